@@ -1,13 +1,49 @@
+import json
+import math
+import mimetypes
 import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g,
+    send_from_directory, stream_template, get_flashed_messages, jsonify,
+    Response, stream_with_context, abort,
+)
+import click
 # from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import Unauthorized
-
-from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm
-from models import db, connect_db, User, Message
+from werkzeug.exceptions import (
+    Unauthorized, TooManyRequests, BadRequest, ServiceUnavailable)
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import archive
+import assets
+import entities
+import export
+import metrics
+import sqlite_engine
+import suggestions
+import trending
+from availability import FIELDS as NAME_FIELDS, TakenNames
+from capture import RequestCapture
+from events import Broker, LocalChannel, PostgresChannel, SQLiteChannel
+from follow_graph import FOLLOWS_TOPIC, FollowGraph
+from forms import (
+    UserAddForm, LoginForm, MessageForm, CSRFProtectForm, UserEditForm,
+    ProfilerForm,
+)
+from images import InvalidImage, save_upload, variant_url
+from models import (
+    db, connect_db, shards, User, Message, MessageTag, Mention, Follow, Like)
+from prepared_statements import PreparedStatements
+from profiler import SamplingProfiler
+from ratelimit import Limit, TokenBucketStore
+from slow_queries import SlowQueryLog
 
 load_dotenv()
 
@@ -15,24 +51,396 @@ CURR_USER_KEY = "curr_user"
 
 app = Flask(__name__)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
+# Without DATABASE_URL, a SQLite database in the instance folder
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+    'DATABASE_URL', 'sqlite:///warbler.sqlite3')
 app.config['SQLALCHEMY_ECHO'] = False
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['UPLOAD_FOLDER'] = os.environ.get(
+    'UPLOAD_FOLDER', os.path.join(app.root_path, 'uploads'))
+app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024
+app.config['RATELIMIT_ENABLED'] = (
+    os.environ.get('RATELIMIT_ENABLED', '1') == '1')
+app.config['RATELIMIT_STORAGE'] = os.environ.get(
+    'RATELIMIT_STORAGE',
+    os.path.join(tempfile.gettempdir(), 'warbler-ratelimit.sqlite3'))
+# Proxies in front of the app whose X-Forwarded-For/-Proto are trusted; the
+# client's address (which rate limits key on) is the one they forwarded
+app.config['PROXY_HOPS'] = int(os.environ.get('PROXY_HOPS', 0))
+app.config['PROFILER_STORAGE'] = os.environ.get(
+    'PROFILER_STORAGE',
+    os.path.join(tempfile.gettempdir(), 'warbler-profiler.sqlite3'))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': metrics.TimedQueuePool,
+}
+
+if sqlite_engine.is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite_engine.engine_options(
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 200))
+app.config['SLOW_QUERY_ANALYZE'] = os.environ.get('SLOW_QUERY_ANALYZE') == '1'
+app.config['ARCHIVE_AFTER_DAYS'] = int(
+    os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+app.config['ARCHIVE_MONTHS_AHEAD'] = 3
+app.config['EVENTS_CHANNEL'] = os.environ.get(
+    'EVENTS_CHANNEL',
+    'postgres' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres')
+    else 'sqlite')
+app.config['EVENTS_STORAGE'] = os.environ.get(
+    'EVENTS_STORAGE',
+    os.path.join(tempfile.gettempdir(), 'warbler-events.sqlite3'))
+# Timeline streams and long-polls each process holds open at once; keep it
+# below the number of threads (see gunicorn.conf.py)
+app.config['MAX_STREAMS'] = int(os.environ.get('MAX_STREAMS', 192))
+app.config['FOLLOW_GRAPH'] = os.environ.get('FOLLOW_GRAPH', '1') == '1'
+app.config['TAKEN_NAMES'] = os.environ.get('TAKEN_NAMES', '1') == '1'
+app.config['FOLLOW_GRAPH_RELOAD_INTERVAL'] = int(
+    os.environ.get('FOLLOW_GRAPH_RELOAD_INTERVAL', 3600))
+app.config['CAPTURE_FILE'] = os.environ.get('CAPTURE_FILE')
+app.config['CAPTURE_SAMPLE'] = float(os.environ.get('CAPTURE_SAMPLE', 1))
+app.config['TRENDING_FLUSH'] = os.environ.get('TRENDING_FLUSH', '1') == '1'
+app.config['SUGGESTION_UPDATES'] = (
+    os.environ.get('SUGGESTION_UPDATES', '1') == '1')
+app.config['PREPARED_STATEMENTS'] = (
+    os.environ.get('PREPARED_STATEMENTS', '1') == '1')
+app.config['SHARD_DATABASE_URLS'] = [
+    url for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',')
+    if url]
 # toolbar = DebugToolbarExtension(app)
 
+if app.config['PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(
+        app.wsgi_app,
+        x_for=app.config['PROXY_HOPS'],
+        x_proto=app.config['PROXY_HOPS'])
+
 connect_db(app)
+metrics.instrument_engine(db.engine)
+
+if db.engine.dialect.name == 'sqlite':
+    sqlite_engine.instrument(db.engine)
+
+slow_query_log = SlowQueryLog(
+    threshold_ms=app.config['SLOW_QUERY_MS'],
+    analyze=app.config['SLOW_QUERY_ANALYZE'],
+)
+slow_query_log.instrument(db.engine)
+
+# After the slow query log, so it sees statements before they're rewritten
+prepared_statements = PreparedStatements(
+    enabled=app.config['PREPARED_STATEMENTS'])
+prepared_statements.instrument(db.engine)
+
+shards.init_app(app)
+
+for engine in shards.engines:
+    slow_query_log.instrument(engine)
+    prepared_statements.instrument(engine)
+
+if app.config['EVENTS_CHANNEL'] == 'postgres':
+    broker = Broker(PostgresChannel(db.engine))
+elif app.config['EVENTS_CHANNEL'] == 'sqlite':
+    broker = Broker(SQLiteChannel(app.config['EVENTS_STORAGE']))
+else:
+    broker = Broker(LocalChannel())
+
+request_capture = RequestCapture(
+    app.config['CAPTURE_FILE'], sample=app.config['CAPTURE_SAMPLE'])
+
+# Shared by the workers on this node, like the rate limits
+profiler = SamplingProfiler(app.config['PROFILER_STORAGE'])
+
+# Started in each gunicorn worker by gunicorn.conf.py
+follow_graph = FollowGraph(
+    broker, reload_interval=app.config['FOLLOW_GRAPH_RELOAD_INTERVAL'])
+User.follow_graph = follow_graph
+
+# Also started per worker by gunicorn.conf.py
+taken_names = TakenNames(broker)
+trending_counter = trending.TrendingCounter()
+
+suggestion_updater = suggestions.SuggestionUpdater()
+
+# And when first used, for servers without that hook
+if app.config['TAKEN_NAMES']:
+    taken_names.init_app(app)
+
+if app.config['TRENDING_FLUSH']:
+    trending_counter.init_app(app)
+
+if app.config['SUGGESTION_UPDATES']:
+    suggestion_updater.init_app(app)
+
+app.add_template_filter(variant_url, 'variant')
+app.add_template_filter(entities.linkify, 'linkify')
+
+# Views that check a password with bcrypt -> limits per IP and per user
+RATE_LIMITS = {
+    'login': {'ip': Limit(20, 60), 'user': Limit(5, 60)},
+    'signup': {'ip': Limit(5, 600), 'user': Limit(5, 600)},
+    'edit_profile': {'ip': Limit(20, 60), 'user': Limit(5, 60)},
+    # Says whether a username is taken, to anyone: per IP, and on GETs
+    'check_available': {'ip': Limit(30, 60), 'methods': {'GET'}},
+}
+
+# POST views that take SQLite's write lock themselves (see begin_write),
+# or don't write at all
+LATE_WRITE_ENDPOINTS = {'login', 'signup', 'edit_profile'}
+
+# Rows fetched per round trip by streamed pages
+STREAM_YIELD_PER = 100
+
+# Streamed pages send the page chrome once this many bytes are rendered,
+# then flush in chunks of STREAM_BUFFER_SIZE
+STREAM_FIRST_FLUSH = 1024
+STREAM_BUFFER_SIZE = 8192
+
+# Results per page of message search
+SEARCH_PAGE_SIZE = 20
+
+# Messages per page of tag and mention lists
+PAGE_SIZE = 20
+
+# Tables kept on the shards when SHARD_DATABASE_URLS is set
+SHARDED_TABLES = [
+    Message.__table__, Like.__table__, MessageTag.__table__,
+    Mention.__table__,
+]
+
+# Most ids returned by the new-messages endpoint, longest it may wait for
+# new messages, and how often it re-checks if no event wakes it (seconds)
+NEW_MESSAGES_LIMIT = 100
+NEW_MESSAGES_MAX_WAIT = 30
+NEW_MESSAGES_POLL_INTERVAL = 10
+
+# Seconds between keep-alive comments on idle timeline streams
+STREAM_HEARTBEAT = 20
+
+# Seconds a client should wait to retry when MAX_STREAMS are open
+STREAM_RETRY_AFTER = 30
+
+open_streams = threading.BoundedSemaphore(app.config['MAX_STREAMS'])
+
+# Uploaded images and built assets have content-addressed names, so they
+# never change
+UPLOAD_MAX_AGE = 365 * 24 * 60 * 60
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@app.template_global()
+def asset_url(filename):
+    """URL for a static file, using the fingerprinted build if there is one."""
+
+    return assets.asset_url(app.static_folder, filename)
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    manifest = assets.build_assets(app.static_folder)
+    print(f"Built {len(manifest)} assets")
+
+
+##############################################################################
+# Request metrics
+
+
+@app.before_request
+def start_request_timer():
+    """Note when the request started, for latency metrics."""
+
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def save_response_status(response):
+    """Keep the status code until the request is torn down."""
+
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exc):
+    """Record latency and status once any streamed body has been sent."""
+
+    if 'request_start' not in g:
+        return
+
+    metrics.observe_request(
+        request.endpoint,
+        request.method,
+        g.get('response_status', 500),
+        time.perf_counter() - g.request_start,
+    )
+
+
+@app.teardown_request
+def capture_request(exc):
+    """Append the finished request to the capture file, if there is one."""
+
+    # Torn down twice when a test client keeps the context
+    if (not request_capture.enabled
+            or 'request_start' not in g
+            or request.environ.get('warbler.captured')):
+        return
+
+    request.environ['warbler.captured'] = True
+    seconds = time.perf_counter() - g.request_start
+
+    request_capture.record(
+        request,
+        session.get(CURR_USER_KEY),
+        g.get('response_status', 500),
+        time.time() - seconds,
+        seconds,
+    )
+
+
+@app.get('/metrics')
+def show_metrics():
+    """Metrics for all workers, in Prometheus text format.
+
+    If METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
+
+    token = app.config['METRICS_TOKEN']
+
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        raise Unauthorized()
+
+    ratelimit_counters = metrics.CounterCollector(
+        'warbler_ratelimit_checks',
+        'Rate limit checks, by view and outcome.',
+        ['scope', 'outcome'],
+        get_rate_limit_store().get_counters,
+    )
+
+    return (
+        metrics.generate([ratelimit_counters]),
+        200,
+        {'Content-Type': metrics.CONTENT_TYPE},
+    )
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+def get_rate_limit_store():
+    """Return token bucket store for the configured RATELIMIT_STORAGE."""
+
+    store = app.extensions.get('ratelimit')
+
+    if store is None or store.path != app.config['RATELIMIT_STORAGE']:
+        store = TokenBucketStore(app.config['RATELIMIT_STORAGE'])
+        app.extensions['ratelimit'] = store
+
+    return store
+
+
+@app.before_request
+def check_rate_limit():
+    """Limit password-checking form submissions per IP and per user, and
+    name availability checks per IP.
+
+    Runs before any hook that touches the database, so rejected requests
+    never reach the database or bcrypt.
+    """
+
+    limits = RATE_LIMITS.get(request.endpoint)
+
+    if (not limits
+            or request.method not in limits.get('methods', {'POST'})
+            or not app.config['RATELIMIT_ENABLED']):
+        return
+
+    if request.endpoint == 'edit_profile':
+        user_key = session.get(CURR_USER_KEY)
+    else:
+        user_key = request.form.get('username', '').lower()
+
+    buckets = [
+        (f"{request.endpoint}:ip:{request.remote_addr}", limits['ip'])]
+
+    if 'user' in limits:
+        buckets.append(
+            (f"{request.endpoint}:user:{user_key}", limits['user']))
+
+    allowed, retry_after = get_rate_limit_store().consume(
+        request.endpoint, buckets)
+
+    if not allowed:
+        raise TooManyRequests(retry_after=math.ceil(retry_after))
+
+
+@app.cli.command('ratelimit-stats')
+def ratelimit_stats_command():
+    """Print allowed/rejected counts for each rate-limited view."""
+
+    counters = get_rate_limit_store().get_counters()
+
+    for (scope, outcome), count in sorted(counters.items()):
+        print(f"{scope}\t{outcome}\t{count}")
+
+
+@app.before_request
+def start_profiling():
+    """Profile a sample of requests while the profiler is enabled."""
+
+    if profiler.enabled and profiler.should_sample(request.endpoint):
+        profiler.start_request(request.endpoint)
+        g.profiling = True
+
+
+@app.teardown_request
+def stop_profiling(exc):
+    """Stop profiling the request, after any streamed body has been sent."""
+
+    if g.get('profiling'):
+        profiler.stop_request()
+
+
+def begin_write():
+    """On SQLite, start a transaction that holds the write lock.
+
+    Otherwise a request that reads and then writes can fail with "database
+    is locked" when another worker writes in between. Ends the request's
+    transaction so far, which must not have written anything.
+    """
+
+    if sqlite_engine.is_sqlite(str(db.engine.url)):
+        db.session.commit()
+        db.session.connection(
+            execution_options={'sqlite_begin': 'IMMEDIATE'})
+
+
+@app.before_request
+def begin_writes_immediately():
+    """On SQLite, take the write lock at the start of requests that write.
+
+    Except in views that hash passwords or resize images before writing:
+    they call begin_write() after that work, so other writers don't wait
+    behind it.
+    """
+
+    if (request.method == 'POST'
+            and request.endpoint not in LATE_WRITE_ENDPOINTS
+            and sqlite_engine.is_sqlite(str(db.engine.url))):
+        db.session.connection(
+            execution_options={'sqlite_begin': 'IMMEDIATE'})
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = User.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -58,6 +466,53 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def stream_page(template_name, **context):
+    """Render a template as a stream of buffered chunks.
+
+    Queries in `context` should use `yield_per()` so rows are fetched from
+    a server-side cursor while the page is sent.
+    """
+
+    # Pop flashed messages now: the session cookie is sent before the body
+    # is rendered, so popping them while streaming wouldn't be saved
+    get_flashed_messages(with_categories=True)
+
+    def generate():
+        buffer = []
+        size = 0
+        limit = STREAM_FIRST_FLUSH
+
+        for chunk in stream_template(template_name, **context):
+            buffer.append(chunk)
+            size += len(chunk)
+
+            if size >= limit:
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+                limit = STREAM_BUFFER_SIZE
+
+        if buffer:
+            yield ''.join(buffer)
+
+    # The server sends the body after the view returns: keep the request
+    # (g, the session, the database session) until it's done
+    return app.response_class(stream_with_context(generate()))
+
+
+def get_submitted_image_url(file_field, url_field, kind, default):
+    """Return URL for an image given either as an upload or as a URL.
+
+    Uploads take precedence and are stored locally. Raises InvalidImage if
+    the uploaded file isn't an image.
+    """
+
+    if file_field.data:
+        return save_upload(file_field.data, kind)
+
+    return url_field.data or default
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -75,14 +530,34 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Checked before bcrypt runs; the IntegrityError below still
+        # catches names taken in the meantime
+        if (taken_names.is_taken('username', form.username.data) or
+                taken_names.is_taken('email', form.email.data)):
+            flash("Username or email already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        try:
+            image_url = get_submitted_image_url(
+                form.image_file,
+                form.image_url,
+                'avatars',
+                User.image_url.default.arg,
+            )
+
+        except InvalidImage:
+            flash("Invalid image file", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=image_url,
             )
 
+            begin_write()
             db.session.add(user)
             db.session.commit()
 
@@ -92,6 +567,7 @@ def signup():
             flash("Username or email already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        taken_names.add(user.username, user.email)
         do_login(user)
 
         return redirect("/")
@@ -100,6 +576,37 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
+@app.get('/api/users/available')
+def check_available():
+    """Is a username or email free to sign up with?
+
+    Takes one of `username` or `email`; returns JSON with `available`.
+    Logged-in users' own names count as available, for profile edits.
+    Emails are only checked for logged-in users, so the endpoint can't be
+    used to find out who has an account.
+    """
+
+    for field in NAME_FIELDS:
+        value = request.args.get(field, '').strip()
+
+        if value:
+            break
+
+    else:
+        raise BadRequest("Give a username or email")
+
+    if field == 'email' and not g.user:
+        raise Unauthorized()
+
+    exclude_user_id = g.user.id if g.user else None
+
+    return jsonify(
+        field=field,
+        value=value,
+        available=not taken_names.is_taken(field, value, exclude_user_id),
+    )
+
+
 @app.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login and redirect to homepage on success."""
@@ -158,22 +665,297 @@ def list_users():
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.query
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = User.query.filter(User.username.like(f"%{search}%"))
 
-    return render_template('users/index.html', users=users)
+    return stream_page(
+        'users/index.html', users=users.yield_per(STREAM_YIELD_PER))
 
 
 @app.get('/users/<int:user_id>')
 def show_user(user_id):
     """Show user profile."""
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    user = User.get(user_id)
+
+    if user is None:
+        abort(404)
+
+    messages = user.get_messages(yield_per=STREAM_YIELD_PER)
+
+    return stream_page('users/show.html', user=user, messages=messages)
+
+
+@app.get('/users/<int:user_id>/archive')
+def show_archive(user_id):
+    """Show the months of a user's archived messages, or (with
+    ?month=YYYY-MM) the messages from one month."""
+
     if not g.user:
         flash("Access unauthorized!", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/show.html', user=user)
+    months = archive.get_archive_months(user.id)
+
+    try:
+        month = datetime.strptime(request.args.get('month', ''), '%Y-%m')
+    except ValueError:
+        month = None
+
+    if month:
+        messages = archive.get_archived_messages(user.id, month)
+    else:
+        messages = []
+
+    return render_template(
+        'users/archive.html',
+        user=user,
+        months=months,
+        month=month,
+        messages=messages)
+
+
+@app.cli.command('archive-messages')
+@click.option('--days', type=int, default=None,
+              help="Archive messages older than this (ARCHIVE_AFTER_DAYS).")
+def archive_messages_command(days):
+    """Move old messages into the compressed monthly archive."""
+
+    if shards.enabled:
+        raise click.UsageError("Archiving sharded messages isn't supported")
+
+    if days is None:
+        days = app.config['ARCHIVE_AFTER_DAYS']
+
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    count = archive.archive_messages(
+        cutoff, app.config['ARCHIVE_MONTHS_AHEAD'])
+    db.session.commit()
+
+    print(f"Archived {count} messages older than {cutoff:%Y-%m-%d}")
+
+
+@app.cli.command('create-shards')
+def create_shards_command():
+    """Create the message tables on each of SHARD_DATABASE_URLS."""
+
+    shards.create_all(SHARDED_TABLES)
+
+    print(f"Created tables on {len(shards.engines)} shards")
+
+
+@app.cli.command('create-partitions')
+def create_partitions_command():
+    """Create archive partitions for the months archived next."""
+
+    cutoff = datetime.utcnow() - timedelta(
+        days=app.config['ARCHIVE_AFTER_DAYS'])
+    first = archive.month_start(cutoff)
+    created = archive.ensure_partitions(
+        first, archive.add_months(first, app.config['ARCHIVE_MONTHS_AHEAD']))
+    db.session.commit()
+
+    print(f"Created {len(created)} partitions")
+
+
+@app.get('/users/<int:user_id>/export')
+def export_user(user_id):
+    """Download a user's data; only for that user and admins.
+
+    Query string: `format` (ndjson or csv), `section` (repeatable; CSV
+    needs exactly one) and `after` (a cursor to resume from). Compressed
+    with gzip when the client accepts it.
+    """
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    if g.user.id != user_id:
+        check_admin()
+
+    user = User.query.get_or_404(user_id)
+    fmt = request.args.get('format', 'ndjson')
+    sections = request.args.getlist('section') or export.SECTIONS
+
+    try:
+        lines = export.generate(
+            user.id, fmt, sections, request.args.get('after'))
+    except export.InvalidExport as e:
+        raise BadRequest(str(e))
+
+    gzip = 'gzip' in request.accept_encodings
+
+    response = Response(
+        stream_with_context(export.encode(lines, gzip)),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson')
+
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename="warbler-{user.username}.{fmt}"')
+    response.vary.add('Accept-Encoding')
+
+    if gzip:
+        response.content_encoding = 'gzip'
+
+    return response
+
+
+@app.cli.command('export-user')
+@click.argument('username')
+@click.option('--format', 'fmt', type=click.Choice(export.FORMATS),
+              default='ndjson')
+@click.option('--section', 'sections', multiple=True,
+              type=click.Choice(export.SECTIONS))
+@click.option('--after', help="Resume after this cursor (section:id).")
+@click.option('--gzip', is_flag=True, help="Compress the output.")
+@click.option('--output', '-o', type=click.File('wb'), default='-')
+def export_user_command(username, fmt, sections, after, gzip, output):
+    """Write USERNAME's data to a file (or stdout)."""
+
+    user = User.query.filter_by(username=username).one()
+
+    try:
+        lines = export.generate(
+            user.id, fmt, sections or export.SECTIONS, after)
+    except export.InvalidExport as e:
+        raise click.UsageError(str(e))
+
+    for chunk in export.encode(lines, gzip):
+        output.write(chunk)
+
+
+@app.cli.command('graph-stats')
+@click.option('--chunk-size', default=100_000,
+              help="Follows fetched per round trip.")
+def graph_stats_command(chunk_size):
+    """Compute follower counts, influence and reciprocity for all users."""
+
+    # Imported here so web workers don't load numpy and scipy
+    import graph_stats
+
+    summary = graph_stats.run(chunk_size)
+    db.session.commit()
+
+    print(f"{summary['users']} users, {summary['follows']} follows, "
+          f"reciprocity {summary['reciprocity']:.3f}, "
+          f"{summary['seconds']:.1f}s")
+
+
+@app.cli.command('rebuild-suggestions')
+def rebuild_suggestions_command():
+    """Recompute "who to follow" suggestions for all users."""
+
+    start = time.perf_counter()
+    count = suggestions.rebuild()
+    db.session.commit()
+
+    print(f"{count} suggestions in {time.perf_counter() - start:.1f}s")
+
+
+@app.cli.command('bench-statements')
+@click.option('--iterations', default=1000)
+@click.option('--username',
+              help="Run the queries as this user (default: the one "
+              "following the most).")
+def bench_statements_command(iterations, username):
+    """Time the per-request queries built each time vs. cached statements.
+
+    Each query runs `iterations` times, as a new request would (with an
+    empty session): built and compiled each time (no compiled cache),
+    built each time (SQLAlchemy's compiled cache; how they were written
+    before), and as cached, prepared statements.
+    """
+
+    if username:
+        user = User.get_by_username(username)
+    else:
+        user = db.session.execute(
+            select(User)
+            .join(Follow, Follow.user_following_id == User.id)
+            .group_by(User.id)
+            .order_by(func.count().desc())
+            .limit(1)).scalar_one_or_none()
+
+    if user is None:
+        raise click.UsageError("No such user")
+
+    user_id, name = user.id, user.username
+    feed_ids = user.list_feed_user_ids()
+    # Kept loaded while each run starts with an empty session
+    db.session.expunge(user)
+
+    built = {
+        'user by id': lambda: User.query.get(user_id),
+        'user by username': lambda: (
+            User.query.filter_by(username=name).one_or_none()),
+        'feed user ids': lambda: db.session.execute(
+            user.get_feed_user_ids()).scalars().all(),
+        'timeline': lambda: db.session.execute(
+            select(Message)
+            .where(Message.user_id.in_(feed_ids))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(100)).scalars().all(),
+        'user messages': lambda: (
+            Message.query
+            .filter_by(user_id=user_id)
+            .order_by(Message.timestamp.desc())
+            .execution_options(shard=shards.for_user(user_id))
+            .all()),
+    }
+    cached = {
+        'user by id': lambda: User.get(user_id),
+        'user by username': lambda: User.get_by_username(name),
+        'feed user ids': user.list_feed_user_ids,
+        'timeline': lambda: Message.get_timeline(feed_ids),
+        'user messages': lambda: user.get_messages().all(),
+    }
+    # Run by every logged-in homepage view
+    homepage = ('user by id', 'feed user ids', 'timeline')
+
+    def run(query, execution_options=None):
+        db.session.rollback()
+        db.session.connection(execution_options=execution_options or {})
+
+        for _ in range(10):
+            db.session.expunge_all()
+            query()
+
+        start = time.perf_counter()
+
+        for _ in range(iterations):
+            db.session.expunge_all()
+            query()
+
+        return (time.perf_counter() - start) / iterations * 1e6
+
+    print(f"{'query (us each)':<20}{'uncompiled':>12}{'built':>10}"
+          f"{'cached':>10}")
+    totals = [0, 0, 0]
+
+    for label in built:
+        times = (
+            run(built[label], {'compiled_cache': None}),
+            run(built[label]),
+            run(cached[label]))
+
+        if label in homepage:
+            totals = [total + t for total, t in zip(totals, times)]
+
+        print(f"{label:<20}" + ''.join(
+            f"{t:>{width}.0f}" for t, width in zip(times, (12, 10, 10))))
+
+    db.session.rollback()
+
+    print(f"{'homepage total':<20}" + ''.join(
+        f"{t:>{width}.0f}" for t, width in zip(totals, (12, 10, 10))))
+    print(f"Cached statements save {totals[1] - totals[2]:.0f} us per "
+          f"homepage request ({totals[0] - totals[2]:.0f} us with no "
+          f"compiled cache)")
 
 
 @app.get('/users/<int:user_id>/following')
@@ -185,7 +967,12 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following = (g.user
+                 .with_relationships(user.get_following())
+                 .yield_per(STREAM_YIELD_PER))
+
+    return stream_page(
+        'users/following.html', user=user, following=following)
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -197,7 +984,12 @@ def show_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = (g.user
+                 .with_relationships(user.get_followers())
+                 .yield_per(STREAM_YIELD_PER))
+
+    return stream_page(
+        'users/followers.html', user=user, followers=followers)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -218,12 +1010,22 @@ def start_following(follow_id):
     if g.csrf_form.validate_on_submit():
         followed_user = User.query.get_or_404(follow_id)
 
-        if g.user.is_following(followed_user):
+        # Checked in the database: the follow graph may be a moment behind
+        if db.session.get(Follow, (followed_user.id, g.user.id)):
             flash("You are already following that person!", 'danger')
 
         else:
             g.user.following.append(followed_user)
+            db.session.flush()
+            suggestions.follow_added(g.user.id, followed_user.id)
             db.session.commit()
+            suggestion_updater.wake()
+
+            broker.publish(FOLLOWS_TOPIC, {
+                'type': 'follow',
+                'user_id': g.user.id,
+                'followed_id': followed_user.id,
+            })
 
         return redirect(f"/users/{g.user.id}/following")
 
@@ -245,9 +1047,20 @@ def stop_following(follow_id):
     if g.csrf_form.validate_on_submit():
         followed_user = User.query.get_or_404(follow_id)
 
-        if g.user.is_following(followed_user):
-            g.user.following.remove(followed_user)
+        follow = db.session.get(Follow, (followed_user.id, g.user.id))
+
+        if follow:
+            db.session.delete(follow)
+            db.session.flush()
+            suggestions.follow_removed(g.user.id, followed_user.id)
             db.session.commit()
+            suggestion_updater.wake()
+
+            broker.publish(FOLLOWS_TOPIC, {
+                'type': 'unfollow',
+                'user_id': g.user.id,
+                'followed_id': followed_user.id,
+            })
 
         else:
             flash("You cannot unfollow someone that you are not following!",
@@ -270,6 +1083,13 @@ def edit_profile():
     form = UserEditForm(obj=g.user)
 
     if form.validate_on_submit():
+        if (taken_names.is_taken(
+                'username', form.username.data, exclude_user_id=g.user.id) or
+                taken_names.is_taken(
+                    'email', form.email.data, exclude_user_id=g.user.id)):
+            flash("Username or email already taken!", 'danger')
+            return render_template('users/edit.html', form=form)
+
         psw = form.password.data
 
         # user is either a user instance or False
@@ -280,11 +1100,30 @@ def edit_profile():
             return render_template('users/edit.html', form=form)
 
         try:
+            image_url = get_submitted_image_url(
+                form.image_file,
+                form.image_url,
+                'avatars',
+                User.image_url.default.arg,
+            )
+            header_image_url = get_submitted_image_url(
+                form.header_image_file,
+                form.header_image_url,
+                'headers',
+                User.header_image_url.default.arg,
+            )
+
+        except InvalidImage:
+            flash("Invalid image file", 'danger')
+            return render_template('users/edit.html', form=form)
+
+        try:
+            begin_write()
+
             user.username = form.username.data
             user.email = form.email.data
-            user.image_url = form.image_url.data or User.image_url.default.arg
-            user.header_image_url = (form.header_image_url.data
-                                     or User.header_image_url.default.arg)
+            user.image_url = image_url
+            user.header_image_url = header_image_url
             user.bio = form.bio.data
 
             db.session.commit()
@@ -296,6 +1135,7 @@ def edit_profile():
             return render_template('users/edit.html', form=form)
 
         else:
+            taken_names.add(user.username, user.email)
             return redirect(f'/users/{user.id}')
 
     else:
@@ -316,10 +1156,16 @@ def delete_user():
     if g.csrf_form.validate_on_submit():
         do_logout()
 
-        Message.query.filter_by(user_id=g.user.id).delete()
+        user_id = g.user.id
+        g.user.delete_messages()
+        suggestions.user_deleted(user_id)
 
         db.session.delete(g.user)
         db.session.commit()
+        suggestion_updater.wake()
+
+        # Their follows went with them
+        broker.publish(FOLLOWS_TOPIC, {'type': 'delete', 'user_id': user_id})
 
         return redirect("/signup")
 
@@ -344,16 +1190,68 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message.create(g.user, form.text.data)
+        entities.index_messages([msg])
         db.session.commit()
 
+        broker.publish(g.user.id, {
+            'type': 'message', 'id': msg.id, 'user_id': g.user.id})
+        trending_counter.posted(msg.id)
+
         flash('Message added!', 'success')
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/search')
+def search_messages():
+    """Search messages by text, best matches first.
+
+    Query string: `q` (search terms), `following=1` to only search messages
+    from the user and people they follow, and `after` (the cursor of the
+    last result of the previous page).
+    """
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    terms = request.args.get('q', '').strip()
+    following_only = request.args.get('following') == '1'
+
+    try:
+        rank, message_id = request.args['after'].split(':')
+        after = (float(rank), int(message_id))
+    except (KeyError, ValueError):
+        after = None
+
+    results = []
+    next_cursor = None
+
+    if terms:
+        user_ids = None
+
+        if following_only:
+            user_ids = g.user.get_feed_user_ids()
+
+        results = Message.search(
+            terms, user_ids=user_ids, after=after,
+            limit=SEARCH_PAGE_SIZE + 1)
+
+        if len(results) > SEARCH_PAGE_SIZE:
+            results = results[:SEARCH_PAGE_SIZE]
+            last = results[-1]
+            next_cursor = f"{last.rank!r}:{last.Message.id}"
+
+    return render_template(
+        'messages/search.html',
+        terms=terms,
+        following_only=following_only,
+        results=results,
+        next_cursor=next_cursor)
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -362,7 +1260,7 @@ def show_message(message_id):
         flash("Access unauthorized!", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = get_message_or_404(message_id)
     return render_template('messages/show.html', message=msg)
 
 
@@ -374,7 +1272,7 @@ def delete_message(message_id):
     Redirect to user page on success.
     """
 
-    msg = Message.query.get_or_404(message_id)
+    msg = get_message_or_404(message_id)
 
     if not g.user:
         flash("Access unauthorized!", "danger")
@@ -384,15 +1282,123 @@ def delete_message(message_id):
         raise Unauthorized()
 
     if g.csrf_form.validate_on_submit():
-        db.session.delete(msg)
+        msg.delete()
         db.session.commit()
 
+        broker.publish(g.user.id, {
+            'type': 'delete', 'id': message_id, 'user_id': g.user.id})
+
         flash('Message deleted!', 'success')
         return redirect(f"/users/{g.user.id}")
 
     else:
         raise Unauthorized()
 
+
+def get_message_or_404(message_id):
+    """The message with `message_id`, or a 404."""
+
+    msg = Message.get(message_id)
+
+    if msg is None:
+        abort(404)
+
+    return msg
+
+
+@app.get('/tags/<tag>')
+def show_tag(tag):
+    """Show messages with a hashtag, newest first.
+
+    Pages with ?before=<id of the last message on the previous page>.
+    """
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    tag = tag.lower()
+    stmt = (select(Message)
+            .join(MessageTag, MessageTag.message_id == Message.id)
+            .where(MessageTag.tag == tag))
+
+    messages, before = get_page(stmt, MessageTag.message_id)
+
+    return render_template(
+        'messages/tag.html', tag=tag, messages=messages, before=before)
+
+
+@app.get('/trending')
+def show_trending():
+    """Show the messages trending now, highest score first.
+
+    The list is precomputed every few seconds; see trending.py.
+    """
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    return render_template(
+        'messages/trending.html', messages=trending.get_messages())
+
+
+@app.get('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show messages mentioning a user, newest first.
+
+    Pages with ?before=<id of the last message on the previous page>.
+    """
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    user = User.query.get_or_404(user_id)
+    stmt = (select(Message)
+            .join(Mention, Mention.message_id == Message.id)
+            .where(Mention.user_id == user.id))
+
+    messages, before = get_page(stmt, Mention.message_id)
+
+    return render_template(
+        'users/mentions.html', user=user, messages=messages, before=before)
+
+
+def get_page(stmt, message_id):
+    """One page of messages selected by `stmt`, newest first by
+    `message_id` (gathered from every shard when sharded).
+
+    Returns (messages, cursor for the next page or None).
+    """
+
+    before = request.args.get('before', type=int)
+
+    if before is not None:
+        stmt = stmt.where(message_id < before)
+
+    rows = shards.scatter(
+        stmt.order_by(message_id.desc()).limit(PAGE_SIZE + 1),
+        key=lambda row: row[0].id,
+        limit=PAGE_SIZE + 1)
+    messages = [message for message, in rows]
+
+    if len(messages) > PAGE_SIZE:
+        messages = messages[:PAGE_SIZE]
+        return messages, messages[-1].id
+
+    return messages, None
+
+
+@app.cli.command('backfill-entities')
+@click.option('--batch-size', default=1000)
+def backfill_entities_command(batch_size):
+    """Parse hashtags and mentions of all existing messages."""
+
+    for done in entities.backfill(batch_size):
+        print(f"Indexed {done} messages")
+
+
 ##############################################################################
 # Likes routes:
 
@@ -405,7 +1411,7 @@ def toggle_message_like(message_id):
         flash("Access unauthorized!", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = get_message_or_404(message_id)
 
     if g.csrf_form.validate_on_submit():
 
@@ -416,11 +1422,14 @@ def toggle_message_like(message_id):
             return redirect(request_url)
 
         if g.user.has_liked(msg):
-            g.user.likes.remove(msg)
+            g.user.unlike(msg)
+            db.session.commit()
+            trending_counter.unliked(msg.id)
         else:
-            g.user.likes.append(msg)
+            g.user.like(msg)
+            db.session.commit()
+            trending_counter.liked(msg.id)
 
-        db.session.commit()
         return redirect(request_url)
 
     else:
@@ -436,7 +1445,149 @@ def get_and_display_user_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/show_likes.html', user=user)
+    return render_template(
+        'users/show_likes.html',
+        user=user,
+        messages=user.get_liked_messages())
+
+
+##############################################################################
+# Admin routes
+
+
+def check_admin():
+    """Raise Unauthorized unless the current user is an admin."""
+
+    if not g.user.is_admin:
+        raise Unauthorized()
+
+
+@app.route('/admin/profiler', methods=["GET", "POST"])
+def manage_profiler():
+    """Show profiler status and sampled routes; turn profiler on/off."""
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    check_admin()
+
+    form = ProfilerForm(
+        enabled=profiler.enabled, sample_rate=profiler.default_rate)
+
+    if form.validate_on_submit():
+        profiler.set_rate(form.sample_rate.data, form.endpoint.data)
+
+        if form.enabled.data:
+            profiler.enable()
+        else:
+            profiler.disable()
+
+        flash("Profiler settings saved", 'success')
+        return redirect('/admin/profiler')
+
+    return render_template(
+        'admin/profiler.html',
+        form=form,
+        profiler=profiler,
+        summary=profiler.get_summary(),
+    )
+
+
+@app.get('/admin/profiler/<endpoint>.folded')
+def download_profile(endpoint):
+    """Download collapsed stacks sampled for `endpoint`."""
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    check_admin()
+
+    return (
+        profiler.get_collapsed(endpoint),
+        200,
+        {
+            'Content-Type': 'text/plain; charset=utf-8',
+            'Content-Disposition':
+                f'attachment; filename="{endpoint}.folded"',
+        },
+    )
+
+
+@app.post('/admin/profiler/reset')
+def reset_profiler():
+    """Drop all sampled stacks."""
+
+    if not g.user:
+        flash("Access unauthorized!", "danger")
+        return redirect("/")
+
+    check_admin()
+
+    if g.csrf_form.validate_on_submit():
+        profiler.reset()
+
+        flash("Profiles cleared", 'success')
+        return redirect('/admin/profiler')
+
+    else:
+        raise Unauthorized()
+
+
+@app.cli.command('make-admin')
+@click.argument('username')
+def make_admin_command(username):
+    """Give USERNAME access to the admin pages."""
+
+    user = User.query.filter_by(username=username).one()
+    user.is_admin = True
+    db.session.commit()
+
+    print(f"{username} is now an admin")
+
+
+##############################################################################
+# Uploads and static assets
+
+
+@app.get('/uploads/<path:filename>')
+def show_upload(filename):
+    """Serve an uploaded image (or one of its variants)."""
+
+    response = send_from_directory(
+        app.config['UPLOAD_FOLDER'], filename, max_age=UPLOAD_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+
+@app.get('/assets/<path:filename>')
+def show_asset(filename):
+    """Serve a built asset, precompressed if the client accepts it."""
+
+    dist_folder = os.path.join(app.static_folder, assets.DIST_DIR)
+
+    variant, encoding = assets.choose_variant(
+        dist_folder,
+        filename,
+        request.accept_encodings,
+        'image/webp' in request.accept_mimetypes.values(),
+    )
+
+    if variant.endswith('.webp'):
+        mimetype = 'image/webp'
+    else:
+        mimetype = mimetypes.guess_type(filename)[0]
+
+    response = send_from_directory(
+        dist_folder, variant, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.cache_control.immutable = True
+    response.vary.update(['Accept-Encoding', 'Accept'])
+
+    if encoding:
+        response.content_encoding = encoding
+
+    return response
 
 
 ##############################################################################
@@ -452,24 +1603,156 @@ def homepage():
     """
 
     if g.user:
-        self_plus_is_following = g.user.following.copy()
-        self_plus_is_following.append(g.user)
-
-        ids = [u.id for u in self_plus_is_following]
+        messages = Message.get_timeline(g.user.list_feed_user_ids())
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        latest_id = max((msg.id for msg in messages), default=0)
 
-        return render_template('home.html', messages=messages)
+        return render_template(
+            'home.html', messages=messages, latest_id=latest_id)
 
     else:
         return render_template('home-anon.html')
 
 
+def reserve_stream():
+    """Take one of this process's MAX_STREAMS, or raise 503."""
+
+    if not open_streams.acquire(blocking=False):
+        raise ServiceUnavailable(retry_after=STREAM_RETRY_AFTER)
+
+
+@app.get('/api/timeline/new')
+def new_timeline_messages():
+    """Count and ids of home timeline messages newer than a cursor.
+
+    Query string: `since` (the newest message id the client has) and
+    `wait` (seconds). With `wait`, holds the request until there is at
+    least one new message or the time is up. It sleeps until the broker
+    reports a message from someone in the feed (re-checking every
+    NEW_MESSAGES_POLL_INTERVAL seconds regardless), and the database
+    connection is returned to the pool while it sleeps. Responds 503 if
+    this process already has MAX_STREAMS waiting.
+
+    Returns JSON: {"count": ..., "ids": [newest first], "cursor": ...}
+    """
+
+    if not g.user:
+        raise Unauthorized()
+
+    since = request.args.get('since', 0, type=int)
+    wait = request.args.get('wait', 0, type=float)
+
+    # float() takes 'nan' and 'inf': a NaN deadline never passes
+    if not math.isfinite(wait):
+        wait = 0
+
+    wait = max(0, min(wait, NEW_MESSAGES_MAX_WAIT))
+
+    if wait:
+        reserve_stream()
+
+    try:
+        return count_new_timeline_messages(since, wait)
+    finally:
+        if wait:
+            open_streams.release()
+
+
+def count_new_timeline_messages(since, wait):
+    """The new-messages response, waiting up to `wait` seconds."""
+
+    deadline = time.monotonic() + wait
+
+    user_ids = g.user.list_feed_user_ids()
+
+    groups = shards.group_by_user(user_ids)
+
+    def new(ids):
+        return (Message.user_id.in_(ids)) & (Message.id > since)
+
+    subscription = broker.subscribe(user_ids)
+
+    try:
+        while True:
+            count = sum(count for count, in shards.scatter({
+                shard: select(func.count()).where(new(ids))
+                for shard, ids in groups.items()}))
+
+            remaining = deadline - time.monotonic()
+
+            if count or remaining <= 0:
+                break
+
+            db.session.close()
+            subscription.get(min(remaining, NEW_MESSAGES_POLL_INTERVAL))
+    finally:
+        subscription.close()
+
+    rows = shards.scatter(
+        {shard: (select(Message.id)
+                 .where(new(ids))
+                 .order_by(Message.id.desc())
+                 .limit(NEW_MESSAGES_LIMIT))
+         for shard, ids in groups.items()},
+        key=lambda row: row[0],
+        limit=NEW_MESSAGES_LIMIT)
+    ids = [id for id, in rows]
+
+    return jsonify(count=count, ids=ids, cursor=max(ids, default=since))
+
+
+@app.get('/api/timeline/stream')
+def stream_timeline():
+    """Server-sent events for the current user's home timeline.
+
+    Sends a `message` event when someone in the feed posts and a `delete`
+    event when they delete a message, each with JSON data
+    {"id": ..., "user_id": ...}. Holds no database connection while open.
+    Responds 503 if this process already has MAX_STREAMS open.
+    """
+
+    if not g.user:
+        raise Unauthorized()
+
+    reserve_stream()
+
+    try:
+        user_ids = g.user.list_feed_user_ids()
+        subscription = broker.subscribe(user_ids)
+    except BaseException:
+        open_streams.release()
+        raise
+
+    db.session.close()
+
+    def generate():
+        yield "retry: 5000\n\n"
+
+        while True:
+            event = subscription.get(STREAM_HEARTBEAT)
+
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                data = json.dumps(
+                    {'id': event['id'], 'user_id': event['user_id']})
+                yield f"event: {event['type']}\ndata: {data}\n\n"
+
+    def close():
+        # Runs even if the client leaves before the first chunk, when the
+        # generator never started
+        subscription.close()
+        open_streams.release()
+
+    response = Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+
+    return response
+
+
 @app.errorhandler(Unauthorized)
 def page_unauthorized(e):
     """Shows Unauthorized page."""
@@ -477,6 +1760,15 @@ def page_unauthorized(e):
     return render_template('unauthorized.html'), 401
 
 
+@app.errorhandler(TooManyRequests)
+def page_too_many_requests(e):
+    """Shows Too Many Requests page."""
+
+    return (render_template('too_many_requests.html'),
+            429,
+            {'Retry-After': str(e.retry_after)})
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     """Shows 404 NOT FOUND page."""
@@ -486,8 +1778,14 @@ def page_not_found(e):
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Responses that set their own max-age (like uploaded images) are left
+    cacheable.
+    """
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if response.cache_control.max_age is None:
+        response.cache_control.no_store = True
+
     return response
@@ -0,0 +1,203 @@
+"""Move old messages out of the `messages` table into a monthly archive.
+
+`messages` only holds recent messages, so timelines, profiles and deletes
+work against a table whose size is bounded by the archive cutoff rather
+than by the age of the site. Older messages are grouped per user and month
+into one `message_archive` row whose `data` is zlib-compressed JSON.
+
+On PostgreSQL `message_archive` is range-partitioned by month, one
+partition per month, so reading a month of someone's archive only touches
+that month's partition. Partitions are created ahead of time by
+`ensure_partitions` (run by `flask create-partitions` and by every archive
+run); other databases use the plain table.
+"""
+
+import json
+import zlib
+from collections import defaultdict, namedtuple
+from datetime import date, datetime
+
+from sqlalchemy import func, select, text, tuple_
+
+from models import db, Like, Message, MessageArchive
+
+ArchivedMessage = namedtuple(
+    'ArchivedMessage', ['id', 'text', 'timestamp', 'likes'])
+
+BATCH_SIZE = 1000
+
+
+def month_start(when):
+    """First day of the month containing `when`."""
+
+    return date(when.year, when.month, 1)
+
+
+def add_months(month, count):
+    """First day of the month `count` months after `month`."""
+
+    years, index = divmod(month.month - 1 + count, 12)
+    return date(month.year + years, index + 1, 1)
+
+
+def partition_name(month):
+    """Name of the archive partition holding `month`."""
+
+    return f"message_archive_{month:%Y_%m}"
+
+
+def ensure_partitions(first, last):
+    """Create archive partitions for each month from `first` to `last`.
+
+    Returns the names of partitions that were created. Does nothing on
+    databases without declarative partitioning.
+    """
+
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return []
+
+    created = []
+    month = month_start(first)
+
+    while month <= last:
+        name = partition_name(month)
+
+        exists = db.session.execute(
+            text("SELECT to_regclass(:name)"), {'name': name}).scalar()
+
+        if exists is None:
+            db.session.execute(text(
+                f"CREATE TABLE {name} PARTITION OF message_archive "
+                f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"
+            ))
+            created.append(name)
+
+        month = add_months(month, 1)
+
+    return created
+
+
+def pack(messages):
+    """Compress a list of ArchivedMessage, newest first."""
+
+    messages = sorted(messages, key=lambda m: (m.timestamp, m.id),
+                      reverse=True)
+
+    rows = [[m.id, m.text, m.timestamp.isoformat(), m.likes]
+            for m in messages]
+
+    return zlib.compress(
+        json.dumps(rows, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(data):
+    """Decompress archived messages, newest first."""
+
+    rows = json.loads(zlib.decompress(data))
+
+    return [
+        ArchivedMessage(id, text, datetime.fromisoformat(timestamp), likes)
+        for id, text, timestamp, likes in rows
+    ]
+
+
+def archive_messages(cutoff, months_ahead=3, batch_size=BATCH_SIZE):
+    """Archive messages older than `cutoff`; returns how many were moved.
+
+    Messages are read, archived and deleted `batch_size` at a time, in
+    (user_id, id) order, so memory use doesn't grow with the backlog. Likes
+    of archived messages are kept as a count in the archive and removed
+    with the message. Runs in the current transaction, which the caller
+    commits.
+    """
+
+    first = db.session.execute(
+        select(func.min(Message.timestamp))
+        .where(Message.timestamp < cutoff)).scalar()
+
+    if first is None:
+        return 0
+
+    ensure_partitions(first, add_months(month_start(cutoff), months_ahead))
+
+    like_count = (select(func.count())
+                  .where(Like.message_id == Message.id)
+                  .scalar_subquery())
+
+    stmt = (
+        select(Message.user_id, Message.id, Message.text,
+               Message.timestamp, like_count.label('likes'))
+        .where(Message.timestamp < cutoff)
+        .order_by(Message.user_id, Message.id)
+        .limit(batch_size))
+
+    count = 0
+    last = None
+
+    while True:
+        if last is not None:
+            batch = stmt.where(
+                tuple_(Message.user_id, Message.id) > tuple_(*last))
+        else:
+            batch = stmt
+
+        rows = db.session.execute(batch).all()
+
+        if not rows:
+            return count
+
+        archive_rows(rows)
+        count += len(rows)
+        last = rows[-1].user_id, rows[-1].id
+
+
+def archive_rows(rows):
+    """Add message `rows` to their archives and delete the messages."""
+
+    chunks = defaultdict(list)
+
+    for row in rows:
+        chunks[row.user_id, month_start(row.timestamp)].append(
+            ArchivedMessage(row.id, row.text, row.timestamp, row.likes))
+
+    # A month split across batches is added to in the next one
+    for (user_id, month), messages in chunks.items():
+        archive = db.session.get(MessageArchive, (user_id, month))
+
+        if archive is None:
+            archive = MessageArchive(user_id=user_id, month=month)
+            db.session.add(archive)
+        else:
+            messages += unpack(archive.data)
+
+        archive.message_count = len(messages)
+        archive.data = pack(messages)
+
+    db.session.flush()
+
+    ids = [row.id for row in rows]
+    db.session.execute(
+        Like.__table__.delete().where(Like.message_id.in_(ids)))
+    db.session.execute(
+        Message.__table__.delete().where(Message.id.in_(ids)))
+
+
+def get_archive_months(user_id):
+    """(month, message_count) for a user's archived months, newest first."""
+
+    return db.session.execute(
+        select(MessageArchive.month, MessageArchive.message_count)
+        .where(MessageArchive.user_id == user_id)
+        .order_by(MessageArchive.month.desc())
+    ).all()
+
+
+def get_archived_messages(user_id, month):
+    """A user's archived messages from `month`, newest first."""
+
+    archive = db.session.get(MessageArchive, (user_id, month_start(month)))
+
+    if archive is None:
+        return []
+
+    return unpack(archive.data)
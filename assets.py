@@ -0,0 +1,210 @@
+"""Fingerprinted, precompressed static assets.
+
+`build_assets()` copies everything in static/ into static/dist/ under a
+content-hashed name, rewrites /static/ references inside stylesheets,
+re-encodes images and writes gzip/brotli (and WebP) variants next to each
+file:
+
+    static/dist/stylesheets/style.1a2b3c4d5e6f.css
+    static/dist/stylesheets/style.1a2b3c4d5e6f.css.gz
+    static/dist/stylesheets/style.1a2b3c4d5e6f.css.br
+    static/dist/manifest.json
+
+Templates look assets up by their original path with `asset_url()`, which
+falls back to /static/ when no build has been run.
+"""
+
+import gzip
+import json
+import os
+import re
+import shutil
+from hashlib import sha256
+from io import BytesIO
+
+from PIL import Image
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+ASSETS_URL_PREFIX = '/assets/'
+
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+IMAGE_FORMATS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+
+# Content-Encoding -> suffix of the precompressed file, in preference order
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+STATIC_URL_RE = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+_manifest_cache = {'mtime': None, 'entries': {}}
+
+
+def build_assets(static_folder):
+    """Build static/dist from `static_folder` and return the manifest."""
+
+    dist_folder = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist_folder, ignore_errors=True)
+
+    sources = sorted(
+        os.path.relpath(os.path.join(root, name), static_folder)
+        for root, dirs, files in os.walk(static_folder)
+        if os.path.relpath(root, static_folder).split(os.sep)[0] != DIST_DIR
+        for name in files
+    )
+
+    # Stylesheets go last so references to other assets can be rewritten
+    sources.sort(key=lambda path: path.endswith('.css'))
+
+    manifest = {}
+
+    for source in sources:
+        with open(os.path.join(static_folder, source), 'rb') as f:
+            data = f.read()
+
+        ext = os.path.splitext(source)[1].lower()
+
+        if ext == '.css':
+            data = _rewrite_css_urls(data, manifest)
+        elif ext in IMAGE_FORMATS:
+            data = _optimize_image(data, IMAGE_FORMATS[ext])
+
+        hashed = _hashed_name(source, data)
+        manifest[source] = hashed
+
+        path = os.path.join(dist_folder, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        if ext in COMPRESSIBLE_EXTENSIONS:
+            _write_compressed(path, data)
+
+        if ext in IMAGE_FORMATS:
+            _write_webp(path, data)
+
+    with open(os.path.join(dist_folder, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(static_folder):
+    """Return manifest of built assets ({} if assets haven't been built).
+
+    The manifest is re-read only when the file changes.
+    """
+
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)
+
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return {}
+
+    if _manifest_cache['mtime'] != mtime:
+        with open(path) as f:
+            _manifest_cache['entries'] = json.load(f)
+        _manifest_cache['mtime'] = mtime
+
+    return _manifest_cache['entries']
+
+
+def asset_url(static_folder, filename):
+    """URL for static file `filename`, fingerprinted if assets are built."""
+
+    hashed = load_manifest(static_folder).get(filename)
+
+    if hashed:
+        return f"{ASSETS_URL_PREFIX}{hashed}"
+
+    return f"/static/{filename}"
+
+
+def choose_variant(dist_folder, filename, accept_encodings, accepts_webp):
+    """Pick the best precompressed/re-encoded file for a request.
+
+    Returns (filename, content_encoding); content_encoding is None when the
+    file should be sent as-is.
+    """
+
+    ext = os.path.splitext(filename)[1].lower()
+
+    if ext in IMAGE_FORMATS and accepts_webp:
+        webp = f"{filename}.webp"
+        if os.path.exists(os.path.join(dist_folder, webp)):
+            return webp, None
+
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding]:
+            compressed = f"{filename}{suffix}"
+            if os.path.exists(os.path.join(dist_folder, compressed)):
+                return compressed, encoding
+
+    return filename, None
+
+
+def _hashed_name(source, data):
+    """`source` with a content hash inserted before the extension."""
+
+    base, ext = os.path.splitext(source)
+    return f"{base}.{sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _rewrite_css_urls(data, manifest):
+    """Point url(/static/...) references in a stylesheet at built assets."""
+
+    def replace(match):
+        quote, path = match.groups()
+        if path in manifest:
+            return f"url({quote}{ASSETS_URL_PREFIX}{manifest[path]}{quote})"
+        return match.group(0)
+
+    return STATIC_URL_RE.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def _optimize_image(data, fmt):
+    """Re-encode image data, keeping the original if that isn't smaller."""
+
+    with Image.open(BytesIO(data)) as img:
+        out = BytesIO()
+
+        if fmt == 'JPEG':
+            img.save(out, fmt, quality=82, optimize=True, progressive=True)
+        else:
+            img.save(out, fmt, optimize=True)
+
+    optimized = out.getvalue()
+    return optimized if len(optimized) < len(data) else data
+
+
+def _write_webp(path, data):
+    """Write a WebP encoding of an image next to it, if that's smaller."""
+
+    with Image.open(BytesIO(data)) as img:
+        out = BytesIO()
+        img.save(out, 'WEBP', quality=80, method=6)
+
+    if out.tell() < len(data):
+        with open(f"{path}.webp", 'wb') as f:
+            f.write(out.getvalue())
+
+
+def _write_compressed(path, data):
+    """Write gzip (and brotli, if available) variants of `data`."""
+
+    gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gzipped) < len(data):
+        with open(f"{path}.gz", 'wb') as f:
+            f.write(gzipped)
+
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            with open(f"{path}.br", 'wb') as f:
+                f.write(compressed)
@@ -0,0 +1,254 @@
+"""Quick checks for usernames and emails that are already taken.
+
+Each worker keeps a Bloom filter of every username and email (see
+`gunicorn.conf.py`). A value the filter hasn't seen is certainly free, so
+most checks of a free name don't touch the database; only possible hits
+(about 1% of free names, plus the taken ones) are confirmed with an
+indexed lookup. Signup and profile edits check before hashing a password,
+instead of finding out from an IntegrityError afterwards.
+
+Filters are built in bulk when a worker starts (or, without gunicorn, on
+the first check). New names are announced to every worker with events on
+USERS_TOPIC as users sign up or change them, and added to its filters by a
+background thread as they arrive. Names freed by deletes or renames stay
+in the filter (costing a database check) until it's rebuilt, which happens
+once it holds more names than it was sized for.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+
+from sqlalchemy import select
+
+from models import db, User
+
+logger = logging.getLogger('warbler.availability')
+
+USERS_TOPIC = 'users'
+
+FIELDS = ('username', 'email')
+
+
+class BloomFilter:
+    """Set membership with no false negatives and few false positives.
+
+    Sized for `capacity` items at a false positive rate of `error_rate`.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16)
+        digest = digest.digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value))
+
+
+def normalize(value):
+    """Key for a name in the filters.
+
+    Case-insensitive, so a filter hit is a superset of database matches.
+    """
+
+    return value.strip().lower()
+
+
+class TakenNames:
+    """Bloom filters of the usernames and emails of all users."""
+
+    def __init__(self, broker, error_rate=0.01, min_capacity=100_000,
+                 chunk_size=10_000):
+        self.broker = broker
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.chunk_size = chunk_size
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._app = None
+        self._subscription = None
+        self._filters = None
+        # Names seen since a rebuild started, which it may not include
+        self._pending = None
+
+    @property
+    def ready(self):
+        return self._filters is not None
+
+    def init_app(self, app):
+        """Start in each process the first time it checks a name."""
+
+        self._app = app
+
+    def start(self, app):
+        """Subscribe to new names and build the filters in the background.
+
+        Does nothing if already started in this process.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._app = app
+            self._filters = None
+            self._subscription = self.broker.subscribe(
+                [USERS_TOPIC], maxsize=None)
+
+        threading.Thread(
+            target=self._listen, args=(self._subscription,),
+            name='taken-names-events', daemon=True).start()
+
+        self.reload()
+
+    def _listen(self, subscription):
+        # Keeps the unbounded subscription drained, checks or not
+        while True:
+            event = subscription.get()
+
+            if event is None:
+                continue
+
+            try:
+                self._add(event)
+            except Exception:
+                logger.exception("Can't add announced names")
+
+    def reload(self):
+        """Start rebuilding the filters in a background thread."""
+
+        with self._lock:
+            if self._pending is not None:
+                return
+
+            self._pending = []
+
+        threading.Thread(
+            target=self._reload, name='taken-names', daemon=True).start()
+
+    def _reload(self):
+        try:
+            with self._app.app_context():
+                self.load()
+        except Exception:
+            logger.exception("Can't load taken names")
+
+            with self._lock:
+                self._pending = None
+
+    def load(self):
+        """Build the filters from the database in this thread."""
+
+        with self._lock:
+            if self._pending is None:
+                self._pending = []
+
+        count = User.query.count()
+        capacity = max(self.min_capacity, count * 2)
+        filters = {
+            field: BloomFilter(capacity, self.error_rate) for field in FIELDS}
+
+        rows = db.session.execute(
+            select(User.username, User.email)
+            .execution_options(yield_per=self.chunk_size))
+
+        for username, email in rows:
+            filters['username'].add(normalize(username))
+            filters['email'].add(normalize(email))
+
+        with self._lock:
+            self._filters = filters
+
+            for names in self._pending:
+                self._add_names(names)
+
+            self._pending = None
+
+        logger.info("Loaded %d users' names into filters", count)
+
+    def sync(self):
+        """Add names announced by other workers since the last call."""
+
+        if self._subscription is None:
+            return
+
+        while (event := self._subscription.get(0)) is not None:
+            self._add(event)
+
+    def _add(self, names):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(names)
+
+            if self._filters is None:
+                return
+
+            self._add_names(names)
+
+            full = any(
+                f.count > f.capacity for f in self._filters.values())
+
+        if full:
+            self.reload()
+
+    def _add_names(self, names):
+        for field in FIELDS:
+            if names.get(field):
+                self._filters[field].add(normalize(names[field]))
+
+    def add(self, username, email):
+        """Announce a new or changed username and email to every worker.
+
+        Call after the change is committed.
+        """
+
+        self.broker.publish(
+            USERS_TOPIC, {'username': username, 'email': email})
+
+    def is_taken(self, field, value, exclude_user_id=None):
+        """Is `value` the `field` ('username' or 'email') of any user?
+
+        Users with `exclude_user_id` don't count, so a user keeping their
+        own name isn't told it's taken.
+        """
+
+        if self._app is not None and self._pid != os.getpid():
+            self.start(self._app)
+
+        self.sync()
+
+        filters = self._filters
+
+        if filters is not None and normalize(value) not in filters[field]:
+            return False
+
+        query = select(User.id).where(getattr(User, field) == value)
+
+        if exclude_user_id is not None:
+            query = query.where(User.id != exclude_user_id)
+
+        return db.session.execute(query.limit(1)).first() is not None
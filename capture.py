@@ -0,0 +1,136 @@
+"""Capture request metadata for replaying production traffic.
+
+With CAPTURE_FILE set, each finished request (for a CAPTURE_SAMPLE
+fraction of users) is appended to that file as one line of JSON:
+
+    {"t":1718000000.123,"m":"GET","r":"/users/<int:user_id>",
+     "a":{"user_id":42},"q":{},"f":{},"u":7,"s":200,"d":12.4}
+
+`t` is when the request started (Unix time), `r` its URL rule and `a` its
+view arguments, `u` the logged-in user's id (after the request, so a login
+records who logged in), `s` the status and `d` the time taken in
+milliseconds, including any streamed body.
+
+Only metadata is kept. No headers, cookies, IP addresses or uploads; query
+parameters and form fields not in SAFE_PARAMS keep their names but only
+the length of their values, so passwords, warble text and searches are
+never written, and URLs in PATH_PARAMS lose their query strings.
+`replay.py` fills the values back in from the seed data.
+
+Each line is written with a single append, so every worker can share one
+file.
+"""
+
+import json
+import os
+import random
+import threading
+import zlib
+from urllib.parse import urlsplit
+
+# Parameters whose values are kept: ids, cursors and options, never text
+SAFE_PARAMS = {
+    'after', 'before', 'following', 'format', 'month', 'section', 'since',
+    'wait',
+}
+
+# URLs, of which only the path is kept (a query string could be a search)
+PATH_PARAMS = {'origin_url'}
+
+# Not user traffic
+SKIP_ENDPOINTS = {'static', 'show_metrics'}
+
+
+def sanitize(params):
+    """Dict of a MultiDict's values, with unsafe ones replaced by lengths.
+
+    Repeated parameters become lists.
+    """
+
+    sanitized = {}
+
+    for name, values in params.lists():
+        if name == 'csrf_token':
+            continue
+
+        if name in PATH_PARAMS:
+            values = [urlsplit(value).path for value in values]
+        elif name not in SAFE_PARAMS:
+            values = [len(value) for value in values]
+
+        sanitized[name] = values[0] if len(values) == 1 else values
+
+    return sanitized
+
+
+class RequestCapture:
+    """Appends sanitized request metadata to a file."""
+
+    def __init__(self, path=None, sample=1.0):
+        self.path = path
+        self.sample = sample
+
+        self._lock = threading.Lock()
+        self._fd = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def should_capture(self, user_id):
+        """Whether to capture a request; all or none of a user's."""
+
+        if self.sample >= 1:
+            return True
+
+        if user_id is None:
+            return random.random() < self.sample
+
+        return zlib.crc32(str(user_id).encode()) / 2**32 < self.sample
+
+    def record(self, request, user_id, status, started, seconds):
+        """Capture one finished request."""
+
+        if (request.url_rule is None
+                or request.endpoint in SKIP_ENDPOINTS
+                or not self.should_capture(user_id)):
+            return
+
+        entry = {
+            't': round(started, 3),
+            'm': request.method,
+            'r': request.url_rule.rule,
+            'a': request.view_args or {},
+            'q': sanitize(request.args),
+            'f': sanitize(request.form),
+            'u': user_id,
+            's': status,
+            'd': round(seconds * 1000, 1),
+        }
+
+        self.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def write(self, line):
+        if self._fd is None:
+            with self._lock:
+                if self._fd is None:
+                    self._fd = os.open(
+                        self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                        0o600)
+
+        os.write(self._fd, line.encode())
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def read(path):
+    """Captured requests from `path`, in the order they started."""
+
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    return sorted(entries, key=lambda entry: entry['t'])
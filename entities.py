@@ -0,0 +1,128 @@
+"""Hashtags and @mentions in message text.
+
+Tags and mentions are parsed once, when a message is written, into the
+`message_tags` and `mentions` tables. Both are keyed (tag or user, message
+id), so "newest messages with #tag" or "newest messages mentioning @user"
+is a range scan of the primary key instead of a scan of every message.
+When messages are sharded (see shards.py), a message's tags and mentions
+are kept on its shard.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+from sqlalchemy import delete, func, insert, select
+
+from models import db, shards, Message, MessageTag, Mention, User
+
+HASHTAG_RE = re.compile(r"(?<![\w#&])#(\w{1,50})")
+MENTION_RE = re.compile(r"(?<![\w@])@(\w{1,30})")
+
+
+def extract_tags(text):
+    """Distinct lower-cased hashtags in `text`, without the #."""
+
+    return sorted({tag.lower() for tag in HASHTAG_RE.findall(text)})
+
+
+def extract_mentions(text):
+    """Distinct lower-cased usernames @mentioned in `text`."""
+
+    return sorted({name.lower() for name in MENTION_RE.findall(text)})
+
+
+def index_messages(messages):
+    """Add tag and mention rows for `messages` (which must have ids).
+
+    Rows are written to the shard of each message when sharded.
+    """
+
+    rows = {}
+    names = {}
+
+    for message in messages:
+        shard = shards.for_message(message.id)
+        tags, mentions = rows.setdefault(shard, ([], []))
+        tags.extend(
+            {'tag': tag, 'message_id': message.id}
+            for tag in extract_tags(message.text))
+
+        for name in extract_mentions(message.text):
+            names.setdefault(name, []).append((shard, message.id))
+
+    if names:
+        users = db.session.execute(
+            select(func.lower(User.username), User.id)
+            .where(func.lower(User.username).in_(names))).all()
+
+        for name, user_id in users:
+            for shard, message_id in names[name]:
+                rows[shard][1].append(
+                    {'user_id': user_id, 'message_id': message_id})
+
+    for shard, (tags, mentions) in rows.items():
+        for model, values in ((MessageTag, tags), (Mention, mentions)):
+            # A Core insert: ORM bulk inserts ignore the shard's bind
+            if values:
+                db.session.execute(
+                    insert(model.__table__).execution_options(shard=shard),
+                    values)
+
+
+def backfill(batch_size=1000):
+    """Re-index tags and mentions of all messages, `batch_size` at a time.
+
+    Each batch is committed on its own, so the job can be stopped and
+    re-run; existing rows for a batch are replaced. Yields the number of
+    messages processed after each batch.
+    """
+
+    done = 0
+
+    for shard in shards.all():
+        last_id = 0
+
+        while True:
+            messages = (Message
+                        .query
+                        .filter(Message.id > last_id)
+                        .order_by(Message.id)
+                        .limit(batch_size)
+                        .execution_options(shard=shard)
+                        .all())
+
+            if not messages:
+                break
+
+            ids = [message.id for message in messages]
+
+            for model in (MessageTag, Mention):
+                db.session.execute(
+                    delete(model)
+                    .where(model.message_id.in_(ids))
+                    .execution_options(shard=shard))
+
+            index_messages(messages)
+            db.session.commit()
+
+            last_id = ids[-1]
+            done += len(ids)
+            yield done
+
+
+def linkify(text):
+    """Escape message text, linking hashtags and @mentions."""
+
+    def tag_link(match):
+        tag = match.group(1)
+        return Markup('<a href="/tags/{}">#{}</a>').format(tag.lower(), tag)
+
+    def mention_link(match):
+        name = match.group(1)
+        return Markup('<a href="/users?q={}">@{}</a>').format(name, name)
+
+    html = str(escape(text))
+    html = HASHTAG_RE.sub(tag_link, html)
+    html = MENTION_RE.sub(mention_link, html)
+
+    return Markup(html)
@@ -0,0 +1,357 @@
+"""Publish/subscribe for live timeline events.
+
+A `Broker` fans events out to `Subscription`s in this process. Each event
+is published on a topic (the id of the user who wrote the message) and
+delivered to every subscription that includes that topic, so a client
+streaming its home timeline subscribes to itself plus everyone it follows.
+
+Events travel between processes over a channel:
+
+- `LocalChannel` delivers straight to this process's broker. It's the
+  stand-in used by tests and single-process servers.
+- `PostgresChannel` sends events with NOTIFY and runs one LISTEN thread per
+  worker process, so an event published by any gunicorn worker reaches the
+  subscribers in all of them.
+- `SQLiteChannel` does the same for single-node deployments on SQLite,
+  through a table in a small database file that each worker polls.
+
+Waiting subscribers block on a condition variable, not a database
+connection, so an idle stream costs a small queue and the thread serving
+it: a gthread worker thread, or a greenlet on the gevent stream server
+(gunicorn_streams.conf.py), where threading is monkey-patched.
+"""
+
+import json
+import logging
+import os
+import selectors
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+
+import psycopg2
+from sqlalchemy import func
+from sqlalchemy import select as sql_select
+
+logger = logging.getLogger('warbler.events')
+
+
+class Subscription:
+    """Events for a set of topics, queued until the subscriber reads them.
+
+    At most `maxsize` events are kept; if the subscriber falls behind, the
+    oldest are dropped.
+    """
+
+    def __init__(self, broker, topics, maxsize=100):
+        self.broker = broker
+        self.topics = frozenset(topics)
+        self._events = deque(maxlen=maxsize)
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        """Queue `event` and wake the subscriber."""
+
+        with self._ready:
+            self._events.append(event)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrives in `timeout`."""
+
+        with self._ready:
+            if not self._events:
+                self._ready.wait(timeout)
+
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        """Stop receiving events."""
+
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Delivers published events to local subscriptions by topic."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+        channel.connect(self.deliver)
+
+    def subscribe(self, topics, maxsize=100):
+        """Return a Subscription to `topics`."""
+
+        self.channel.listen()
+
+        subscription = Subscription(self, topics, maxsize)
+
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscriptions[topic].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove `subscription` from all its topics."""
+
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscriptions.get(topic)
+
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[topic]
+
+    def subscriber_count(self):
+        """Number of open subscriptions in this process."""
+
+        with self._lock:
+            return len(set().union(*self._subscriptions.values()))
+
+    def publish(self, topic, event):
+        """Send `event` (a dict) to `topic`'s subscribers in all processes."""
+
+        self.channel.publish(topic, event)
+
+    def deliver(self, topic, event):
+        """Hand an event from the channel to this process's subscribers."""
+
+        with self._lock:
+            subscribers = list(self._subscriptions.get(topic, ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+
+class LocalChannel:
+    """Channel that only reaches the current process."""
+
+    def connect(self, deliver):
+        self.deliver = deliver
+
+    def listen(self):
+        pass
+
+    def publish(self, topic, event):
+        self.deliver(topic, event)
+
+
+class PostgresChannel:
+    """Channel over PostgreSQL LISTEN/NOTIFY.
+
+    Publishing runs `pg_notify()` on a pooled connection of `engine`. The
+    listener uses its own connection outside the pool, started on first
+    use in each process (so after gunicorn forks), and reconnects if the
+    connection is lost.
+    """
+
+    def __init__(self, engine, name='warbler_events', reconnect_delay=1):
+        self.engine = engine
+        self.name = name
+        self.reconnect_delay = reconnect_delay
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = threading.Event()
+        self.listening = threading.Event()
+
+    def connect(self, deliver):
+        self.deliver = deliver
+
+    def listen(self):
+        """Start the listener thread if it isn't running in this process."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._stopped = threading.Event()
+
+            threading.Thread(
+                target=self._run, args=(self._stopped,),
+                name='events-listener', daemon=True,
+            ).start()
+
+    def close(self):
+        """Stop the listener thread."""
+
+        self._stopped.set()
+
+        with self._lock:
+            self._pid = None
+
+    def publish(self, topic, event):
+        payload = json.dumps({'topic': topic, 'event': event})
+
+        with self.engine.connect() as conn:
+            conn.execute(sql_select(func.pg_notify(self.name, payload)))
+            conn.commit()
+
+    def _run(self, stopped):
+        """Deliver notifications until `stopped`, reconnecting on errors."""
+
+        url = self.engine.url.set(drivername='postgresql')
+
+        while not stopped.is_set():
+            try:
+                conn = psycopg2.connect(
+                    url.render_as_string(hide_password=False))
+            except psycopg2.Error:
+                logger.exception("Can't connect to listen for events")
+                time.sleep(self.reconnect_delay)
+                continue
+
+            try:
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN "{self.name}"')
+                self.listening.set()
+                self._receive(conn, stopped)
+            except psycopg2.Error:
+                logger.exception("Lost connection listening for events")
+                time.sleep(self.reconnect_delay)
+            finally:
+                self.listening.clear()
+                conn.close()
+
+    def _receive(self, conn, stopped):
+        """Wait for notifications on `conn` and deliver them."""
+
+        # Not select.select(): a worker holding many streams gives the
+        # connection a descriptor past its limit of 1024
+        with selectors.DefaultSelector() as selector:
+            selector.register(conn, selectors.EVENT_READ)
+
+            while not stopped.is_set():
+                if not selector.select(1):
+                    continue
+
+                conn.poll()
+
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    message = json.loads(notify.payload)
+                    self.deliver(message['topic'], message['event'])
+
+
+class SQLiteChannel:
+    """Channel over a table in a SQLite database (WAL mode) on local disk.
+
+    Publishing inserts a row. Each process runs a thread, started on first
+    use (so after gunicorn forks), that polls for rows newer than the last
+    it saw every `poll_interval` seconds. Rows older than `keep` seconds
+    are pruned.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payload TEXT NOT NULL,
+        created REAL NOT NULL
+    );
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, poll_interval=0.1, keep=60):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.keep = keep
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stopped = threading.Event()
+        self._published = 0
+        self.listening = threading.Event()
+
+    def connect(self, deliver):
+        self.deliver = deliver
+
+    def listen(self):
+        """Start the polling thread if it isn't running in this process."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._stopped = threading.Event()
+
+            threading.Thread(
+                target=self._run, args=(self._stopped,),
+                name='events-listener', daemon=True,
+            ).start()
+
+    def close(self):
+        """Stop the polling thread."""
+
+        self._stopped.set()
+
+        with self._lock:
+            self._pid = None
+
+    def publish(self, topic, event):
+        payload = json.dumps({'topic': topic, 'event': event})
+        now = time.time()
+        conn = self._connect()
+
+        conn.execute(
+            "INSERT INTO events (payload, created) VALUES (?, ?)",
+            (payload, now))
+
+        self._published += 1
+        if self._published % self.PRUNE_EVERY == 0:
+            conn.execute(
+                "DELETE FROM events WHERE created < ?", (now - self.keep,))
+
+    def _connect(self):
+        """Connection for this thread (reopened after a fork)."""
+
+        local = self._local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+
+            local.conn = conn
+            local.pid = os.getpid()
+
+        return local.conn
+
+    def _run(self, stopped):
+        """Deliver new rows until `stopped`, retrying on errors."""
+
+        last_id = None
+
+        while not stopped.is_set():
+            try:
+                conn = self._connect()
+
+                if last_id is None:
+                    last_id = conn.execute(
+                        "SELECT coalesce(max(id), 0) FROM events"
+                    ).fetchone()[0]
+
+                self.listening.set()
+
+                while not stopped.wait(self.poll_interval):
+                    rows = conn.execute(
+                        "SELECT id, payload FROM events WHERE id > ? "
+                        "ORDER BY id", (last_id,)).fetchall()
+
+                    for last_id, payload in rows:
+                        message = json.loads(payload)
+                        self.deliver(message['topic'], message['event'])
+            except sqlite3.Error:
+                logger.exception("Error polling for events")
+                stopped.wait(1)
+            finally:
+                self.listening.clear()
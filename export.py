@@ -0,0 +1,314 @@
+"""Stream a user's data as NDJSON or CSV.
+
+An export is a series of sections (see SECTIONS), each a list of records
+ordered by its first column; archived messages are ordered by month, then
+id, as they're stored a month at a time. Rows are read through server-side
+cursors (`yield_per`) and written out as they arrive, so memory use doesn't
+grow with the size of the account.
+
+Exports can be resumed: `after="likes:1234"` skips everything up to and
+including the like of message 1234 and carries on from there; archived
+messages are resumed by month and id, as in
+`after="archived_messages:2015-03:1234"`. In NDJSON each record has a
+`cursor` field with the value to resume after it.
+"""
+
+import csv
+import io
+import json
+import re
+import zlib
+from datetime import date
+
+from sqlalchemy import select
+
+from archive import unpack
+from models import db, shards, Follow, Like, Message, MessageArchive, User
+
+SECTIONS = (
+    'profile', 'messages', 'archived_messages', 'likes', 'following',
+    'followers',
+)
+
+COLUMNS = {
+    'profile': ['id', 'username', 'email', 'bio', 'location', 'image_url',
+                'header_image_url'],
+    'messages': ['id', 'timestamp', 'text'],
+    'archived_messages': ['id', 'timestamp', 'text', 'likes'],
+    'likes': ['message_id', 'user_id', 'timestamp', 'text'],
+    'following': ['user_id', 'username'],
+    'followers': ['user_id', 'username'],
+}
+
+FORMATS = ('ndjson', 'csv')
+
+ARCHIVE_KEY_RE = re.compile(r'(\d{4})-(\d{2}):(\d+)')
+
+# Rows fetched per round trip, and bytes buffered before each chunk is sent
+YIELD_PER = 500
+CHUNK_SIZE = 64 * 1024
+
+
+class InvalidExport(ValueError):
+    """Unknown format, section or resume cursor."""
+
+
+def parse_cursor(cursor):
+    """Split a "section:key" resume cursor into (section, key).
+
+    The key is an int, or a (month, id) pair for archived messages.
+    """
+
+    section, _, key = cursor.partition(':')
+
+    if section == 'archived_messages':
+        match = ARCHIVE_KEY_RE.fullmatch(key)
+
+        if match and 1 <= int(match[2]) <= 12:
+            return section, (
+                date(int(match[1]), int(match[2]), 1), int(match[3]))
+
+    elif section in SECTIONS and key.isdigit():
+        return section, int(key)
+
+    raise InvalidExport(f"Invalid cursor: {cursor}")
+
+
+def format_cursor(section, row):
+    """Resume cursor for the record `row` of `section`."""
+
+    if section == 'archived_messages':
+        return f"{section}:{row['timestamp']:%Y-%m}:{row['id']}"
+
+    return f"{section}:{row[COLUMNS[section][0]]}"
+
+
+def get_rows(user_id, section, after=None):
+    """Yield dicts of `section` for a user, keyed after `after` if given."""
+
+    if section == 'archived_messages':
+        yield from get_archived_rows(user_id, after)
+        return
+
+    if section == 'likes' and shards.enabled:
+        yield from get_sharded_like_rows(user_id, after)
+        return
+
+    shard = None
+
+    if section == 'profile':
+        key = User.id
+        stmt = select(*(getattr(User, c) for c in COLUMNS['profile'])).where(
+            User.id == user_id)
+
+    elif section == 'messages':
+        key = Message.id
+        stmt = (select(Message.id, Message.timestamp, Message.text)
+                .where(Message.user_id == user_id))
+        shard = shards.for_user(user_id)
+
+    elif section == 'likes':
+        key = Like.message_id
+        stmt = (select(Like.message_id, Message.user_id, Message.timestamp,
+                       Message.text)
+                .join(Message, Message.id == Like.message_id)
+                .where(Like.user_id == user_id))
+
+    elif section == 'following':
+        key = Follow.user_being_followed_id
+        stmt = (select(key.label('user_id'), User.username)
+                .join(User, User.id == key)
+                .where(Follow.user_following_id == user_id))
+
+    elif section == 'followers':
+        key = Follow.user_following_id
+        stmt = (select(key.label('user_id'), User.username)
+                .join(User, User.id == key)
+                .where(Follow.user_being_followed_id == user_id))
+
+    if after is not None:
+        stmt = stmt.where(key > after)
+
+    rows = db.session.execute(
+        stmt.order_by(key)
+        .execution_options(yield_per=YIELD_PER, shard=shard))
+
+    for row in rows:
+        yield row._asdict()
+
+
+def get_sharded_like_rows(user_id, after=None):
+    """Yield a user's likes when messages are sharded.
+
+    Likes are on the user's shard and the messages on their authors', so
+    each batch of likes is joined to its messages in Python.
+    """
+
+    while True:
+        stmt = select(Like.message_id).where(Like.user_id == user_id)
+
+        if after is not None:
+            stmt = stmt.where(Like.message_id > after)
+
+        message_ids = db.session.execute(
+            stmt
+            .order_by(Like.message_id)
+            .limit(YIELD_PER)
+            .execution_options(shard=shards.for_user(user_id))
+        ).scalars().all()
+
+        if not message_ids:
+            return
+
+        stmts = {
+            shard: select(Message.id.label('message_id'), Message.user_id,
+                          Message.timestamp, Message.text)
+            .where(Message.id.in_(ids))
+            for shard, ids in shards.group_by_message(message_ids).items()}
+
+        rows = sorted(shards.scatter(stmts), key=lambda row: row[0])
+
+        for row in rows:
+            yield row._asdict()
+
+        after = message_ids[-1]
+
+
+def get_archived_rows(user_id, after=None):
+    """Yield a user's archived messages, decompressing a month at a time.
+
+    Messages are in (month, id) order, and `after` is a (month, id) pair.
+    """
+
+    stmt = select(MessageArchive.month, MessageArchive.data).where(
+        MessageArchive.user_id == user_id)
+
+    if after is not None:
+        stmt = stmt.where(MessageArchive.month >= after[0])
+
+    months = db.session.execute(
+        stmt
+        .order_by(MessageArchive.month)
+        .execution_options(yield_per=1))
+
+    for month, data in months:
+        for message in sorted(unpack(data)):
+            if after is None or (month, message.id) > after:
+                yield message._asdict()
+
+
+def generate(user_id, fmt='ndjson', sections=SECTIONS, after=None):
+    """Return an iterator over the lines of an export.
+
+    CSV exports must be of a single section (they have one header row).
+    Raises InvalidExport straight away, before anything is streamed.
+    """
+
+    if fmt not in FORMATS:
+        raise InvalidExport(f"Unknown format: {fmt}")
+
+    if fmt == 'csv' and len(sections) != 1:
+        raise InvalidExport("CSV exports need exactly one section")
+
+    for section in sections:
+        if section not in SECTIONS:
+            raise InvalidExport(f"Unknown section: {section}")
+
+    if after:
+        after_section, after_key = parse_cursor(after)
+    else:
+        after_section = after_key = None
+
+    return generate_lines(user_id, fmt, sections, after_section, after_key)
+
+
+def generate_lines(user_id, fmt, sections, after_section, after_key):
+    """Yield lines of a validated export."""
+
+    for section in SECTIONS:
+        if section not in sections:
+            continue
+
+        if after_section:
+            if SECTIONS.index(section) < SECTIONS.index(after_section):
+                continue
+            if section != after_section:
+                after_key = None
+
+        rows = get_rows(user_id, section, after_key)
+
+        if fmt == 'csv':
+            yield from to_csv(COLUMNS[section], rows)
+        else:
+            yield from to_ndjson(section, rows)
+
+
+def to_ndjson(section, rows):
+    """Yield one JSON line per row, with its section and resume cursor."""
+
+    for row in rows:
+        record = {
+            'section': section,
+            'cursor': format_cursor(section, row),
+            **row,
+        }
+        yield json.dumps(record, default=format_value) + '\n'
+
+
+def to_csv(columns, rows):
+    """Yield a header line, then one CSV line per row."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(columns)
+
+    for row in rows:
+        yield line(format_value(row[c]) for c in columns)
+
+
+def format_value(value):
+    """Dates as ISO 8601; everything else unchanged."""
+
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+
+    return value
+
+
+def encode(lines, gzip=False):
+    """Yield `lines` as UTF-8 bytes in chunks of about CHUNK_SIZE.
+
+    With `gzip`, the chunks are compressed as they're produced.
+    """
+
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+    buffer = []
+    size = 0
+
+    for text in lines:
+        data = text.encode('utf-8')
+
+        if compressor:
+            data = compressor.compress(data)
+
+        buffer.append(data)
+        size += len(data)
+
+        if size >= CHUNK_SIZE:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+
+    if compressor:
+        buffer.append(compressor.flush())
+
+    if buffer:
+        yield b''.join(buffer)
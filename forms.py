@@ -1,6 +1,25 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import InputRequired, Email, Length, URL, Optional
+from flask_wtf.file import FileField, FileAllowed
+from wtforms import (
+    StringField, PasswordField, TextAreaField, BooleanField, FloatField,
+)
+from wtforms.validators import (
+    InputRequired, Email, Length, URL, Optional, NumberRange,
+)
+
+from images import UPLOAD_URL_PREFIX
+
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
+
+class ImageURL(URL):
+    """URL validator that also accepts paths of locally uploaded images."""
+
+    def __call__(self, form, field):
+        if field.data and field.data.startswith(UPLOAD_URL_PREFIX):
+            return
+
+        super().__call__(form, field)
 
 
 class MessageForm(FlaskForm):
@@ -29,7 +48,12 @@ class UserAddForm(FlaskForm):
 
     image_url = StringField(
         '(Optional) Image URL',
-        validators=[Optional(), URL(), Length(max=255)]
+        validators=[Optional(), ImageURL(), Length(max=255)]
+    )
+
+    image_file = FileField(
+        '(Optional) Upload Image',
+        validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')]
     )
 
 
@@ -38,7 +62,12 @@ class UserEditForm(UserAddForm):
 
     header_image_url = StringField(
         '(Optional) Header Image URL',
-        validators=[Optional(), URL(), Length(max=255)]
+        validators=[Optional(), ImageURL(), Length(max=255)]
+    )
+
+    header_image_file = FileField(
+        '(Optional) Upload Header Image',
+        validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')]
     )
 
     bio = TextAreaField(
@@ -68,3 +97,19 @@ class LoginForm(FlaskForm):
 
 class CSRFProtectForm(FlaskForm):
     """ Form for CSRF protection """
+
+
+class ProfilerForm(FlaskForm):
+    """Form for turning the request profiler on and off."""
+
+    enabled = BooleanField('Enabled')
+
+    sample_rate = FloatField(
+        'Sample rate',
+        validators=[InputRequired(), NumberRange(min=0, max=1)]
+    )
+
+    endpoint = StringField(
+        '(Optional) Only set rate for endpoint',
+        validators=[Optional()]
+    )
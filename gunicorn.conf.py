@@ -0,0 +1,72 @@
+"""Gunicorn settings for Warbler.
+
+    gunicorn app:app
+
+Timeline streams can run on a separate server instead; see
+gunicorn_streams.conf.py.
+
+Workers share metrics through files in PROMETHEUS_MULTIPROC_DIR, which has
+to be set before the app (and prometheus_client) is imported.
+"""
+
+import os
+import shutil
+import tempfile
+
+# Timeline streams and long-polls park a thread each while they wait (but
+# no database connection), so workers run many cheap threads. At most
+# three quarters of them wait at once, so pages still get a thread.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 256))
+os.environ.setdefault('MAX_STREAMS', str(threads * 3 // 4))
+
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'warbler-metrics'))
+
+
+def on_starting(server):
+    """Start with empty metrics."""
+
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    """Stop reporting live gauges for a worker that has exited."""
+
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    """Load the in-memory follow graph and taken-name filters, and start
+    flushing trending counts and applying suggestion updates.
+
+    See follow_graph.py, availability.py, trending.py and suggestions.py.
+    """
+
+    from app import (
+        app, follow_graph, suggestion_updater, taken_names, trending_counter)
+
+    if app.config['TAKEN_NAMES']:
+        taken_names.start(app)
+
+    if app.config['TRENDING_FLUSH']:
+        trending_counter.start(app)
+
+    if app.config['SUGGESTION_UPDATES']:
+        suggestion_updater.start(app)
+
+    if app.config['FOLLOW_GRAPH']:
+        follow_graph.start(app)
+
+
+def worker_exit(server, worker):
+    """Flush the worker's last trending counts."""
+
+    from app import app, trending_counter
+
+    with app.app_context():
+        trending_counter.flush()
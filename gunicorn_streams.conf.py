@@ -0,0 +1,72 @@
+"""Gunicorn settings for a server that only holds timeline streams.
+
+    gunicorn -c gunicorn_streams.conf.py --bind 127.0.0.1:8001 app:app
+
+Have the proxy send /api/timeline/stream and /api/timeline/new here, and
+everything else to the main server (gunicorn.conf.py). Its gevent workers
+park each waiting client in a greenlet instead of a thread, so a worker
+holds thousands of them, and they never take a thread from a page.
+
+Its metrics are kept apart from the main server's, in
+STREAM_METRICS_DIR: scrape both servers' /metrics.
+"""
+
+import os
+import shutil
+import tempfile
+
+worker_class = 'gevent'
+worker_connections = int(
+    os.environ.get('GUNICORN_STREAM_CONNECTIONS', 10000))
+# Leave a few connections for /metrics and the like
+os.environ.setdefault('MAX_STREAMS', str(worker_connections * 9 // 10))
+
+metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR'] = os.environ.get(
+    'STREAM_METRICS_DIR',
+    os.path.join(tempfile.gettempdir(), 'warbler-stream-metrics'))
+
+
+def on_starting(server):
+    """Start with empty metrics."""
+
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    """Stop reporting live gauges for a worker that has exited."""
+
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    """Make psycopg2 wait for the database in a greenlet, not the worker.
+
+    Opening a stream still queries the feed; without this, each query
+    would stop every other stream in the worker until it returned.
+    """
+
+    import psycopg2.extensions
+
+    psycopg2.extensions.set_wait_callback(wait_green)
+
+
+def wait_green(conn, timeout=None):
+    """psycopg2 wait callback that yields to other greenlets."""
+
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+
+    while True:
+        state = conn.poll()
+
+        if state == extensions.POLL_OK:
+            return
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise OperationalError(f"Bad result from poll: {state!r}")
@@ -0,0 +1,169 @@
+"""Local storage for uploaded profile and header images.
+
+Originals are stored under UPLOAD_FOLDER with a content-addressed name, and
+fixed-size variants are generated in a background thread:
+
+    uploads/avatars/<digest>.png          original
+    uploads/avatars/<digest>-thumb.jpg    variant
+
+Templates ask for a variant with the `variant` filter; until the variant has
+been written (or for external URLs) the original URL is used. A variant
+that can't be generated is logged to `warbler.images`.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from io import BytesIO
+
+from flask import current_app
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from metrics import CACHE_REQUESTS
+
+logger = logging.getLogger('warbler.images')
+
+UPLOAD_URL_PREFIX = '/uploads/'
+
+# variant name -> (width, height) for each kind of upload
+VARIANT_SIZES = {
+    'avatars': {
+        'thumb': (256, 256),
+    },
+    'headers': {
+        'thumb': (600, 200),
+        'header': (1500, 500),
+    },
+}
+
+ALLOWED_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='variants')
+
+
+class InvalidImage(ValueError):
+    """Uploaded file isn't an image we can store."""
+
+
+def get_upload_folder():
+    """Return folder uploads are stored in for the current app."""
+
+    return current_app.config['UPLOAD_FOLDER']
+
+
+def save_upload(file, kind):
+    """Store uploaded `file` as an image of `kind` ('avatars' or 'headers').
+
+    Writes the original, schedules generation of its variants and returns
+    the URL of the original. Raises InvalidImage if the file isn't an image,
+    or has more than Image.MAX_IMAGE_PIXELS pixels.
+    """
+
+    data = file.read()
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            ext = ALLOWED_FORMATS[img.format]
+            img.verify()
+    except (UnidentifiedImageError, KeyError, OSError,
+            Image.DecompressionBombError) as e:
+        raise InvalidImage("Unsupported image file") from e
+
+    # Pillow only refuses images over twice the limit; decoding one under
+    # that to make its variants would still take too much memory
+    if img.width * img.height > Image.MAX_IMAGE_PIXELS:
+        raise InvalidImage("Image too large")
+
+    filename = f"{sha256(data).hexdigest()[:32]}.{ext}"
+    folder = os.path.join(get_upload_folder(), kind)
+    path = os.path.join(folder, filename)
+
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        _write_atomic(path, data)
+
+    executor.submit(generate_variants, path, kind).add_done_callback(
+        _log_failure)
+
+    return f"{UPLOAD_URL_PREFIX}{kind}/{filename}"
+
+
+def generate_variants(path, kind):
+    """Write every variant of the original image at `path`.
+
+    Variants are JPEGs cropped to a fixed size; existing variants are kept.
+    """
+
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+
+        for name, size in VARIANT_SIZES[kind].items():
+            variant_path = _variant_path(path, name)
+
+            if os.path.exists(variant_path):
+                continue
+
+            resized = ImageOps.fit(img, size, Image.LANCZOS)
+            tmp_path = _tmp_path(variant_path)
+            resized.save(
+                tmp_path, 'JPEG', quality=85, optimize=True, progressive=True)
+            os.replace(tmp_path, variant_path)
+
+
+def variant_url(url, variant):
+    """Return URL of `variant` of image at `url` if it has been generated.
+
+    External URLs, and uploads whose variants aren't ready yet, are returned
+    unchanged.
+    """
+
+    if not url or not url.startswith(UPLOAD_URL_PREFIX):
+        return url
+
+    relative = url[len(UPLOAD_URL_PREFIX):]
+    kind = relative.split('/', 1)[0]
+
+    if variant not in VARIANT_SIZES.get(kind, {}):
+        return url
+
+    path = _variant_path(os.path.join(get_upload_folder(), relative), variant)
+
+    if os.path.exists(path):
+        CACHE_REQUESTS.labels('image_variant', 'hit').inc()
+        return _variant_path(url, variant)
+
+    CACHE_REQUESTS.labels('image_variant', 'miss').inc()
+    return url
+
+
+def _variant_path(path, variant):
+    """Path (or URL) of `variant` for the original at `path`."""
+
+    base, _ext = os.path.splitext(path)
+    return f"{base}-{variant}.jpg"
+
+
+def _tmp_path(path):
+    """Temporary file name for `path`, unique to this process and thread."""
+
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+
+def _log_failure(future):
+    """Log the error of a generate_variants job that raised."""
+
+    try:
+        future.result()
+    except Exception:
+        logger.exception("Can't generate image variants")
+
+
+def _write_atomic(path, data):
+    """Write `data` to `path` so readers never see a partial file."""
+
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
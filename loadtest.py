@@ -0,0 +1,519 @@
+"""Load generator: scripted virtual users against a running Warbler.
+
+    python loadtest.py --url http://127.0.0.1:5000
+    python loadtest.py --workers 1,2,4
+
+Each virtual user logs in as a seeded user (password "password"; run
+`python seed.py` first) and then loops: scrolling and polling the home
+timeline, viewing profiles and messages, liking, following and posting.
+How often each happens, who logs in and whose profiles get visited come
+from the seed CSVs in generator/ (see `derive_mix`).
+
+Users are added in steps; each step runs for `--duration` seconds and
+reports throughput and p50/p95/p99 latency per route. The saturation
+point is the last step that still raised throughput by `--min-gain`
+without too many errors. With `--workers`, a gunicorn is started for each
+worker count in turn (rate limits off) and swept the same way.
+"""
+
+import csv
+import http.client
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+import click
+
+SEED_DIR = os.path.join(os.path.dirname(__file__), 'generator')
+SEED_PASSWORD = 'password'
+
+# The seed has no likes or page views, so these are assumptions: likes
+# given per posted message, and page loads per write of any kind.
+LIKES_PER_MESSAGE = 3
+READS_PER_WRITE = 10
+
+# How page loads split between the read actions
+READ_SHARES = {
+    'timeline': 0.45,
+    'poll': 0.2,
+    'profile': 0.2,
+    'message': 0.15,
+}
+
+# Seconds to wait for a step's users to log in before measuring
+LOGIN_TIMEOUT = 120
+
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+MESSAGE_ID_RE = re.compile(r'href="/messages/(\d+)"')
+
+Mix = namedtuple('Mix', ['actions', 'logins', 'targets'])
+Step = namedtuple('Step', ['users', 'duration', 'routes', 'logins'])
+Route = namedtuple('Route', ['count', 'errors', 'p50', 'p95', 'p99'])
+
+
+##############################################################################
+# Behaviour mix
+
+def derive_mix(seed_dir=SEED_DIR):
+    """Action weights and who does what, from the seed CSVs.
+
+    - Writes split as the seed does: one post per seeded message, one
+      follow per seeded follow, LIKES_PER_MESSAGE likes per message.
+    - Reads are READS_PER_WRITE times all writes, split by READ_SHARES.
+    - Users log in in proportion to how much they post and follow, and
+      profiles are viewed and followed in proportion to follower counts.
+
+    Seeded user ids follow the order of users.csv, starting at 1.
+    """
+
+    with open(os.path.join(seed_dir, 'users.csv')) as f:
+        usernames = [row['username'] for row in csv.DictReader(f)]
+
+    with open(os.path.join(seed_dir, 'messages.csv')) as f:
+        authors = [int(row['user_id']) for row in csv.DictReader(f)]
+
+    with open(os.path.join(seed_dir, 'follows.csv')) as f:
+        follows = [
+            (int(row['user_following_id']), int(row['user_being_followed_id']))
+            for row in csv.DictReader(f)]
+
+    activity = dict.fromkeys(range(1, len(usernames) + 1), 1)
+    followers = dict.fromkeys(range(1, len(usernames) + 1), 1)
+
+    for user_id in authors:
+        activity[user_id] += 1
+
+    for follower_id, followed_id in follows:
+        activity[follower_id] += 1
+        followers[followed_id] += 1
+
+    writes = {
+        'post': len(authors),
+        'follow': len(follows),
+        'like': len(authors) * LIKES_PER_MESSAGE,
+    }
+    reads = sum(writes.values()) * READS_PER_WRITE
+
+    actions = {name: reads * share for name, share in READ_SHARES.items()}
+    actions.update(writes)
+    total = sum(actions.values())
+
+    return Mix(
+        actions={name: weight / total for name, weight in actions.items()},
+        logins=[
+            (usernames[id - 1], weight) for id, weight in activity.items()],
+        targets=list(followers.items()))
+
+
+def choose(rng, weighted):
+    """Pick a key from (key, weight) pairs."""
+
+    keys, weights = zip(*weighted)
+    return rng.choices(keys, weights)[0]
+
+
+##############################################################################
+# Virtual users
+
+class Recorder:
+    """Latencies and errors per route, shared by a step's virtual users."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def routes(self):
+        """Dict of route: Route, latencies in milliseconds."""
+
+        with self.lock:
+            return {
+                route: Route(
+                    len(latencies),
+                    self.errors.get(route, 0),
+                    *(percentile(latencies, p) * 1000 for p in (50, 95, 99)))
+                for route, latencies in sorted(self.latencies.items())}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of `values`."""
+
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def parse_csrf_token(html):
+    match = CSRF_RE.search(html)
+    return match and match.group(1)
+
+
+class VirtualUser:
+    """One logged-in browser session, on its own keep-alive connection."""
+
+    def __init__(self, url, mix, recorder, rng, think=0):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.mix = mix
+        self.recorder = recorder
+        self.rng = rng
+        self.think = think
+
+        self.conn = None
+        self.cookies = SimpleCookie()
+        self.csrf_token = None
+        self.user_id = None
+        self.message_ids = []
+        self.latest_id = 0
+        self.following = set()
+
+    def request(self, method, path, route, form=None, expect=None):
+        """Make a request, timing it under `route`. Returns (status, body).
+
+        It counts as an error if the status isn't in `expect`, or by
+        default if it's 400 or above.
+        """
+
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=30)
+
+        headers = {}
+        body = None
+
+        if self.cookies:
+            headers['Cookie'] = '; '.join(
+                f"{name}={morsel.value}"
+                for name, morsel in self.cookies.items())
+
+        if form is not None:
+            if self.csrf_token:
+                form = {'csrf_token': self.csrf_token, **form}
+
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = time.perf_counter()
+
+        try:
+            self.conn.request(method, path, body, headers)
+            resp = self.conn.getresponse()
+            text = resp.read().decode()
+        except (OSError, http.client.HTTPException):
+            self.recorder.record(route, time.perf_counter() - start, False)
+            self.conn.close()
+            self.conn = None
+            return None, ''
+
+        self.recorder.record(
+            route, time.perf_counter() - start,
+            resp.status in expect if expect else resp.status < 400)
+
+        for header in resp.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(header)
+
+        return resp.status, text
+
+    def login(self):
+        username = choose(self.rng, self.mix.logins)
+
+        status, html = self.request('GET', '/login', 'GET /login')
+        self.csrf_token = parse_csrf_token(html)
+
+        status, html = self.request('POST', '/login', 'POST /login', {
+            'username': username, 'password': SEED_PASSWORD}, expect=[302])
+
+        if status != 302:
+            return False
+
+        status, html = self.request('GET', '/', 'GET /')
+        match = re.search(r'href="/users/(\d+)"', html)
+        self.user_id = match and int(match.group(1))
+        self.read_timeline(html)
+
+        return True
+
+    def read_timeline(self, html):
+        ids = [int(id) for id in MESSAGE_ID_RE.findall(html)]
+
+        if ids:
+            self.message_ids = ids
+            self.latest_id = max(self.latest_id, max(ids))
+
+    def run(self, stop, ready, logins):
+        """Log in, wait at `ready` for the others, then act until `stop`.
+
+        Logging in is recorded in `logins` instead, outside the measured
+        window.
+        """
+
+        recorder, self.recorder = self.recorder, logins
+
+        try:
+            while not stop.is_set() and not self.login():
+                stop.wait(1)
+
+            self.recorder = recorder
+
+            try:
+                ready.wait()
+            except threading.BrokenBarrierError:
+                pass
+
+            while not stop.is_set():
+                action = choose(self.rng, self.mix.actions.items())
+                getattr(self, f"do_{action}")()
+
+                if self.think:
+                    stop.wait(self.rng.expovariate(1 / self.think))
+        finally:
+            if self.conn:
+                self.conn.close()
+
+    def do_timeline(self):
+        status, html = self.request('GET', '/', 'GET /')
+        self.read_timeline(html)
+
+    def do_poll(self):
+        self.request(
+            'GET', f'/api/timeline/new?since={self.latest_id}',
+            'GET /api/timeline/new')
+
+    def do_profile(self):
+        user_id = choose(self.rng, self.mix.targets)
+        self.request('GET', f'/users/{user_id}', 'GET /users/<id>')
+
+    def do_message(self):
+        if self.message_ids:
+            message_id = self.rng.choice(self.message_ids)
+            self.request(
+                'GET', f'/messages/{message_id}', 'GET /messages/<id>')
+
+    def do_like(self):
+        if self.message_ids:
+            message_id = self.rng.choice(self.message_ids)
+            self.request(
+                'POST', f'/messages/{message_id}/like-toggle',
+                'POST /messages/<id>/like-toggle',
+                {'origin_url': '/'})
+
+    def do_follow(self):
+        user_id = choose(self.rng, self.mix.targets)
+
+        if user_id == self.user_id:
+            return
+
+        if user_id in self.following:
+            self.following.discard(user_id)
+            self.request(
+                'POST', f'/users/stop-following/{user_id}',
+                'POST /users/stop-following/<id>', {})
+        else:
+            self.following.add(user_id)
+            self.request(
+                'POST', f'/users/follow/{user_id}',
+                'POST /users/follow/<id>', {})
+
+    def do_post(self):
+        text = f"Load test warble {self.rng.getrandbits(32):08x}"
+        self.request(
+            'POST', '/messages/new', 'POST /messages/new', {'text': text})
+
+
+##############################################################################
+# Ramping and sweeping
+
+def run_step(url, users, duration, mix, think=0, seed=None):
+    """Run `users` virtual users for `duration` seconds."""
+
+    recorder = Recorder()
+    logins = Recorder()
+    stop = threading.Event()
+    ready = threading.Barrier(users + 1)
+    rng = random.Random(seed)
+
+    threads = [
+        threading.Thread(
+            target=VirtualUser(
+                url, mix, recorder, random.Random(rng.random()), think).run,
+            args=(stop, ready, logins), daemon=True)
+        for i in range(users)]
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        ready.wait(LOGIN_TIMEOUT)
+    except threading.BrokenBarrierError:
+        # Go ahead with the users who have logged in
+        pass
+
+    start = time.monotonic()
+    stop.wait(duration)
+    stop.set()
+
+    for thread in threads:
+        thread.join()
+
+    return Step(
+        users, time.monotonic() - start, recorder.routes(), logins.routes())
+
+
+def throughput(step):
+    return sum(route.count for route in step.routes.values()) / step.duration
+
+
+def error_rate(step):
+    count = sum(route.count for route in step.routes.values())
+    errors = sum(route.errors for route in step.routes.values())
+
+    return errors / count if count else 1
+
+
+def find_saturation(steps, min_gain=0.05, max_error_rate=0.01):
+    """The step after which more users stopped helping.
+
+    That's the last step before one that raised throughput by less than
+    `min_gain`, or had more than `max_error_rate` of requests fail.
+    """
+
+    for prev, step in zip(steps, steps[1:]):
+        if (error_rate(step) > max_error_rate
+                or throughput(step) < throughput(prev) * (1 + min_gain)):
+            return prev
+
+    return steps[-1]
+
+
+def print_step(step):
+    click.echo(
+        f"\n{step.users} users: {throughput(step):.1f} req/s, "
+        f"{error_rate(step):.2%} errors")
+    click.echo(
+        f"  {'route':<36}{'req/s':>8}{'errors':>8}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+
+    for name, route in step.routes.items():
+        click.echo(
+            f"  {name:<36}{route.count / step.duration:>8.1f}"
+            f"{route.errors:>8}{route.p50:>9.1f}{route.p95:>9.1f}"
+            f"{route.p99:>9.1f}")
+
+    # Before the measured window, so no rate
+    for name, route in step.logins.items():
+        click.echo(
+            f"  {name + ' (login)':<36}{'-':>8}"
+            f"{route.errors:>8}{route.p50:>9.1f}{route.p95:>9.1f}"
+            f"{route.p99:>9.1f}")
+
+
+def ramp(url, users, duration, mix, think, min_gain):
+    """Run each step of `users`, stopping once throughput saturates."""
+
+    steps = []
+
+    for count in users:
+        steps.append(run_step(url, count, duration, mix, think))
+        print_step(steps[-1])
+
+        if find_saturation(steps, min_gain) is not steps[-1]:
+            break
+
+    return find_saturation(steps, min_gain)
+
+
+def start_gunicorn(workers, port):
+    """Start `gunicorn app:app` with `workers` workers and wait for it."""
+
+    env = {**os.environ, 'RATELIMIT_ENABLED': '0'}
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '-w', str(workers), '-b', f'127.0.0.1:{port}', 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+    deadline = time.monotonic() + 60
+
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise click.ClickException("gunicorn exited on startup")
+
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            conn.close()
+            return server
+        except OSError:
+            time.sleep(0.5)
+
+    server.terminate()
+    raise click.ClickException("gunicorn didn't start within 60 seconds")
+
+
+def parse_counts(value):
+    return [int(count) for count in value.split(',')]
+
+
+@click.command()
+@click.option('--url', default='http://127.0.0.1:5000',
+              help="Running Warbler to load (without --workers).")
+@click.option('--workers', type=parse_counts,
+              help="Gunicorn worker counts to sweep, e.g. 1,2,4.")
+@click.option('--port', default=8765, help="Port for gunicorn (--workers).")
+@click.option('--users', type=parse_counts, default='1,2,4,8,16,32,64,128',
+              help="Virtual users in each step.")
+@click.option('--duration', default=30.0, help="Seconds per step.")
+@click.option('--think', default=0.0,
+              help="Mean pause between a user's actions, in seconds.")
+@click.option('--min-gain', default=0.05,
+              help="Throughput gain a step needs to not count as saturated.")
+def main(url, workers, port, users, duration, think, min_gain):
+    """Find how many requests per second Warbler serves."""
+
+    mix = derive_mix()
+
+    click.echo("Action mix: " + ", ".join(
+        f"{name} {weight:.1%}" for name, weight in mix.actions.items()))
+
+    if not workers:
+        best = ramp(url, users, duration, mix, think, min_gain)
+        click.echo(
+            f"\nSaturated at {best.users} users, {throughput(best):.1f} req/s")
+        return
+
+    results = []
+
+    for count in workers:
+        click.echo(f"\n=== {count} gunicorn workers ===")
+        server = start_gunicorn(count, port)
+
+        try:
+            results.append((count, ramp(
+                f'http://127.0.0.1:{port}', users, duration, mix, think,
+                min_gain)))
+        finally:
+            server.terminate()
+            server.wait()
+
+    click.echo("\nworkers  users   req/s")
+
+    for count, best in results:
+        click.echo(f"{count:>7}{best.users:>7}{throughput(best):>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Runtime metrics in Prometheus text format.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR before the app is imported
+(gunicorn.conf.py does this) and every worker writes its values to files in
+that directory; a scrape of any worker then reports totals for all of them.
+Without it, metrics cover only the current process.
+"""
+
+import os
+import time
+
+from flask import has_request_context, request
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = CollectorRegistry()
+
+REQUEST_LATENCY = Histogram(
+    'warbler_request_duration_seconds',
+    'Time spent handling a request, including any streamed body.',
+    ['endpoint', 'method'],
+    registry=REGISTRY,
+)
+
+REQUEST_COUNT = Counter(
+    'warbler_requests_total',
+    'Requests handled, by response status.',
+    ['endpoint', 'method', 'status'],
+    registry=REGISTRY,
+)
+
+SQL_STATEMENTS = Counter(
+    'warbler_sql_statements_total',
+    'SQL statements executed, by the endpoint that issued them.',
+    ['endpoint'],
+    registry=REGISTRY,
+)
+
+SLOW_QUERIES = Counter(
+    'warbler_slow_queries_total',
+    'SQL statements slower than SLOW_QUERY_MS, by endpoint.',
+    ['endpoint'],
+    registry=REGISTRY,
+)
+
+DB_POOL_CHECKOUTS = Counter(
+    'warbler_db_pool_checkouts_total',
+    'Connections checked out of the pool.',
+    registry=REGISTRY,
+)
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    'warbler_db_pool_checkout_seconds',
+    'Time to get a connection from the pool (waiting and connecting).',
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 30),
+    registry=REGISTRY,
+)
+
+DB_POOL_CHECKED_OUT = Gauge(
+    'warbler_db_pool_checked_out',
+    'Connections currently checked out of the pool.',
+    multiprocess_mode='livesum',
+    registry=REGISTRY,
+)
+
+DB_POOL_OVERFLOW = Gauge(
+    'warbler_db_pool_overflow',
+    'Connections open beyond the pool size.',
+    multiprocess_mode='livesum',
+    registry=REGISTRY,
+)
+
+BCRYPT_SECONDS = Histogram(
+    'warbler_bcrypt_duration_seconds',
+    'Time spent hashing or checking passwords.',
+    ['operation'],
+    buckets=(.001, .01, .05, .1, .2, .3, .5, 1, 2),
+    registry=REGISTRY,
+)
+
+CACHE_REQUESTS = Counter(
+    'warbler_cache_requests_total',
+    'Cache lookups, by cache and hit/miss.',
+    ['cache', 'result'],
+    registry=REGISTRY,
+)
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout takes."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - start)
+
+
+class CounterCollector:
+    """Reports counts from `get_counters()` ({labels: count}) on scrape."""
+
+    def __init__(self, name, documentation, labels, get_counters):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.get_counters = get_counters
+
+    def collect(self):
+        family = CounterMetricFamily(
+            self.name, self.documentation, labels=self.labels)
+
+        for labels, count in sorted(self.get_counters().items()):
+            family.add_metric(labels, count)
+
+        yield family
+
+
+def get_endpoint():
+    """Endpoint of the current request, for labels."""
+
+    if has_request_context():
+        return request.endpoint or 'none'
+
+    return 'none'
+
+
+def instrument_engine(engine):
+    """Count statements and pool activity for a SQLAlchemy engine."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(conn, cursor, statement, params, context, many):
+        SQL_STATEMENTS.labels(get_endpoint()).inc()
+
+    @event.listens_for(engine.pool, 'checkout')
+    def on_checkout(dbapi_conn, record, proxy):
+        DB_POOL_CHECKOUTS.inc()
+        update_pool_gauges(engine.pool)
+
+    @event.listens_for(engine.pool, 'checkin')
+    def on_checkin(dbapi_conn, record):
+        update_pool_gauges(engine.pool)
+
+
+def update_pool_gauges(pool):
+    """Record current checked-out and overflow counts of `pool`."""
+
+    if isinstance(pool, QueuePool):
+        DB_POOL_CHECKED_OUT.set(pool.checkedout())
+        DB_POOL_OVERFLOW.set(max(pool.overflow(), 0))
+
+
+def observe_request(endpoint, method, status, seconds):
+    """Record one finished request."""
+
+    endpoint = endpoint or 'none'
+
+    REQUEST_LATENCY.labels(endpoint, method).observe(seconds)
+    REQUEST_COUNT.labels(endpoint, method, status).inc()
+
+
+def generate(collectors=()):
+    """Return current metrics (for all workers) in text format.
+
+    `collectors` report values that are already shared between workers,
+    so they're added once rather than per process.
+    """
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    extra = CollectorRegistry()
+    for collector in collectors:
+        extra.register(collector)
+
+    return generate_latest(registry) + generate_latest(extra)
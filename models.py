@@ -1,12 +1,26 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    DDL, Integer, and_, any_, column, delete, event, func, insert,
+    lambda_stmt, literal, literal_column, select, table, tuple_,
+    type_coerce)
+from sqlalchemy.orm import aliased
+# Registers the typed to_tsvector() and friends used for message search.
+import sqlalchemy.dialects.postgresql  # noqa: F401
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from metrics import BCRYPT_SECONDS
+from prepared_statements import PREPARED
+from shards import ShardRouter
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
+shards = ShardRouter(db)
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -17,6 +31,33 @@ DEFAULT_HEADER_IMAGE_URL = (
     "rb-4.0.3&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=for" +
     "mat&fit=crop&w=2070&q=80")
 
+# Text search configuration for the full-text index on messages.
+SEARCH_CONFIG = literal_column("'english'::regconfig")
+
+# On SQLite, an FTS5 index over messages.text, kept up to date by triggers
+SEARCH_TABLE = table('messages_fts', column('rowid'), column('messages_fts'))
+
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE messages_fts USING fts5(
+        text, content='messages', content_rowid='id',
+        tokenize='porter unicode61')""",
+    """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END""",
+    """CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages
+    BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+    END""",
+]
+
+Stats = namedtuple('Stats', 'messages following followers likes')
+
 
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -41,6 +82,9 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    # FollowGraph answering relationship checks from memory once it's ready
+    follow_graph = None
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -88,6 +132,17 @@ class User(db.Model):
         nullable=False,
     )
 
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    __table_args__ = (
+        # Mentions are matched case-insensitively (see entities.py)
+        db.Index('ix_users_username_lower', func.lower(username)),
+    )
+
     messages = db.relationship('Message', backref="user")
 
     followers = db.relationship(
@@ -111,7 +166,10 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with BCRYPT_SECONDS.labels('hash').time():
+            hashed_pwd = (bcrypt
+                          .generate_password_hash(password)
+                          .decode('UTF-8'))
 
         user = User(
             username=username,
@@ -134,18 +192,39 @@ class User(db.Model):
         False.
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        user = cls.get_by_username(username)
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            with BCRYPT_SECONDS.labels('check').time():
+                is_auth = bcrypt.check_password_hash(user.password, password)
             if is_auth:
                 return user
 
         return False
 
+    @classmethod
+    def get(cls, user_id):
+        """The user with `user_id`, or None (a cached statement)."""
+
+        return db.session.execute(
+            lambda_stmt(lambda: select(User).where(User.id == user_id)),
+            execution_options=PREPARED).scalar_one_or_none()
+
+    @classmethod
+    def get_by_username(cls, username):
+        """The user named `username`, or None (a cached statement)."""
+
+        return db.session.execute(
+            lambda_stmt(
+                lambda: select(User).where(User.username == username)),
+            execution_options=PREPARED).scalar_one_or_none()
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
+        if User.follow_graph is not None and User.follow_graph.ready:
+            return User.follow_graph.is_following(other_user.id, self.id)
+
         found_user_list = [
             user for user in self.followers if user == other_user]
         return len(found_user_list) == 1
@@ -153,6 +232,9 @@ class User(db.Model):
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
+        if User.follow_graph is not None and User.follow_graph.ready:
+            return User.follow_graph.is_following(self.id, other_user.id)
+
         found_user_list = [
             user for user in self.following if user == other_user]
         return len(found_user_list) == 1
@@ -160,8 +242,261 @@ class User(db.Model):
     def has_liked(self, message):
         """Checks if this message is in likes. Returns True or False"""
 
+        if shards.enabled:
+            return message.id in self.get_liked_ids()
+
         return message in self.likes
 
+    def get_liked_ids(self):
+        """Set of ids of the messages this user has liked.
+
+        Loaded once per instance, like the `likes` collection.
+        """
+
+        if getattr(self, '_liked_ids', None) is None:
+            self._liked_ids = set(db.session.execute(
+                select(Like.message_id)
+                .where(Like.user_id == self.id)
+                .execution_options(shard=shards.for_user(self.id))
+            ).scalars())
+
+        return self._liked_ids
+
+    def like(self, message):
+        """Like `message` (stored on this user's shard when sharded)."""
+
+        if not shards.enabled:
+            self.likes.append(message)
+            return
+
+        db.session.execute(
+            insert(Like)
+            .values(user_id=self.id, message_id=message.id)
+            .execution_options(shard=shards.for_user(self.id)))
+        self.get_liked_ids().add(message.id)
+
+    def unlike(self, message):
+        """Stop liking `message`."""
+
+        if not shards.enabled:
+            self.likes.remove(message)
+            return
+
+        db.session.execute(
+            delete(Like)
+            .where(Like.user_id == self.id, Like.message_id == message.id)
+            .execution_options(shard=shards.for_user(self.id)))
+        self.get_liked_ids().discard(message.id)
+
+    def get_liked_messages(self):
+        """Messages this user has liked, newest first."""
+
+        ids = db.session.execute(
+            select(Like.message_id)
+            .where(Like.user_id == self.id)
+            .execution_options(shard=shards.for_user(self.id))
+        ).scalars().all()
+
+        stmts = {
+            shard: (select(Message)
+                    .where(Message.id.in_(message_ids))
+                    .order_by(Message.id.desc()))
+            for shard, message_ids in shards.group_by_message(ids).items()}
+
+        rows = shards.scatter(stmts, key=lambda row: row[0].id)
+
+        return [message for message, in rows]
+
+    def get_stats(self):
+        """Counts of this user's messages, following, followers and likes.
+
+        Returns a row with `messages` (including archived ones),
+        `following`, `followers` and `likes` attributes, counted in one
+        query instead of loading each list (two when sharded: messages and
+        likes are counted on the user's shard).
+        """
+
+        def count(column):
+            return (select(func.count())
+                    .where(column == self.id)
+                    .scalar_subquery())
+
+        archived = (select(func.coalesce(func.sum(
+                        MessageArchive.message_count), 0))
+                    .where(MessageArchive.user_id == self.id)
+                    .scalar_subquery())
+
+        main = [
+            archived.label('archived'),
+            count(Follow.user_following_id).label('following'),
+            count(Follow.user_being_followed_id).label('followers'),
+        ]
+        sharded = [
+            count(Message.user_id).label('messages'),
+            count(Like.user_id).label('likes'),
+        ]
+
+        if shards.enabled:
+            row = db.session.execute(select(*main)).one()._asdict()
+            row.update(db.session.execute(
+                select(*sharded)
+                .execution_options(shard=shards.for_user(self.id))
+            ).one()._asdict())
+        else:
+            row = db.session.execute(select(*main, *sharded)).one()._asdict()
+
+        return Stats(
+            messages=row['messages'] + row['archived'],
+            following=row['following'],
+            followers=row['followers'],
+            likes=row['likes'],
+        )
+
+    def get_messages(self, yield_per=None):
+        """This user's messages, newest first.
+
+        Loaded `yield_per` at a time as they're iterated over, if given.
+        """
+
+        user_id = self.id
+        options = {**PREPARED, 'shard': shards.for_user(user_id)}
+
+        if yield_per:
+            options['yield_per'] = yield_per
+
+        return db.session.execute(
+            lambda_stmt(
+                lambda: select(Message)
+                .where(Message.user_id == user_id)
+                .order_by(Message.timestamp.desc())),
+            execution_options=options).scalars()
+
+    def delete_messages(self):
+        """Delete this user's messages.
+
+        When sharded, also deletes what deleting the user would cascade to
+        on the main database: their likes, likes of their messages and
+        mentions of them.
+        """
+
+        shard = shards.for_user(self.id)
+
+        if shard is None:
+            Message.query.filter_by(user_id=self.id).delete()
+            return
+
+        message_ids = db.session.execute(
+            delete(Message)
+            .where(Message.user_id == self.id)
+            .returning(Message.id)
+            .execution_options(shard=shard)).scalars().all()
+
+        db.session.execute(
+            delete(Like)
+            .where(Like.user_id == self.id)
+            .execution_options(shard=shard))
+
+        if message_ids:
+            shards.execute_all(
+                delete(Like).where(Like.message_id.in_(message_ids)))
+
+        shards.execute_all(delete(Mention).where(Mention.user_id == self.id))
+
+    def get_following(self):
+        """Query for the users this user is following."""
+
+        return (User
+                .query
+                .join(Follow, Follow.user_being_followed_id == User.id)
+                .filter(Follow.user_following_id == self.id))
+
+    def get_feed_user_ids(self):
+        """Query for ids of this user and the users they follow."""
+
+        return (select(Follow.user_being_followed_id)
+                .where(Follow.user_following_id == self.id)
+                .union(select(literal(self.id))))
+
+    def list_feed_user_ids(self):
+        """Ids of this user and the users they follow (a cached statement)."""
+
+        user_id = self.id
+
+        following = db.session.execute(
+            lambda_stmt(
+                lambda: select(Follow.user_being_followed_id)
+                .where(Follow.user_following_id == user_id)),
+            execution_options=PREPARED).scalars().all()
+
+        return [user_id, *following]
+
+    def with_relationships(self, query):
+        """Add flags for how this user relates to each user in `query`.
+
+        Rows of the returned query are (user, you_follow, follows_you),
+        found with two primary key joins on follows instead of a lookup per
+        user.
+        """
+
+        you_follow = aliased(Follow)
+        follows_you = aliased(Follow)
+
+        return (query
+                .outerjoin(you_follow, and_(
+                    you_follow.user_being_followed_id == User.id,
+                    you_follow.user_following_id == self.id))
+                .outerjoin(follows_you, and_(
+                    follows_you.user_following_id == User.id,
+                    follows_you.user_being_followed_id == self.id))
+                .add_columns(
+                    you_follow.user_following_id.isnot(None)
+                    .label('you_follow'),
+                    follows_you.user_being_followed_id.isnot(None)
+                    .label('follows_you')))
+
+    def get_followers_followed_by(self, viewer, limit=3):
+        """Users following this user whom `viewer` follows.
+
+        Returns (first `limit` users, total count).
+        """
+
+        if User.follow_graph is not None and User.follow_graph.ready:
+            ids = User.follow_graph.get_followers_followed_by(
+                self.id, viewer.id)
+            count = len(ids)
+            users = User.query.filter(User.id.in_(ids[:limit])).all()
+
+        else:
+            viewer_follows = aliased(Follow)
+            query = (self
+                     .get_followers()
+                     .join(viewer_follows,
+                           viewer_follows.user_being_followed_id == User.id)
+                     .filter(viewer_follows.user_following_id == viewer.id))
+            count = query.count()
+            users = query.order_by(User.id).limit(limit).all()
+
+        return sorted(users, key=lambda user: user.id), count
+
+    def get_suggestions(self, limit=5):
+        """Top suggested users to follow, as (user, mutual_count) rows."""
+
+        return db.session.execute(
+            select(User, FollowSuggestion.mutual_count)
+            .join(FollowSuggestion,
+                  FollowSuggestion.suggested_user_id == User.id)
+            .where(FollowSuggestion.user_id == self.id)
+            .order_by(FollowSuggestion.score.desc())
+            .limit(limit)).all()
+
+    def get_followers(self):
+        """Query for the users following this user."""
+
+        return (User
+                .query
+                .join(Follow, Follow.user_following_id == User.id)
+                .filter(Follow.user_being_followed_id == self.id))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -191,6 +526,196 @@ class Message(db.Model):
         nullable=False,
     )
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+        db.Index(
+            'ix_messages_text_search',
+            func.to_tsvector(SEARCH_CONFIG, text),
+            postgresql_using='gin',
+        ).ddl_if(dialect='postgresql'),
+    )
+
+    @classmethod
+    def create(cls, user, text):
+        """Add a message by `user`, on their shard when sharded.
+
+        Returns the message, which has an id.
+        """
+
+        shard = shards.for_user(user.id)
+
+        if shard is None:
+            message = cls(text=text)
+            user.messages.append(message)
+            db.session.flush()
+            return message
+
+        return db.session.execute(
+            insert(cls)
+            .values(id=shards.new_message_id(shard), user_id=user.id,
+                    text=text, timestamp=datetime.utcnow())
+            .returning(cls)
+            .execution_options(shard=shard)).scalar_one()
+
+    @classmethod
+    def get(cls, message_id):
+        """The message with `message_id` (from its shard), or None."""
+
+        return db.session.get(
+            cls, message_id,
+            execution_options={'shard': shards.for_message(message_id)})
+
+    @classmethod
+    def get_timeline(cls, user_ids, limit=100):
+        """The newest `limit` messages by `user_ids`, newest first.
+
+        One cached statement per shard, merged (one query when not sharded).
+        On PostgreSQL the ids are bound as one array, so the SQL is the same
+        for any number of them and is prepared once.
+        """
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            def by_users(ids):
+                return lambda: select(Message).where(
+                    Message.user_id == any_(type_coerce(ids, ARRAY(Integer))))
+        else:
+            def by_users(ids):
+                return lambda: select(Message).where(
+                    Message.user_id.in_(ids))
+
+        stmts = {
+            shard: lambda_stmt(by_users(shard_ids))
+            + (lambda s: s
+               .order_by(Message.timestamp.desc(), Message.id.desc())
+               .limit(limit)
+               # prepare=True, as PREPARED; not on the lambda statement,
+               # which would keep the first call's ids
+               .execution_options(prepare=True))
+            for shard, shard_ids in shards.group_by_user(user_ids).items()}
+
+        rows = shards.scatter(
+            stmts,
+            key=lambda row: (row[0].timestamp, row[0].id),
+            limit=limit)
+
+        return [message for message, in rows]
+
+    def delete(self):
+        """Delete this message, with its likes."""
+
+        shard = shards.for_message(self.id)
+
+        if shard is None:
+            db.session.delete(self)
+            return
+
+        shards.execute_all(delete(Like).where(Like.message_id == self.id))
+        db.session.execute(
+            delete(Message)
+            .where(Message.id == self.id)
+            .execution_options(shard=shard))
+
+    @classmethod
+    def search(cls, terms, user_ids=None, after=None, limit=20):
+        """Find messages matching search `terms`, best matches first.
+
+        Returns up to `limit` (message, rank) rows. `user_ids` (a list or
+        subquery) limits results to those authors; `after` is the
+        (rank, id) of the last row of the previous page.
+
+        On PostgreSQL this uses the ix_messages_text_search full-text index,
+        which Postgres keeps up to date as messages are added and deleted;
+        on SQLite, the messages_fts index. Other databases fall back to a
+        substring match. When sharded, every shard is searched and the
+        results merged.
+        """
+
+        dialect = db.session.get_bind().dialect.name
+        stmt = select(cls)
+
+        if dialect == 'postgresql':
+            query = func.websearch_to_tsquery(SEARCH_CONFIG, terms)
+            vector = func.to_tsvector(SEARCH_CONFIG, cls.text)
+            # As double precision, so cursors round-trip exactly
+            rank = func.ts_rank(vector, query).cast(db.Double)
+            matches = vector.op('@@')(query)
+        elif dialect == 'sqlite':
+            # Each word as a quoted string, so all must match and none are
+            # read as FTS5 query syntax
+            query = " ".join(
+                '"' + word.replace('"', '""') + '"' for word in terms.split())
+            # bm25() is lower for better matches
+            rank = -func.bm25(SEARCH_TABLE.c.messages_fts)
+            matches = SEARCH_TABLE.c.messages_fts.op('MATCH')(query)
+            stmt = stmt.join(SEARCH_TABLE, SEARCH_TABLE.c.rowid == cls.id)
+        else:
+            rank = literal(0.0)
+            matches = cls.text.ilike(f"%{terms}%")
+
+        stmt = stmt.add_columns(rank.label('rank')).where(matches)
+
+        if user_ids is not None:
+            if shards.enabled and not isinstance(user_ids, list):
+                # The shards don't have the tables a subquery would read
+                user_ids = db.session.execute(user_ids).scalars().all()
+
+            stmt = stmt.where(cls.user_id.in_(user_ids))
+
+        if after is not None:
+            stmt = stmt.where(tuple_(rank, cls.id) < tuple_(*after))
+
+        return shards.scatter(
+            stmt.order_by(rank.desc(), cls.id.desc()).limit(limit),
+            key=lambda row: (row.rank, row[0].id),
+            limit=limit)
+
+
+shards.by_message_id.add(Message)
+
+for ddl in SQLITE_SEARCH_DDL:
+    event.listen(
+        Message.__table__, 'after_create',
+        DDL(ddl).execute_if(dialect='sqlite'))
+
+event.listen(
+    Message.__table__, 'before_drop',
+    DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'))
+
+
+class MessageArchive(db.Model):
+    """One user's archived messages for one month, compressed together.
+
+    On PostgreSQL the table is partitioned by month; see archive.py.
+    """
+
+    __tablename__ = 'message_archive'
+
+    __table_args__ = {
+        'postgresql_partition_by': 'RANGE (month)',
+    }
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    month = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    data = db.deferred(db.Column(
+        db.LargeBinary,
+        nullable=False,
+    ))
+
 
 class Like(db.Model):
     """Through table that links user to messages"""
@@ -210,6 +735,203 @@ class Like(db.Model):
     )
 
 
+class UserStats(db.Model):
+    """Follow graph stats for a user, computed by `flask graph-stats`."""
+
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    followers = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    following = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    influence = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    reciprocity = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class MessageTag(db.Model):
+    """Hashtag used in a message (lower-cased, without the #)."""
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.String(50),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """User @mentioned in a message."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+        index=True,
+    )
+
+
+class FollowSuggestion(db.Model):
+    """User suggested for another to follow, maintained by suggestions.py.
+
+    `mutual_count` is how many of the user's follows follow the suggested
+    user; `activity` weights that by how much the suggested user has posted
+    lately, and `score` is the product of the two.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+        index=True,
+    )
+
+    mutual_count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    activity = db.Column(
+        db.Float,
+        nullable=False,
+        default=1.0,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_follow_suggestions_user_id_score', 'user_id', score.desc()),
+    )
+
+
+class SuggestionUpdate(db.Model):
+    """A follow or unfollow whose suggestions suggestions.py hasn't updated.
+
+    No foreign keys: the users may be deleted before it's processed.
+    """
+
+    __tablename__ = 'suggestion_updates'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class TrendingCount(db.Model):
+    """Likes and posts of a message in one time bucket, for trending.py.
+
+    No foreign key to messages, which may be on a shard; counts of deleted
+    messages age out with the rest.
+    """
+
+    __tablename__ = 'trending_counts'
+
+    # Start time // trending.BUCKET_SECONDS
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    posts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class TrendingMessage(db.Model):
+    """A message in the precomputed trending list, by trending.py."""
+
+    __tablename__ = 'trending_messages'
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -219,3 +941,4 @@ def connect_db(app):
     app.app_context().push()
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
@@ -0,0 +1,167 @@
+"""Server-side prepared statements for the hottest queries.
+
+The queries run on every request (the logged-in user, a profile's
+messages, the home timeline, logging in) are lambda statements in
+models.py: SQLAlchemy builds each one once per call site and caches its
+compiled SQL, so a request only binds new values.
+
+psycopg2 still sends each statement's SQL text, which Postgres parses and
+plans every time. Statements run with the PREPARED execution options are
+instead PREPAREd on each pooled connection the first time it runs them,
+then sent as `EXECUTE name(values)`. At most `max_per_connection` are kept
+per connection; the least recently used are deallocated. A statement
+Postgres can't prepare (one with a parameter whose type it can't infer)
+is run as it is, and not tried again. Statements read through a
+server-side cursor (`yield_per`) aren't prepared: DECLARE can't take an
+EXECUTE. Nor are statements with IN lists, whose SQL changes with the
+number of values: compare to `ANY(:array)` instead (see
+Message.get_timeline).
+
+Turn this off (PREPARED_STATEMENTS=0) behind a pooler that doesn't keep a
+client on one server connection, e.g. PgBouncer in transaction mode.
+
+SQLite needs none of this: the sqlite3 module already keeps a cache of
+prepared statements on each connection.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+from sqlalchemy import event
+
+# Execution options for a statement to prepare
+PREPARED = {'prepare': True}
+
+PARAMETER_RE = re.compile(r"%\((\w+)\)s|%%")
+
+
+def to_prepare(statement):
+    """(SQL for PREPARE, parameter names in order) for pyformat SQL."""
+
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+
+        if name is None:
+            return '%'
+
+        if name not in names:
+            names.append(name)
+
+        return f"${names.index(name) + 1}"
+
+    return PARAMETER_RE.sub(replace, statement), names
+
+
+class PreparedStatements:
+    """Prepares statements on an engine's connections and reuses them."""
+
+    def __init__(self, max_per_connection=100, enabled=True):
+        self.max_per_connection = max_per_connection
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        # SQL: (statement name, SQL for PREPARE, parameter names)
+        self._statements = {}
+        self._unpreparable = set()
+
+    def instrument(self, engine):
+        """Prepare statements run on `engine`, if it's Postgres/psycopg2."""
+
+        if (engine.dialect.name != 'postgresql'
+                or engine.dialect.paramstyle != 'pyformat'):
+            return
+
+        event.listen(
+            engine, 'before_cursor_execute', self.rewrite, retval=True)
+
+    def rewrite(self, conn, cursor, statement, parameters, context, many):
+        """`statement` as an EXECUTE of a prepared statement, if it can be.
+
+        A before_cursor_execute listener.
+        """
+
+        if (not self.enabled
+                or many
+                or context is None
+                or not context.execution_options.get('prepare')
+                or cursor.name is not None
+                or not isinstance(parameters, dict)
+                or self._varies(context.compiled)):
+            return statement, parameters
+
+        name, sql, names = self._parse(statement)
+
+        if name in self._unpreparable:
+            return statement, parameters
+
+        prepared = conn.info.setdefault('prepared_statements', OrderedDict())
+
+        if name in prepared:
+            prepared.move_to_end(name)
+        elif self._prepare(cursor, name, sql):
+            prepared[name] = True
+
+            while len(prepared) > self.max_per_connection:
+                oldest, _ = prepared.popitem(last=False)
+                cursor.execute(f"DEALLOCATE {oldest}")
+        else:
+            with self._lock:
+                self._unpreparable.add(name)
+
+            return statement, parameters
+
+        if names:
+            args = ', '.join(f"%({name})s" for name in names)
+            return f"EXECUTE {name}({args})", parameters
+
+        return f"EXECUTE {name}", parameters
+
+    @staticmethod
+    def _varies(compiled):
+        """Whether `compiled`'s SQL is rendered anew for each execution."""
+
+        return compiled is not None and bool(
+            compiled.post_compile_params or compiled.literal_execute_params)
+
+    def _parse(self, statement):
+        parsed = self._statements.get(statement)
+
+        if parsed is None:
+            sql, names = to_prepare(statement)
+            name = 'w_' + sha1(statement.encode('utf-8')).hexdigest()[:20]
+            parsed = (name, sql, names)
+
+            with self._lock:
+                if len(self._statements) >= 10 * self.max_per_connection:
+                    self._statements.clear()
+
+                self._statements[statement] = parsed
+
+        return parsed
+
+    def _prepare(self, cursor, name, sql):
+        """PREPARE `sql` as `name`; False if Postgres refuses.
+
+        Inside a savepoint, so a failure doesn't abort the transaction.
+        """
+
+        in_transaction = not cursor.connection.autocommit
+
+        if in_transaction:
+            cursor.execute("SAVEPOINT prepare_statement")
+
+        try:
+            cursor.execute(f"PREPARE {name} AS {sql}")
+        except Exception:
+            if in_transaction:
+                cursor.execute("ROLLBACK TO SAVEPOINT prepare_statement")
+            return False
+        finally:
+            if in_transaction:
+                cursor.execute("RELEASE SAVEPOINT prepare_statement")
+
+        return True
@@ -0,0 +1,276 @@
+"""Sampling profiler for a fraction of requests, aggregated per route.
+
+While enabled, each request is picked for profiling with its route's sample
+rate. A single background thread wakes every `interval` seconds, grabs the
+stack of every thread currently handling a picked request and counts it
+under that route. Stacks are exported in collapsed ("folded") format, one
+`frame;frame;frame count` line per distinct stack, which flamegraph.pl,
+speedscope and similar tools turn into flame graphs.
+
+Settings and stacks are shared by every gunicorn worker on a node through a
+small SQLite database (WAL mode) on local disk, like the rate limiter's:
+turning the profiler on in one worker turns it on in all of them, and the
+stacks downloaded include every worker's. Each worker re-reads the
+settings at most every `refresh_interval` seconds, and adds the stacks it
+has sampled to the database every `flush_interval` seconds.
+
+When disabled, the only cost per request is checking `profiler.enabled`.
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stacks (
+    endpoint TEXT NOT NULL,
+    stack TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (endpoint, stack)
+);
+"""
+
+# Per-endpoint rates are stored as settings named RATE_PREFIX + endpoint
+RATE_PREFIX = 'rate:'
+
+
+class SamplingProfiler:
+    """Collects collapsed stacks of sampled requests, stored at `path`."""
+
+    def __init__(self, path, interval=0.005, default_rate=0.01,
+                 refresh_interval=1, flush_interval=1):
+        self.path = path
+        self.interval = interval
+        self.refresh_interval = refresh_interval
+        self.flush_interval = flush_interval
+
+        self._default_rate = default_rate
+        self._settings = None
+        self._loaded = 0
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._active = {}
+        self._stacks = defaultdict(Counter)
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self._get_settings()[0]
+
+    @property
+    def default_rate(self):
+        return self._get_settings()[1]
+
+    @property
+    def sample_rates(self):
+        """{endpoint: sample rate} for endpoints with their own rate."""
+
+        return self._get_settings()[2]
+
+    def enable(self, default_rate=None):
+        """Start sampling requests, in every worker."""
+
+        if default_rate is not None:
+            self.set_rate(default_rate)
+
+        self._set('enabled', 1)
+        self._start_thread()
+
+    def disable(self):
+        """Stop sampling requests; collected stacks are kept."""
+
+        self._set('enabled', 0)
+
+    def set_rate(self, rate, endpoint=None):
+        """Set the sample rate of `endpoint`, or the default rate."""
+
+        if endpoint:
+            self._set(RATE_PREFIX + endpoint, rate)
+        else:
+            self._set('default_rate', rate)
+
+    def reset(self):
+        """Drop all collected stacks, every worker's."""
+
+        with self._lock:
+            self._stacks.clear()
+
+        conn = self._connect()
+
+        with conn:
+            conn.execute("DELETE FROM stacks")
+
+    def should_sample(self, endpoint):
+        """Randomly decide whether to profile a request to `endpoint`."""
+
+        rate = self.sample_rates.get(endpoint, self.default_rate)
+        return random.random() < rate
+
+    def start_request(self, endpoint):
+        """Profile the current thread as a request to `endpoint`."""
+
+        with self._lock:
+            self._active[threading.get_ident()] = endpoint
+
+        self._start_thread()
+
+    def stop_request(self):
+        """Stop profiling the current thread."""
+
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def get_summary(self):
+        """Return {endpoint: number of samples}."""
+
+        self.flush()
+
+        rows = self._connect().execute(
+            "SELECT endpoint, SUM(count) FROM stacks GROUP BY endpoint")
+        return dict(rows)
+
+    def get_collapsed(self, endpoint):
+        """Return collapsed stacks for `endpoint`, busiest first."""
+
+        self.flush()
+
+        rows = self._connect().execute(
+            """SELECT stack, count FROM stacks WHERE endpoint = ?
+               ORDER BY count DESC""",
+            (endpoint,))
+        return ''.join(f"{stack} {count}\n" for stack, count in rows)
+
+    def flush(self):
+        """Add the stacks sampled in this process to the database."""
+
+        with self._lock:
+            stacks, self._stacks = self._stacks, defaultdict(Counter)
+
+        rows = [
+            (endpoint, stack, count)
+            for endpoint, counts in stacks.items()
+            for stack, count in counts.items()]
+
+        if not rows:
+            return
+
+        conn = self._connect()
+
+        with conn:
+            conn.executemany(
+                """INSERT INTO stacks VALUES (?, ?, ?)
+                   ON CONFLICT (endpoint, stack)
+                   DO UPDATE SET count = count + excluded.count""",
+                rows)
+
+    def _get_settings(self):
+        """(enabled, default rate, {endpoint: rate}), re-read from the
+        database if older than `refresh_interval`."""
+
+        if (self._settings is None
+                or time.monotonic() - self._loaded >= self.refresh_interval):
+            self._load_settings()
+
+        return self._settings
+
+    def _load_settings(self):
+        settings = dict(self._connect().execute(
+            "SELECT name, value FROM settings"))
+
+        rates = {
+            name[len(RATE_PREFIX):]: rate
+            for name, rate in settings.items()
+            if name.startswith(RATE_PREFIX)}
+
+        self._settings = (
+            bool(settings.get('enabled', 0)),
+            settings.get('default_rate', self._default_rate),
+            rates)
+        self._loaded = time.monotonic()
+
+    def _set(self, name, value):
+        conn = self._connect()
+
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                (name, value))
+
+        self._load_settings()
+
+    def _connect(self):
+        """Connection for this thread (reopened after a fork)."""
+
+        local = self._local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+
+            local.conn = conn
+            local.pid = os.getpid()
+
+        return local.conn
+
+    def _start_thread(self):
+        """Start the sampler thread if it isn't running in this process."""
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._thread = threading.Thread(
+                target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Sample stacks of profiled threads until disabled and idle,
+        flushing them every `flush_interval` seconds."""
+
+        flushed = time.monotonic()
+
+        while self.enabled or self._active:
+            with self._lock:
+                active = dict(self._active)
+
+            if active:
+                frames = sys._current_frames()
+
+                with self._lock:
+                    for thread_id, endpoint in active.items():
+                        frame = frames.get(thread_id)
+                        if frame is not None:
+                            self._stacks[endpoint][collapse(frame)] += 1
+
+            if time.monotonic() - flushed >= self.flush_interval:
+                self.flush()
+                flushed = time.monotonic()
+
+            time.sleep(self.interval)
+
+        self.flush()
+
+
+def collapse(frame):
+    """Collapsed representation of the stack ending at `frame`."""
+
+    names = []
+
+    while frame is not None:
+        code = frame.f_code
+        name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        names.append(name.replace(' ', '_').replace(';', '_'))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
@@ -0,0 +1,136 @@
+"""Token-bucket rate limiting shared between worker processes.
+
+Buckets live in a small SQLite database (WAL mode) on local disk, so every
+gunicorn worker on a node sees the same counts. Each check takes one token
+from every bucket it names, or from none of them if any bucket is empty.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# `capacity` requests are allowed in a burst, refilling over `period` seconds
+Limit = namedtuple('Limit', 'capacity period')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    scope TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (scope, outcome)
+);
+"""
+
+# Buckets untouched for this long are full again and can be dropped
+PRUNE_AFTER = 24 * 60 * 60
+PRUNE_EVERY = 1000
+
+
+class TokenBucketStore:
+    """Token buckets stored in the SQLite database at `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._checks = 0
+
+    def consume(self, scope, buckets, now=None):
+        """Take a token from each of `buckets`, a list of (key, Limit).
+
+        Returns (allowed, retry_after): retry_after is the number of seconds
+        until every bucket has a token again (0 when allowed).
+        """
+
+        now = time.time() if now is None else now
+        conn = self._connect()
+
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            levels = []
+            retry_after = 0
+
+            for key, limit in buckets:
+                rate = limit.capacity / limit.period
+                row = conn.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?",
+                    (key,),
+                ).fetchone()
+
+                if row is None:
+                    tokens = limit.capacity
+                else:
+                    tokens = min(
+                        limit.capacity, row[0] + (now - row[1]) * rate)
+
+                if tokens < 1:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+
+                levels.append((key, tokens))
+
+            allowed = retry_after == 0
+
+            if allowed:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                    [(key, tokens - 1, now) for key, tokens in levels],
+                )
+
+            conn.execute(
+                """INSERT INTO counters VALUES (?, ?, 1)
+                   ON CONFLICT (scope, outcome)
+                   DO UPDATE SET count = count + 1""",
+                (scope, 'allowed' if allowed else 'rejected'),
+            )
+
+            self._checks += 1
+            if self._checks % PRUNE_EVERY == 0:
+                conn.execute(
+                    "DELETE FROM buckets WHERE updated < ?",
+                    (now - PRUNE_AFTER,),
+                )
+
+            conn.execute("COMMIT")
+
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        return allowed, retry_after
+
+    def get_counters(self):
+        """Return {(scope, outcome): count} for every check made so far."""
+
+        rows = self._connect().execute(
+            "SELECT scope, outcome, count FROM counters")
+        return {(scope, outcome): count for scope, outcome, count in rows}
+
+    def reset(self):
+        """Empty all buckets and counters."""
+
+        self._connect().executescript(
+            "DELETE FROM buckets; DELETE FROM counters;")
+
+    def _connect(self):
+        """Connection for this thread (reopened after a fork)."""
+
+        local = self._local
+
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+
+            local.conn = conn
+            local.pid = os.getpid()
+
+        return local.conn
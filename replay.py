@@ -0,0 +1,336 @@
+"""Replay captured traffic against a local Warbler and compare builds.
+
+    python replay.py run capture.jsonl --url http://127.0.0.1:5000 \\
+        --speed 10 --out build-a.jsonl
+    python replay.py compare build-a.jsonl build-b.jsonl
+
+`run` re-issues the requests in a capture (see capture.py) on their
+original schedule, sped up `--speed` times, and writes each one's route,
+status and latency to `--out`. Run it against an instance seeded with a
+matching dataset (`python seed.py`) and started with the same SECRET_KEY
+as this process: requests are made as their captured user by signing a
+session cookie for them, with a CSRF token for forms, so no passwords are
+needed. Values the capture left out (warble text, searches, names) are
+filled in deterministically from the seed data, so replaying one capture
+against two builds sends exactly the same requests.
+
+`compare` prints p50/p95/p99 latency per route for two `run` outputs.
+"""
+
+import csv
+import hashlib
+import http.client
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
+
+import click
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+from itsdangerous import URLSafeTimedSerializer
+
+import capture
+from loadtest import SEED_DIR, SEED_PASSWORD, percentile
+
+# app.CURR_USER_KEY; not imported, to keep the app's setup out of here
+CURR_USER_KEY = 'curr_user'
+
+RULE_ARG_RE = re.compile(r'<(?:[^<>:]+:)?([^<>]+)>')
+
+
+class Seed:
+    """Usernames and warble text from the seed CSVs, for filling in values."""
+
+    def __init__(self, seed_dir=SEED_DIR):
+        with open(os.path.join(seed_dir, 'users.csv')) as f:
+            self.usernames = [row['username'] for row in csv.DictReader(f)]
+
+        with open(os.path.join(seed_dir, 'messages.csv')) as f:
+            self.texts = [row['text'] for row in csv.DictReader(f)]
+
+    def username(self, user_id):
+        """Username of a seeded user, by id."""
+
+        if user_id is not None and 0 < user_id <= len(self.usernames):
+            return self.usernames[user_id - 1]
+
+        return None
+
+    def text(self, length, n):
+        """Seeded warble text `length` long; the same for the same n."""
+
+        text = self.texts[n % len(self.texts)]
+
+        while len(text) < length:
+            n += 1
+            text = f"{text} {self.texts[n % len(self.texts)]}"
+
+        return text[:length]
+
+
+class Signer:
+    """Signs session cookies and CSRF tokens as the server would."""
+
+    def __init__(self, secret_key):
+        app = Flask(__name__)
+        app.secret_key = secret_key
+
+        self.session_serializer = (
+            SecureCookieSessionInterface().get_signing_serializer(app))
+        self.csrf_serializer = URLSafeTimedSerializer(
+            secret_key, salt='wtf-csrf-token')
+
+        self._cookies = {}
+        self._lock = threading.Lock()
+
+    def session(self, user_id):
+        """Session cookie value and CSRF form token for a user (or None)."""
+
+        with self._lock:
+            if user_id not in self._cookies:
+                raw = hashlib.sha1(f"replay:{user_id}".encode()).hexdigest()
+                data = {'csrf_token': raw}
+
+                if user_id is not None:
+                    data[CURR_USER_KEY] = user_id
+
+                self._cookies[user_id] = (
+                    self.session_serializer.dumps(data),
+                    self.csrf_serializer.dumps(raw))
+
+            return self._cookies[user_id]
+
+
+def fill(params, seed, entry, n):
+    """`params` from a capture with lengths replaced by seeded values."""
+
+    filled = []
+
+    for name, values in params.items():
+        if not isinstance(values, list):
+            values = [values]
+
+        for value in values:
+            if not isinstance(value, int):
+                pass
+            elif name == 'username':
+                value = seed.username(entry['u']) or f"replay{n}"
+            elif name == 'email':
+                value = f"replay{n}@example.com"
+            elif name == 'password':
+                value = SEED_PASSWORD
+            else:
+                value = seed.text(value, n)
+
+            filled.append((name, value))
+
+    return filled
+
+
+def build_request(entry, seed, signer, n):
+    """(method, path, body, headers) to replay the nth captured request."""
+
+    path = RULE_ARG_RE.sub(
+        lambda match: str(entry['a'][match.group(1)]), entry['r'])
+    query = fill(entry['q'], seed, entry, n)
+
+    if query:
+        path = f"{path}?{urlencode(query)}"
+
+    cookie, csrf_token = signer.session(entry['u'])
+    headers = {'Cookie': f"session={cookie}"}
+    body = None
+
+    if entry['m'] != 'GET':
+        form = [('csrf_token', csrf_token)] + fill(entry['f'], seed, entry, n)
+        body = urlencode(form)
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    return entry['m'], path, body, headers
+
+
+class Replayer:
+    """Re-issues captured requests on their original schedule."""
+
+    def __init__(self, url, seed, signer, speed=1.0, concurrency=64):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.seed = seed
+        self.signer = signer
+        self.speed = speed
+        self.concurrency = concurrency
+
+        self._local = threading.local()
+
+    def connection(self):
+        if getattr(self._local, 'conn', None) is None:
+            self._local.conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=60)
+
+        return self._local.conn
+
+    def send(self, n, entry, due):
+        lag = max(time.monotonic() - due, 0)
+        method, path, body, headers = build_request(
+            entry, self.seed, self.signer, n)
+        conn = self.connection()
+        start = time.perf_counter()
+
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            status = None
+
+        return {
+            'n': n,
+            'r': f"{entry['m']} {entry['r']}",
+            's': status,
+            'd': round((time.perf_counter() - start) * 1000, 1),
+            'captured_s': entry['s'],
+            'captured_d': entry['d'],
+            'lag': round(lag * 1000, 1),
+        }
+
+    def run(self, entries):
+        """Replay `entries`, yielding their results in the same order.
+
+        Requests are sent when due even if earlier ones haven't finished,
+        up to `concurrency` at once; `lag` is how late each one went out.
+        """
+
+        if not entries:
+            return
+
+        t0 = entries[0]['t']
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            futures = []
+
+            for n, entry in enumerate(entries):
+                due = start + (entry['t'] - t0) / self.speed
+                delay = due - time.monotonic()
+
+                if delay > 0:
+                    time.sleep(delay)
+
+                futures.append(pool.submit(self.send, n, entry, due))
+
+            for future in futures:
+                yield future.result()
+
+
+def summarize(results, latency='d'):
+    """Dict of route: (count, errors, p50, p95, p99)."""
+
+    routes = {}
+
+    for result in results:
+        routes.setdefault(result['r'], []).append(result)
+
+    return {
+        route: (
+            len(rows),
+            sum(1 for row in rows if not row['s'] or row['s'] >= 500),
+            *(percentile([row[latency] for row in rows], p)
+              for p in (50, 95, 99)))
+        for route, rows in sorted(routes.items())}
+
+
+def read_results(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+@click.group()
+def cli():
+    """Replay captured traffic and compare latency between builds."""
+
+
+@cli.command()
+@click.argument('capture_file', type=click.Path(exists=True))
+@click.option('--url', default='http://127.0.0.1:5000')
+@click.option('--speed', default=1.0,
+              help="How many times faster than captured to send requests.")
+@click.option('--concurrency', default=64,
+              help="Most requests in flight at once.")
+@click.option('--out', required=True, type=click.Path(),
+              help="File for each replayed request's result (JSON lines).")
+def run(capture_file, url, speed, concurrency, out):
+    """Replay a capture against a running Warbler."""
+
+    if 'SECRET_KEY' not in os.environ:
+        raise click.UsageError("Set SECRET_KEY to the server's secret key")
+
+    if speed <= 0:
+        raise click.UsageError("--speed must be positive")
+
+    entries = capture.read(capture_file)
+    replayer = Replayer(
+        url, Seed(), Signer(os.environ['SECRET_KEY']), speed, concurrency)
+    results = []
+
+    with open(out, 'w') as f:
+        for result in replayer.run(entries):
+            f.write(json.dumps(result, separators=(',', ':')) + '\n')
+            results.append(result)
+
+    lags = [result['lag'] for result in results]
+    if lags:
+        click.echo(
+            f"Replayed {len(results)} requests; sent up to "
+            f"{max(lags):.0f} ms late (p99 {percentile(lags, 99):.0f} ms)")
+
+    captured = summarize(results, latency='captured_d')
+
+    click.echo(
+        f"{'route':<48}{'count':>7}{'5xx':>6}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'captured p95':>14}")
+
+    for route, (count, errors, p50, p95, p99) in summarize(results).items():
+        click.echo(
+            f"{route:<48}{count:>7}{errors:>6}{p50:>9.1f}{p95:>9.1f}"
+            f"{p99:>9.1f}{captured[route][3]:>14.1f}")
+
+
+@cli.command()
+@click.argument('before', type=click.Path(exists=True))
+@click.argument('after', type=click.Path(exists=True))
+def compare(before, after):
+    """Compare latency per route between two replays."""
+
+    before, after = (
+        summarize(read_results(before)), summarize(read_results(after)))
+
+    click.echo(
+        f"{'route':<48}{'':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+
+    for route in sorted(before.keys() | after.keys()):
+        rows = [('before', before.get(route)), ('after', after.get(route))]
+
+        for label, row in rows:
+            if row:
+                p50, p95, p99 = row[2:]
+                click.echo(
+                    f"{route if label == 'before' else '':<48}{label:>6}"
+                    f"{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}")
+
+        if before.get(route) and after.get(route):
+            change = [
+                (b - a) / a if a else 0
+                for a, b in zip(before[route][2:], after[route][2:])]
+            click.echo(
+                f"{'':<54}" + ''.join(f"{c:>+9.0%}" for c in change))
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,6 +1,8 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
+from datetime import datetime
+
 from app import db
 from models import User, Message, Follow
 
@@ -11,7 +13,9 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.bulk_insert_mappings(Message, [
+        {**row, 'timestamp': datetime.fromisoformat(row['timestamp'])}
+        for row in DictReader(messages)])
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follow, DictReader(follows))
@@ -0,0 +1,236 @@
+"""Optional sharding of message tables across several databases.
+
+With `SHARD_DATABASE_URLS` set, `messages`, `likes`, `message_tags` and
+`mentions` live on N shard databases instead of the main one:
+
+- A user's messages, and the likes they give, live on the shard chosen by
+  a hash of their user id (`for_user`). Tags and mentions of a message
+  live with the message.
+- Message ids come from one sequence on the main database and encode the
+  shard: id = sequence value * N + shard. They stay in posting order
+  across shards, and `for_message` routes a lookup by id.
+- Statements are routed by an execution option,
+  `.execution_options(shard=n)`; without one they run on the main
+  database as before. `for_user` and `for_message` return None when
+  sharding is off, so the same code works either way.
+- `scatter()` runs a statement on every shard in parallel and merges the
+  already-sorted results, e.g. for the home timeline.
+
+Shards have no foreign keys to the main database (or, for likes, to
+another shard), so deletes that would cascade are done explicitly.
+"""
+
+import heapq
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from sqlalchemy import MetaData, create_engine, event, func, select
+from sqlalchemy.orm import Session
+
+# Main database sequence that message ids are allocated from
+MESSAGE_ID_SEQUENCE = 'messages_id_seq'
+
+
+class ShardRouter:
+    """Engines for the shard databases and routing between them."""
+
+    def __init__(self, db):
+        self.db = db
+        self.engines = []
+        self._pool = None
+        # Models whose rows are found on the shard of their id's message
+        self.by_message_id = set()
+
+        event.listen(Session, 'do_orm_execute', self._route)
+
+    def init_app(self, app):
+        """Connect to the shards in app.config['SHARD_DATABASE_URLS']."""
+
+        self.configure(
+            app.config.get('SHARD_DATABASE_URLS', []),
+            app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+
+    def configure(self, urls, engine_options=None):
+        """Use the shard databases at `urls` (none to turn sharding off)."""
+
+        for engine in self.engines:
+            engine.dispose()
+
+        if self._pool:
+            self._pool.shutdown()
+
+        self.engines = [
+            create_engine(url, **(engine_options or {})) for url in urls]
+        self._pool = (
+            ThreadPoolExecutor(len(urls), thread_name_prefix='shard')
+            if urls else None)
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def all(self):
+        """Every shard, or [None] (the main database) if not sharded."""
+
+        return list(range(len(self.engines))) if self.enabled else [None]
+
+    def for_user(self, user_id):
+        """Shard holding a user's messages and likes."""
+
+        if not self.enabled:
+            return None
+
+        return zlib.crc32(str(user_id).encode()) % len(self.engines)
+
+    def for_message(self, message_id):
+        """Shard holding a message."""
+
+        if not self.enabled:
+            return None
+
+        return message_id % len(self.engines)
+
+    def new_message_id(self, shard):
+        """Allocate an id for a new message on `shard`."""
+
+        value = self.db.session.execute(
+            select(func.nextval(MESSAGE_ID_SEQUENCE))).scalar()
+
+        return value * len(self.engines) + shard
+
+    def _route(self, orm_execute_state):
+        """Run statements with a `shard` execution option on that shard."""
+
+        shard = orm_execute_state.execution_options.get('shard')
+
+        # Reloads of expired messages (after a commit) go by their id
+        if shard is None and self.enabled and orm_execute_state.is_column_load:
+            state = orm_execute_state.load_options._refresh_state
+
+            if state is not None and state.class_ in self.by_message_id:
+                shard = self.for_message(state.identity[0])
+
+        if shard is None or 'bind' in orm_execute_state.bind_arguments:
+            return None
+
+        return orm_execute_state.invoke_statement(
+            bind_arguments={'bind': self.engines[shard]})
+
+    def execute_all(self, stmt):
+        """Run a write on every shard, in the session's transaction."""
+
+        for shard in self.all():
+            self.db.session.execute(stmt.execution_options(shard=shard))
+
+    def group_by_user(self, user_ids):
+        """Dict of shard: the `user_ids` whose messages it holds."""
+
+        groups = {}
+
+        for user_id in user_ids:
+            groups.setdefault(self.for_user(user_id), []).append(user_id)
+
+        return groups
+
+    def group_by_message(self, message_ids):
+        """Dict of shard: the `message_ids` it holds."""
+
+        groups = {}
+
+        for message_id in message_ids:
+            groups.setdefault(
+                self.for_message(message_id), []).append(message_id)
+
+        return groups
+
+    def scatter(self, stmts, key=None, limit=None):
+        """Run a query on several shards in parallel.
+
+        `stmts` is a statement to run on every shard, or a dict of
+        statements by shard. Each shard's rows must already be sorted by
+        `key` (a function of a row), descending; they're merged into one
+        list of up to `limit` rows in that order. ORM objects in the rows
+        are added to the current session. Without sharding this is just the
+        statement run on the main database.
+        """
+
+        if not isinstance(stmts, dict):
+            stmts = dict.fromkeys(self.all(), stmts)
+
+        if None in stmts:
+            return self.db.session.execute(stmts[None]).all()[:limit]
+
+        results = self._pool.map(
+            lambda item: self._fetch(self.engines[item[0]], item[1]),
+            stmts.items())
+
+        if key is None:
+            rows = [row for result in results for row in result]
+        else:
+            rows = heapq.merge(*results, key=key, reverse=True)
+
+        rows = list(islice(rows, limit))
+
+        if not rows:
+            return rows
+
+        Row = namedtuple('Row', rows[0]._fields, rename=True)
+
+        return [Row(*map(self._attach, row)) for row in rows]
+
+    def _fetch(self, engine, stmt):
+        with Session(engine) as session:
+            return session.execute(stmt).all()
+
+    def _attach(self, value):
+        """`value`, or if it's an ORM object, a copy in the current session."""
+
+        if isinstance(value, self.db.Model):
+            return self.db.session.merge(value, load=False)
+
+        return value
+
+    def _metadata(self, tables):
+        """Copies of `tables` for the shards.
+
+        Foreign keys are kept only between tables that share a shard: a
+        message's tags and mentions, but not likes, which live with the
+        user who gave them.
+        """
+
+        metadata = MetaData()
+        names = {table.name for table in tables}
+
+        for table in tables:
+            copy = table.to_metadata(metadata)
+
+            for constraint in list(copy.foreign_key_constraints):
+                referred = constraint.elements[0].target_fullname
+                referred = referred.split('.')[0]
+
+                if referred not in names or table.name == 'likes':
+                    copy.constraints.discard(constraint)
+
+                    for fk in constraint.elements:
+                        fk.parent.foreign_keys.discard(fk)
+                        copy.foreign_keys.discard(fk)
+
+        return metadata
+
+    def create_all(self, tables):
+        """Create `tables` on every shard."""
+
+        metadata = self._metadata(tables)
+
+        for engine in self.engines:
+            metadata.create_all(engine)
+
+    def drop_all(self, tables):
+        """Drop `tables` from every shard."""
+
+        metadata = self._metadata(tables)
+
+        for engine in self.engines:
+            metadata.drop_all(engine)
@@ -0,0 +1,224 @@
+"""Log SQL statements that take longer than a threshold.
+
+Each slow statement is logged to the `warbler.slow_queries` logger with its
+SQL, the types of its bound parameters (never their values), the route that
+issued it and its query plan. Statements are grouped by fingerprint (the
+SQL with literals, parameters and IN lists collapsed), and each fingerprint
+is logged at most once per `min_interval` seconds, with at most
+`max_per_minute` entries logged overall.
+"""
+
+import logging
+import re
+import threading
+import time
+from hashlib import sha1
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+from metrics import SLOW_QUERIES, get_endpoint
+
+logger = logging.getLogger('warbler.slow_queries')
+
+FINGERPRINT_PATTERNS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r"%\(\w+\)s|\$\d+|%s"), '?'),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), '?'),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), '(...)'),
+    (re.compile(r"\s+"), ' '),
+)
+
+
+def fingerprint(statement):
+    """Return (fingerprint id, normalized SQL) for `statement`."""
+
+    normalized = statement
+
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        normalized = pattern.sub(replacement, normalized)
+
+    normalized = normalized.strip()
+    return sha1(normalized.encode('utf-8')).hexdigest()[:12], normalized
+
+
+def describe_parameters(parameters, many):
+    """Shape of bound parameters: names/positions and types, no values."""
+
+    if many:
+        if not parameters:
+            return "[]"
+        first = describe_parameters(parameters[0], False)
+        return f"{len(parameters)} x {first}"
+
+    def shape(value):
+        if isinstance(value, (str, bytes)):
+            return f"{type(value).__name__}[{len(value)}]"
+        if isinstance(value, (list, tuple)):
+            return f"{type(value).__name__}[{len(value)}]"
+        return type(value).__name__
+
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(
+            f"{name}: {shape(value)}"
+            for name, value in parameters.items()) + '}'
+
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(shape(value) for value in parameters) + ')'
+
+    return shape(parameters)
+
+
+def get_route():
+    """URL rule and endpoint of the current request, if there is one."""
+
+    if has_request_context() and request.url_rule is not None:
+        return f"{request.method} {request.url_rule.rule} ({request.endpoint})"
+
+    return '-'
+
+
+class SlowQueryLog:
+    """Times every statement on an engine and logs the slow ones."""
+
+    def __init__(self, threshold_ms=None, analyze=False,
+                 min_interval=300, max_per_minute=10):
+        self.threshold_ms = threshold_ms
+        self.analyze = analyze
+        self.min_interval = min_interval
+        self.max_per_minute = max_per_minute
+
+        self._lock = threading.Lock()
+        self._last_logged = {}
+        self._suppressed = {}
+        self._window_start = 0
+        self._window_count = 0
+
+    def instrument(self, engine):
+        """Start timing statements run on `engine`."""
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_timer(conn, cursor, statement, params, context, many):
+            # The SQL as written, before it's made an EXECUTE of a prepared
+            # statement (see prepared_statements.py)
+            conn.info.setdefault('query_start', []).append(
+                (time.perf_counter(), statement, context))
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def check_duration(conn, cursor, statement, params, context, many):
+            start, statement, _ = conn.info['query_start'].pop()
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            if (self.threshold_ms is not None
+                    and elapsed_ms >= self.threshold_ms):
+                SLOW_QUERIES.labels(get_endpoint()).inc()
+                self.record(conn, statement, params, many, elapsed_ms)
+
+        @event.listens_for(engine, 'handle_error')
+        def forget_failed(exception_context):
+            # A statement that raised never reaches after_cursor_execute
+            conn = exception_context.connection
+            started = conn.info.get('query_start') if conn else None
+
+            if (started
+                    and started[-1][2] is exception_context.execution_context):
+                started.pop()
+
+    def reset(self):
+        """Forget which statements have been logged."""
+
+        with self._lock:
+            self._last_logged.clear()
+            self._suppressed.clear()
+            self._window_start = 0
+            self._window_count = 0
+
+    def record(self, conn, statement, parameters, many, elapsed_ms):
+        """Log a slow statement unless it was logged recently."""
+
+        fingerprint_id, normalized = fingerprint(statement)
+
+        if not self._should_log(fingerprint_id):
+            return
+
+        with self._lock:
+            suppressed = self._suppressed.pop(fingerprint_id, 0)
+
+        plan = None if many else self.explain(conn, statement, parameters)
+
+        logger.warning(
+            "slow query %.1f ms [%s] route=%s suppressed=%d\n"
+            "%s\nparams=%s\nplan:\n%s",
+            elapsed_ms,
+            fingerprint_id,
+            get_route(),
+            suppressed,
+            normalized,
+            describe_parameters(parameters, many),
+            plan or '(not available)',
+        )
+
+    def explain(self, conn, statement, parameters):
+        """Return the query plan for `statement`, or None.
+
+        Runs on the statement's own connection with a raw DBAPI cursor (so
+        it isn't timed itself), inside a savepoint so a failing EXPLAIN
+        can't abort the surrounding transaction.
+        """
+
+        dialect = conn.dialect.name
+        is_select = statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+
+        if dialect == 'postgresql':
+            if self.analyze and is_select:
+                prefix = "EXPLAIN (ANALYZE, BUFFERS) "
+            else:
+                prefix = "EXPLAIN "
+        elif dialect == 'sqlite':
+            prefix = "EXPLAIN QUERY PLAN "
+        else:
+            return None
+
+        cursor = conn.connection.cursor()
+
+        try:
+            cursor.execute("SAVEPOINT slow_query_explain")
+
+            try:
+                cursor.execute(prefix + statement, parameters)
+                rows = cursor.fetchall()
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                raise
+            finally:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+
+        except Exception as e:
+            return f"(EXPLAIN failed: {e})"
+        finally:
+            cursor.close()
+
+        return '\n'.join(
+            ' | '.join(str(column) for column in row) for row in rows)
+
+    def _should_log(self, fingerprint_id):
+        """Apply per-fingerprint and overall limits; count what's skipped."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            last = self._last_logged.get(fingerprint_id)
+
+            if now - self._window_start >= 60:
+                self._window_start = now
+                self._window_count = 0
+
+            if ((last is not None and now - last < self.min_interval)
+                    or self._window_count >= self.max_per_minute):
+                self._suppressed[fingerprint_id] = (
+                    self._suppressed.get(fingerprint_id, 0) + 1)
+                return False
+
+            self._last_logged[fingerprint_id] = now
+            self._window_count += 1
+            return True
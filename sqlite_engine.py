@@ -0,0 +1,77 @@
+"""SQLite as the main database, for small single-node deployments.
+
+With a `sqlite:///` DATABASE_URL every gunicorn worker opens the same
+database file. `instrument()` sets each new connection up for that:
+
+- WAL journaling, so readers never block each other or the writer, with
+  `synchronous=NORMAL` (durable at checkpoints, safe against corruption).
+- A busy timeout, so concurrent writers wait for the lock instead of
+  failing straight away, and a larger page cache and memory-mapped I/O.
+- Foreign keys on, for the `ondelete="cascade"` the models rely on.
+- SQLAlchemy, not the sqlite3 module, begins transactions, so SAVEPOINTs
+  (nested transactions, and the test suite's rollbacks) work. A connection
+  with the `sqlite_begin='IMMEDIATE'` execution option takes the write
+  lock when it begins: a deferred transaction that reads and then writes
+  fails straight away, without waiting, if another connection wrote since
+  its read began.
+- Connections opened before a fork (e.g. with `gunicorn --preload`) are
+  replaced instead of being shared between processes.
+"""
+
+import os
+
+from sqlalchemy import event, exc
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'foreign_keys': 'ON',
+    'busy_timeout': 5000,
+    # Negative sizes are in KiB: 64 MB per connection
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+
+def is_sqlite(url):
+    return url.startswith('sqlite')
+
+
+def engine_options(options):
+    """`options` for create_engine(), adjusted for SQLite."""
+
+    connect_args = dict(options.get('connect_args', {}))
+    # Pooled connections move between a worker's threads
+    connect_args['check_same_thread'] = False
+
+    return {**options, 'connect_args': connect_args}
+
+
+def instrument(engine):
+    """Set up every connection `engine` opens; see the module docstring."""
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_conn, record):
+        # Autocommit at the driver level; begin_transaction emits BEGIN
+        dbapi_conn.isolation_level = None
+
+        cursor = dbapi_conn.cursor()
+
+        for name, value in PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+
+        cursor.close()
+        record.info['pid'] = os.getpid()
+
+    @event.listens_for(engine, 'begin')
+    def begin_transaction(conn):
+        mode = conn.get_execution_options().get('sqlite_begin', 'DEFERRED')
+        conn.exec_driver_sql(f"BEGIN {mode}")
+
+    @event.listens_for(engine, 'checkout')
+    def check_pid(dbapi_conn, record, proxy):
+        if record.info['pid'] != os.getpid():
+            record.dbapi_connection = proxy.dbapi_connection = None
+            raise exc.DisconnectionError(
+                "Connection belongs to another process")
@@ -0,0 +1,46 @@
+// Say whether the username and email typed into a signup or profile form
+// are free, checking with the server once typing pauses.
+
+(function () {
+  const DELAY = 300;
+
+  for (const field of ['username', 'email']) {
+    const input = document.getElementById(field);
+
+    if (!input) continue;
+
+    const initial = input.value;
+    const note = document.createElement('small');
+    note.className = 'form-text d-block mb-2';
+    input.after(note);
+
+    let timer = null;
+    let latest = null;
+
+    input.addEventListener('input', () => {
+      clearTimeout(timer);
+      note.textContent = '';
+
+      const value = input.value.trim();
+
+      if (!value || value === initial) return;
+
+      timer = setTimeout(async () => {
+        latest = value;
+
+        const params = new URLSearchParams({ [field]: value });
+        const resp = await fetch(`/api/users/available?${params}`);
+
+        if (!resp.ok || latest !== value) return;
+
+        const data = await resp.json();
+
+        note.textContent = data.available
+          ? `${value} is available`
+          : `${value} is already taken`;
+        note.classList.toggle('text-success', data.available);
+        note.classList.toggle('text-danger', !data.available);
+      }, DELAY);
+    });
+  }
+})();
@@ -0,0 +1,82 @@
+// Show a "N new warbles" banner when messages newer than the ones on the
+// page are posted; clicking it reloads the timeline. Listens to the
+// timeline's server-sent events, or long-polls where EventSource isn't
+// available.
+
+(function () {
+  const banner = document.getElementById('new-warbles');
+
+  if (!banner) return;
+
+  let since = Number(banner.dataset.since);
+  const newIds = new Set();
+
+  function update() {
+    const total = newIds.size;
+
+    banner.textContent =
+      total === 1 ? '1 new warble' : `${total} new warbles`;
+    banner.classList.toggle('d-none', total === 0);
+  }
+
+  function listen() {
+    const source = new EventSource('/api/timeline/stream');
+
+    source.addEventListener('message', event => {
+      const data = JSON.parse(event.data);
+
+      if (data.id > since) {
+        newIds.add(data.id);
+        update();
+      }
+    });
+
+    source.addEventListener('delete', event => {
+      newIds.delete(JSON.parse(event.data).id);
+      update();
+    });
+
+    // EventSource gives up after an error response, e.g. a 503 when the
+    // server has no room for another stream: try again later
+    source.addEventListener('error', () => {
+      if (source.readyState === EventSource.CLOSED) {
+        setTimeout(listen, 30000);
+      }
+    });
+  }
+
+  function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+  }
+
+  async function poll() {
+    try {
+      const resp = await fetch(`/api/timeline/new?since=${since}&wait=25`);
+
+      if (resp.status === 503) {
+        const retryAfter = Number(resp.headers.get('Retry-After')) || 30;
+
+        await sleep(retryAfter * 1000);
+        return poll();
+      }
+
+      if (!resp.ok) return;
+
+      const data = await resp.json();
+
+      data.ids.forEach(id => newIds.add(id));
+      since = data.cursor;
+      update();
+    } catch (err) {
+      await sleep(5000);
+    }
+
+    poll();
+  }
+
+  if (window.EventSource) {
+    listen();
+  } else {
+    poll();
+  }
+})();
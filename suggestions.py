@@ -0,0 +1,340 @@
+"""Precomputed "who to follow" suggestions.
+
+A user's candidates are friends of friends: people followed by the people
+they follow, who they don't follow yet. Each is ranked by its mutual count
+(how many of the user's follows follow it) times an activity weight that
+favours people who have posted recently. The top SUGGESTIONS_PER_USER for
+every user are stored in `follow_suggestions`, so the home page reads them
+with one range scan of an index.
+
+`rebuild()` recomputes the whole table (`flask rebuild-suggestions`).
+Between rebuilds, `follow_added()`, `follow_removed()` and `user_deleted()`
+only queue the change in `suggestion_updates`, so a follow costs its
+request one insert however many followers the user has. A
+`SuggestionUpdater` thread in each worker applies the queue: it recomputes
+the suggestions of each user who followed or unfollowed, and recounts the
+followed user as a suggestion to each of their followers. Each user keeps
+at most SUGGESTIONS_PER_USER; a suggestion dropped to make room isn't
+brought back until the next rebuild. Activity weights are refreshed when a
+row changes and on each rebuild.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, func, insert, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from models import db, Follow, FollowSuggestion, Message, SuggestionUpdate
+
+logger = logging.getLogger('warbler.suggestions')
+
+SUGGESTIONS_PER_USER = 50
+
+# Queued follows applied per transaction, and seconds between checks of
+# the queue when no follow in this worker wakes the updater
+UPDATE_BATCH = 100
+UPDATE_INTERVAL = 30
+
+# Messages in the last ACTIVITY_DAYS raise a score by up to ACTIVITY_WEIGHT
+# times, with ACTIVITY_CAP or more messages counting as fully active
+ACTIVITY_DAYS = 30
+ACTIVITY_CAP = 50
+ACTIVITY_WEIGHT = 1.0
+
+COLUMNS = ['user_id', 'suggested_user_id', 'mutual_count', 'activity',
+           'score']
+
+
+def recent_activity():
+    """Subquery of (user_id, recent) message counts over ACTIVITY_DAYS."""
+
+    since = datetime.utcnow() - timedelta(days=ACTIVITY_DAYS)
+
+    return (select(Message.user_id, func.count().label('recent'))
+            .where(Message.timestamp >= since)
+            .group_by(Message.user_id)
+            .subquery())
+
+
+def activity_weight(recent):
+    """Score multiplier for a user with `recent` messages (may be NULL)."""
+
+    recent = func.coalesce(recent, 0)
+    capped = case((recent > ACTIVITY_CAP, ACTIVITY_CAP), else_=recent)
+
+    return 1.0 + capped * (ACTIVITY_WEIGHT / ACTIVITY_CAP)
+
+
+def not_following(user_id, other_id):
+    """Condition that `user_id` doesn't follow `other_id` (columns)."""
+
+    follow = aliased(Follow)
+
+    return ~(select(follow)
+             .where(follow.user_following_id == user_id,
+                    follow.user_being_followed_id == other_id)
+             .exists())
+
+
+def friends_of_friends():
+    """Select of (user_id, suggested_user_id) for every path of length 2.
+
+    Returns the select with the two follows aliases it joins, so callers
+    can narrow it down.
+    """
+
+    mine = aliased(Follow)
+    theirs = aliased(Follow)
+
+    stmt = (select(mine.user_following_id.label('user_id'),
+                   theirs.user_being_followed_id.label('suggested_user_id'))
+            .join(theirs,
+                  theirs.user_following_id == mine.user_being_followed_id)
+            .where(theirs.user_being_followed_id != mine.user_following_id,
+                   not_following(mine.user_following_id,
+                                 theirs.user_being_followed_id)))
+
+    return stmt, mine, theirs
+
+
+def rebuild(user_ids=None):
+    """Replace the suggestions of `user_ids` (default: every user's); the
+    caller commits.
+
+    Rebuilding every user's also drops the updates queued so far. Returns
+    the number of suggestions written.
+    """
+
+    pairs, mine, theirs = friends_of_friends()
+    old = delete(FollowSuggestion)
+
+    if user_ids is not None:
+        pairs = pairs.where(mine.user_following_id.in_(user_ids))
+        old = old.where(FollowSuggestion.user_id.in_(user_ids))
+    else:
+        queued = db.session.execute(
+            select(func.max(SuggestionUpdate.id))).scalar()
+
+        if queued is not None:
+            db.session.execute(
+                delete(SuggestionUpdate)
+                .where(SuggestionUpdate.id <= queued))
+
+    db.session.execute(old.execution_options(synchronize_session=False))
+
+    return insert_top(pairs, mine, theirs)
+
+
+def insert_top(pairs, mine, theirs):
+    """Insert the top SUGGESTIONS_PER_USER of each user among `pairs`, a
+    friends_of_friends() select. Returns the number inserted."""
+
+    pairs = (pairs
+             .add_columns(func.count().label('mutual_count'))
+             .group_by(mine.user_following_id, theirs.user_being_followed_id)
+             .subquery())
+
+    activity = recent_activity()
+    weight = activity_weight(activity.c.recent)
+    score = pairs.c.mutual_count * weight
+
+    ranked = (select(
+        pairs.c.user_id,
+        pairs.c.suggested_user_id,
+        pairs.c.mutual_count,
+        weight.label('activity'),
+        score.label('score'),
+        func.row_number().over(
+            partition_by=pairs.c.user_id,
+            order_by=(score.desc(), pairs.c.suggested_user_id),
+        ).label('rank'))
+        .outerjoin(activity, activity.c.user_id == pairs.c.suggested_user_id)
+        .subquery())
+
+    result = db.session.execute(
+        insert(FollowSuggestion).from_select(
+            COLUMNS,
+            select(*(ranked.c[name] for name in COLUMNS))
+            .where(ranked.c.rank <= SUGGESTIONS_PER_USER)))
+
+    return result.rowcount
+
+
+def recount(user_id, suggested_id):
+    """Recount `suggested_id` as a suggestion to each follower of
+    `user_id`, keeping each follower's top SUGGESTIONS_PER_USER."""
+
+    followers = (select(Follow.user_following_id)
+                 .where(Follow.user_being_followed_id == user_id))
+
+    db.session.execute(
+        delete(FollowSuggestion)
+        .where(FollowSuggestion.suggested_user_id == suggested_id,
+               FollowSuggestion.user_id.in_(followers))
+        .execution_options(synchronize_session=False))
+
+    pairs, mine, theirs = friends_of_friends()
+    insert_top(
+        pairs.where(mine.user_following_id.in_(followers),
+                    theirs.user_being_followed_id == suggested_id),
+        mine, theirs)
+
+    trim(followers)
+
+
+def trim(user_ids):
+    """Drop all but the top SUGGESTIONS_PER_USER of each of `user_ids`."""
+
+    ranked = (select(
+        FollowSuggestion.user_id,
+        FollowSuggestion.suggested_user_id,
+        func.row_number().over(
+            partition_by=FollowSuggestion.user_id,
+            order_by=(FollowSuggestion.score.desc(),
+                      FollowSuggestion.suggested_user_id),
+        ).label('rank'))
+        .where(FollowSuggestion.user_id.in_(user_ids))
+        .subquery())
+
+    key = tuple_(FollowSuggestion.user_id, FollowSuggestion.suggested_user_id)
+
+    db.session.execute(
+        delete(FollowSuggestion)
+        .where(key.in_(
+            select(ranked.c.user_id, ranked.c.suggested_user_id)
+            .where(ranked.c.rank > SUGGESTIONS_PER_USER)))
+        .execution_options(synchronize_session=False))
+
+
+def follow_added(user_id, followed_id):
+    """Queue the suggestion updates for a new follow; the caller commits.
+
+    Stops suggesting `followed_id` to the user straight away.
+    """
+
+    db.session.execute(
+        delete(FollowSuggestion)
+        .where(FollowSuggestion.user_id == user_id,
+               FollowSuggestion.suggested_user_id == followed_id)
+        .execution_options(synchronize_session=False))
+
+    db.session.add(SuggestionUpdate(user_id=user_id, followed_id=followed_id))
+
+
+def follow_removed(user_id, followed_id):
+    """Queue the suggestion updates for an unfollow; the caller commits."""
+
+    db.session.add(SuggestionUpdate(user_id=user_id, followed_id=followed_id))
+
+
+def user_deleted(user_id):
+    """Queue updates for the followers of a user about to be deleted; the
+    caller deletes the user and commits.
+
+    Their own suggestions, and everyone's suggestions of them, go with
+    them; each follower's are recomputed without them.
+    """
+
+    db.session.execute(
+        insert(SuggestionUpdate).from_select(
+            ['user_id', 'followed_id'],
+            select(Follow.user_following_id, Follow.user_being_followed_id)
+            .where(Follow.user_being_followed_id == user_id)
+            .order_by(Follow.user_following_id)))
+
+
+def apply_updates(limit=UPDATE_BATCH):
+    """Apply up to `limit` queued updates, oldest first, and commit.
+
+    Returns how many were applied, or None if another worker was updating
+    the same suggestions at the same time (they're left queued).
+    """
+
+    # Reads and then writes: take SQLite's write lock first
+    db.session.connection(execution_options={'sqlite_begin': 'IMMEDIATE'})
+
+    updates = db.session.execute(
+        select(SuggestionUpdate)
+        .order_by(SuggestionUpdate.id)
+        .limit(limit)
+        # Postgres: leave updates another worker is applying to it
+        .with_for_update(skip_locked=True)).scalars().all()
+
+    try:
+        if updates:
+            rebuild(list({update.user_id for update in updates}))
+
+            for user_id, followed_id in {
+                    (update.user_id, update.followed_id)
+                    for update in updates}:
+                recount(user_id, followed_id)
+
+            db.session.execute(
+                delete(SuggestionUpdate)
+                .where(SuggestionUpdate.id.in_(
+                    [update.id for update in updates])))
+
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+
+    return len(updates)
+
+
+class SuggestionUpdater:
+    """Applies queued suggestion updates in a background thread."""
+
+    def __init__(self, interval=UPDATE_INTERVAL):
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._app = None
+        self._wake = threading.Event()
+
+    def init_app(self, app):
+        """Start the thread in each process the first time it's woken."""
+
+        self._app = app
+
+    def start(self, app):
+        """Apply updates in a background thread of this process.
+
+        Does nothing if already started in this process.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._app = app
+            self._wake = threading.Event()
+
+        threading.Thread(
+            target=self._run, name='suggestions', daemon=True).start()
+
+    def wake(self):
+        """Apply the queued updates now, rather than at the next interval."""
+
+        if self._app is not None and self._pid != os.getpid():
+            self.start(self._app)
+
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            try:
+                with self._app.app_context():
+                    while apply_updates() == UPDATE_BATCH:
+                        pass
+            except Exception:
+                logger.exception("Can't update suggestions")
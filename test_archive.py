@@ -0,0 +1,139 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+from testing import DBTestCase, requires_postgres
+from app import app, CURR_USER_KEY
+from archive import (
+    add_months, archive_messages, ensure_partitions, get_archive_months,
+    get_archived_messages,
+)
+from models import db, User, Message, MessageArchive
+
+
+class ArchiveTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        old1 = Message(text="old one", user_id=u1.id,
+                       timestamp=datetime(2020, 1, 5))
+        old2 = Message(text="old two", user_id=u1.id,
+                       timestamp=datetime(2020, 1, 20))
+        older = Message(text="older", user_id=u1.id,
+                        timestamp=datetime(2019, 12, 31))
+        new = Message(text="new", user_id=u1.id,
+                      timestamp=datetime(2024, 6, 1))
+        db.session.add_all([old1, old2, older, new])
+        db.session.commit()
+
+        u2.likes.append(old1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.new_id = new.id
+
+    def test_add_months(self):
+        """Tests month arithmetic across year ends"""
+        self.assertEqual(add_months(date(2020, 11, 1), 3), date(2021, 2, 1))
+        self.assertEqual(add_months(date(2020, 1, 1), -1), date(2019, 12, 1))
+
+    def test_archive_messages(self):
+        """Tests that old messages move to the archive by month"""
+        count = archive_messages(datetime(2021, 1, 1))
+        db.session.commit()
+
+        self.assertEqual(count, 3)
+        self.assertEqual(
+            [m.id for m in Message.query.all()], [self.new_id])
+
+        months = get_archive_months(self.u1_id)
+        self.assertEqual(
+            [(row.month, row.message_count) for row in months],
+            [(date(2020, 1, 1), 2), (date(2019, 12, 1), 1)])
+
+        messages = get_archived_messages(self.u1_id, date(2020, 1, 1))
+        self.assertEqual([m.text for m in messages], ["old two", "old one"])
+        self.assertEqual(messages[1].likes, 1)
+
+        user = db.session.get(User, self.u1_id)
+        self.assertEqual(user.get_stats().messages, 4)
+
+    def test_archive_in_batches(self):
+        """Tests that months split across batches are archived whole"""
+        u2 = User.query.filter_by(username='u2').one()
+        db.session.add(Message(text="u2 old", user_id=u2.id,
+                               timestamp=datetime(2020, 1, 10)))
+        db.session.commit()
+
+        count = archive_messages(datetime(2021, 1, 1), batch_size=2)
+        db.session.commit()
+
+        self.assertEqual(count, 4)
+        self.assertEqual(
+            [m.id for m in Message.query.all()], [self.new_id])
+
+        messages = get_archived_messages(self.u1_id, date(2020, 1, 1))
+        self.assertEqual([m.text for m in messages], ["old two", "old one"])
+        self.assertEqual(messages[1].likes, 1)
+        self.assertEqual(
+            [m.text for m in get_archived_messages(u2.id, date(2020, 1, 1))],
+            ["u2 old"])
+
+    def test_archive_merges_months(self):
+        """Tests that archiving more of a month adds to its archive row"""
+        archive_messages(datetime(2020, 1, 10))
+        archive_messages(datetime(2021, 1, 1))
+        db.session.commit()
+
+        archived = db.session.get(MessageArchive, (self.u1_id, date(2020, 1, 1)))
+        self.assertEqual(archived.message_count, 2)
+
+    @requires_postgres
+    def test_partitions_created(self):
+        """Tests that monthly partitions are created ahead of the cutoff"""
+        archive_messages(datetime(2021, 1, 1), months_ahead=2)
+
+        partitions = db.session.execute(text(
+            "SELECT relname FROM pg_inherits "
+            "JOIN pg_class ON pg_class.oid = inhrelid "
+            "WHERE inhparent = 'message_archive'::regclass")).scalars().all()
+
+        self.assertIn('message_archive_2019_12', partitions)
+        self.assertIn('message_archive_2021_03', partitions)
+        self.assertNotIn('message_archive_2021_04', partitions)
+
+        self.assertEqual(
+            ensure_partitions(date(2021, 1, 1), date(2021, 3, 1)), [])
+
+    def test_show_archive(self):
+        """Tests the archive page lists months and shows one on demand"""
+        archive_messages(datetime(2021, 1, 1))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}/archive')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('January 2020 (2)', html)
+            self.assertNotIn('old one', html)
+
+            resp = c.get(f'/users/{self.u1_id}/archive?month=2020-01')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('old one', html)
+            self.assertNotIn('<p>older</p>', html)
@@ -0,0 +1,81 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import testing  # noqa: F401
+from app import app
+from assets import build_assets
+
+
+class AssetPipelineTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.static_folder = app.static_folder
+        cls.tmp_dir = tempfile.mkdtemp()
+
+        app.static_folder = os.path.join(cls.tmp_dir, 'static')
+        shutil.copytree(cls.static_folder, app.static_folder)
+
+        cls.manifest = build_assets(app.static_folder)
+
+    @classmethod
+    def tearDownClass(cls):
+        app.static_folder = cls.static_folder
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_build_rewrites_css_urls(self):
+        """Tests that stylesheets point at fingerprinted images"""
+        css_path = os.path.join(
+            app.static_folder, 'dist', self.manifest['stylesheets/style.css'])
+
+        with open(css_path) as f:
+            css = f.read()
+
+        self.assertIn(
+            f"/assets/{self.manifest['images/nav-bg.png']}", css)
+        self.assertNotIn('/static/images/', css)
+
+    def test_templates_use_manifest(self):
+        """Tests that pages link to fingerprinted assets"""
+        with app.test_client() as c:
+            html = c.get('/').get_data(as_text=True)
+
+            self.assertIn(
+                f"/assets/{self.manifest['stylesheets/style.css']}", html)
+
+    def test_serve_precompressed(self):
+        """Tests that the encoding matching Accept-Encoding is served"""
+        url = f"/assets/{self.manifest['stylesheets/style.css']}"
+
+        with app.test_client() as c:
+            resp = c.get(url, headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_encoding, 'gzip')
+            self.assertEqual(resp.mimetype, 'text/css')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn(b'.navbar', gzip.decompress(resp.data))
+
+            resp = c.get(url, headers={'Accept-Encoding': 'identity'})
+
+            self.assertIsNone(resp.content_encoding)
+            self.assertIn(b'.navbar', resp.data)
+
+    def test_serve_webp(self):
+        """Tests that WebP images are served to clients that accept them"""
+        url = f"/assets/{self.manifest['images/warbler-hero.jpg']}"
+
+        with app.test_client() as c:
+            resp = c.get(url, headers={'Accept': 'image/webp,*/*'})
+            self.assertEqual(resp.mimetype, 'image/webp')
+
+            resp = c.get(url, headers={'Accept': '*/*'})
+            self.assertEqual(resp.mimetype, 'image/jpeg')
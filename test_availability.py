@@ -0,0 +1,203 @@
+"""Username and email availability tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from testing import DBTestCase
+from app import app, CURR_USER_KEY
+from availability import BloomFilter, TakenNames, USERS_TOPIC
+from events import Broker, LocalChannel
+from models import db, User
+
+
+class BloomFilterTestCase(TestCase):
+    def test_membership(self):
+        """Tests no false negatives and about the configured error rate"""
+        bloom = BloomFilter(10_000, error_rate=0.01)
+        names = [f"user{i}" for i in range(10_000)]
+
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+
+        false_positives = sum(
+            f"other{i}" in bloom for i in range(10_000))
+        self.assertLess(false_positives, 200)
+
+
+class TakenNamesTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("alice", "alice@email.com", "password", None)
+        db.session.add(u1)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.broker = Broker(LocalChannel())
+        self.names = TakenNames(self.broker)
+        self.names._subscription = self.broker.subscribe(
+            [USERS_TOPIC], maxsize=None)
+
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.record)
+        super().tearDown()
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_is_taken(self):
+        """Tests free names are answered without the database"""
+        self.assertFalse(self.names.ready)
+        self.assertTrue(self.names.is_taken('username', 'alice'))
+        self.assertEqual(len(self.statements), 1)
+
+        self.names.load()
+        self.assertTrue(self.names.ready)
+        self.statements.clear()
+
+        self.assertFalse(self.names.is_taken('username', 'bob'))
+        self.assertFalse(self.names.is_taken('email', 'bob@email.com'))
+        self.assertEqual(self.statements, [])
+
+        self.assertTrue(self.names.is_taken('username', 'alice'))
+        self.assertTrue(self.names.is_taken('email', 'alice@email.com'))
+        self.assertFalse(self.names.is_taken(
+            'username', 'alice', exclude_user_id=self.u1_id))
+        self.assertEqual(len(self.statements), 3)
+
+    def test_add(self):
+        """Tests announced names reach the filters"""
+        self.names.load()
+
+        bob = User.signup("bob", "bob@email.com", "password", None)
+        db.session.add(bob)
+        db.session.commit()
+
+        # Not announced yet, so the filter hasn't seen it
+        self.assertFalse(self.names.is_taken('username', 'bob'))
+
+        self.names.add("bob", "bob@email.com")
+
+        self.assertTrue(self.names.is_taken('username', 'bob'))
+        self.assertTrue(self.names.is_taken('email', 'bob@email.com'))
+
+    def test_reload_when_full(self):
+        """Tests the filters are rebuilt once over capacity"""
+        self.names.min_capacity = 2
+        self.names.load()
+
+        with patch.object(self.names, 'reload') as reload:
+            self.names.add("bob", "bob@email.com")
+            self.names.sync()
+            reload.assert_not_called()
+
+            self.names.add("carol", "carol@email.com")
+            self.names.sync()
+            reload.assert_called_once()
+
+
+    def test_starts_on_first_check(self):
+        """Tests names set up with the app start by themselves"""
+        self.names.init_app(app)
+
+        with patch('availability.threading.Thread') as Thread:
+            self.names.is_taken('username', 'bob')
+            self.names.is_taken('username', 'carol')
+
+        # One thread for events and one building the filters, once
+        self.assertEqual(Thread.call_count, 2)
+
+    def test_events_drained_without_checks(self):
+        """Tests announced names are added with no checks to sync them"""
+        with patch.object(self.names, 'reload'):
+            self.names.start(app)
+
+        self.names.load()
+        self.names.add("bob", "bob@email.com")
+
+        for _ in range(100):
+            if 'bob' in self.names._filters['username']:
+                break
+            time.sleep(0.01)
+
+        self.assertIn('bob', self.names._filters['username'])
+        self.assertIsNone(self.names._subscription.get(0))
+
+
+class AvailabilityViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("alice", "alice@email.com", "password", None)
+        db.session.add(u1)
+        db.session.commit()
+        self.u1_id = u1.id
+
+    def test_check_available(self):
+        """Tests the availability endpoint"""
+        with app.test_client() as c:
+            data = c.get('/api/users/available?username=alice').get_json()
+            self.assertEqual(
+                data,
+                {'field': 'username', 'value': 'alice', 'available': False})
+
+            resp = c.get('/api/users/available')
+            self.assertEqual(resp.status_code, 400)
+
+            # Emails only for logged-in users
+            resp = c.get('/api/users/available?email=alice@email.com')
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            data = c.get('/api/users/available?username=alice').json
+            self.assertTrue(data['available'])
+
+            data = c.get('/api/users/available?email=new@email.com').json
+            self.assertTrue(data['available'])
+
+    def test_signup_taken_skips_hashing(self):
+        """Tests a taken name is rejected before the password is hashed"""
+        with patch.object(User, 'signup') as signup:
+            with app.test_client() as c:
+                resp = c.post('/signup', data={
+                    'username': 'alice',
+                    'email': 'other@email.com',
+                    'password': 'password',
+                })
+
+        self.assertIn("Username or email already taken", resp.text)
+        signup.assert_not_called()
+
+    def test_edit_profile_taken_skips_hashing(self):
+        """Tests profile edits check names before the password"""
+        bob = User.signup("bob", "bob@email.com", "password", None)
+        db.session.add(bob)
+        db.session.commit()
+
+        with patch.object(User, 'authenticate') as authenticate:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = bob.id
+
+                resp = c.post('/users/profile', data={
+                    'username': 'alice',
+                    'email': 'bob@email.com',
+                    'password': 'password',
+                })
+
+        self.assertIn("Username or email already taken!", resp.text)
+        authenticate.assert_not_called()
@@ -0,0 +1,145 @@
+"""Traffic capture and replay tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_capture.py
+
+import os
+import tempfile
+
+from testing import DBTestCase
+from app import app, request_capture
+from models import db, Message, User
+import capture
+import replay
+
+
+class CaptureTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.add(u1)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        self.dir = tempfile.TemporaryDirectory()
+        request_capture.path = os.path.join(self.dir.name, 'capture.jsonl')
+
+    def tearDown(self):
+        request_capture.close()
+        request_capture.path = None
+        self.dir.cleanup()
+
+        super().tearDown()
+
+    def test_capture(self):
+        """Tests requests are captured without their private values"""
+        with app.test_client() as c:
+            c.post('/login', data={'username': 'u1', 'password': 'password'})
+            c.post('/messages/new', data={'text': "a secret warble"})
+            c.get('/messages/search', query_string={'q': 'secret'})
+            c.get(f'/users/{self.u1_id}')
+            c.get('/static/stylesheets/style.css')
+
+        entries = capture.read(request_capture.path)
+
+        with open(request_capture.path) as f:
+            text = f.read()
+
+        # Field names, but never values
+        self.assertNotIn('secret', text)
+        self.assertEqual(text.count('password'), 1)
+
+        self.assertEqual(
+            [(entry['m'], entry['r'], entry['u']) for entry in entries],
+            [
+                ('POST', '/login', self.u1_id),
+                ('POST', '/messages/new', self.u1_id),
+                ('GET', '/messages/search', self.u1_id),
+                ('GET', '/users/<int:user_id>', self.u1_id),
+            ])
+
+        login, post, search, profile = entries
+        self.assertEqual(login['f'], {'username': 2, 'password': 8})
+        self.assertEqual(login['s'], 302)
+        self.assertEqual(post['f'], {'text': 15})
+        self.assertEqual(search['q'], {'q': 6})
+        self.assertEqual(profile['a'], {'user_id': self.u1_id})
+        self.assertGreater(profile['d'], 0)
+
+    def test_sample_by_user(self):
+        """Tests sampling keeps or drops all of a user's requests"""
+        request_capture.sample = 0.5
+
+        try:
+            picked = [request_capture.should_capture(i) for i in range(200)]
+            again = [request_capture.should_capture(i) for i in range(200)]
+        finally:
+            request_capture.sample = 1.0
+
+        self.assertEqual(picked, again)
+        self.assertTrue(40 < sum(picked) < 160)
+
+
+class ReplayTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.add_all([u1, u2])
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u2.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m1_id = m1.id
+
+        self.seed = replay.Seed()
+        self.signer = replay.Signer(app.secret_key)
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        super().tearDown()
+
+    def test_build_request(self):
+        """Tests a replayed request is signed in as its user, with CSRF"""
+        entry = {
+            't': 0, 'm': 'POST',
+            'r': '/messages/<int:message_id>/like-toggle',
+            'a': {'message_id': self.m1_id}, 'q': {},
+            'f': {'origin_url': '/'}, 'u': self.u1_id, 's': 302, 'd': 1.0,
+        }
+
+        method, path, body, headers = replay.build_request(
+            entry, self.seed, self.signer, 0)
+
+        self.assertEqual(path, f'/messages/{self.m1_id}/like-toggle')
+
+        cookie = headers.pop('Cookie').removeprefix('session=')
+
+        with app.test_client() as c:
+            c.set_cookie('session', cookie)
+            resp = c.open(path, method=method, data=body, headers=headers)
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(
+            db.session.get(User, self.u1_id).get_stats().likes, 1)
+
+    def test_fill(self):
+        """Tests captured lengths are filled in the same way every time"""
+        entry = {'u': 1}
+        params = {'text': 20, 'username': 8, 'password': 8, 'since': '5'}
+
+        filled = dict(replay.fill(params, self.seed, entry, 3))
+
+        self.assertEqual(len(filled['text']), 20)
+        self.assertEqual(filled['username'], self.seed.usernames[0])
+        self.assertEqual(filled['password'], 'password')
+        self.assertEqual(filled['since'], '5')
+        self.assertEqual(
+            dict(replay.fill(params, self.seed, entry, 3)), filled)
@@ -0,0 +1,139 @@
+"""Hashtag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_entities.py
+
+from unittest import TestCase
+
+from sqlalchemy import func, select
+
+from testing import DBTestCase, DATABASE_BACKEND
+from app import app, CURR_USER_KEY
+from entities import backfill, extract_mentions, extract_tags, linkify
+from models import db, Message, MessageTag, Mention, User
+
+
+class ParseTestCase(TestCase):
+    def test_extract_tags(self):
+        """Tests that hashtags are found, lower-cased and de-duplicated"""
+        self.assertEqual(
+            extract_tags("#Python and #python, not a#b or ##x, but #x_1!"),
+            ['python', 'x_1'])
+
+    def test_extract_mentions(self):
+        """Tests that mentions are found but email addresses aren't"""
+        self.assertEqual(
+            extract_mentions("hi @Alice and @bob, mail me@example.com"),
+            ['alice', 'bob'])
+
+    def test_linkify(self):
+        """Tests that text is escaped and tags and mentions are linked"""
+        html = linkify("<b>it's</b> #Fun with @bob")
+
+        self.assertIn('&lt;b&gt;it&#39;s&lt;/b&gt;', html)
+        self.assertIn('<a href="/tags/fun">#Fun</a>', html)
+        self.assertIn('<a href="/users?q=bob">@bob</a>', html)
+
+
+class EntityViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def test_add_message_indexes(self):
+        """Tests that tags and mentions are stored when a message is added"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post('/messages/new', data={
+                'text': 'Hello @U2 and @nobody #Warbler #warbler'})
+
+        msg = Message.query.one()
+
+        self.assertEqual(
+            [t.tag for t in MessageTag.query.all()], ['warbler'])
+        self.assertEqual(
+            [(m.user_id, m.message_id) for m in Mention.query.all()],
+            [(self.u2_id, msg.id)])
+
+    def test_mentions_indexed(self):
+        """Tests mentioned usernames are looked up with an index"""
+        conn = db.session.connection()
+        sql = str(
+            select(User.id)
+            .where(func.lower(User.username).in_(['u2']))
+            .compile(conn, compile_kwargs={'literal_binds': True}))
+
+        if DATABASE_BACKEND == 'postgresql':
+            # Too few users for the planner to choose the index otherwise
+            conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            plan = conn.exec_driver_sql("EXPLAIN " + sql).scalars().all()
+        else:
+            plan = [
+                row[-1] for row in
+                conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+
+        self.assertIn('ix_users_username_lower', '\n'.join(plan))
+
+    def test_show_tag(self):
+        """Tests the tag page with cursor pagination"""
+        msgs = [Message(text=f"post {i} #busy", user_id=self.u1_id)
+                for i in range(25)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        list(backfill(batch_size=10))
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get('/tags/Busy').get_data(as_text=True)
+
+            self.assertIn('post 24 ', html)
+            self.assertNotIn('post 4 ', html)
+            self.assertIn(f'/tags/busy?before={msgs[5].id}', html)
+
+            html = c.get(f'/tags/busy?before={msgs[5].id}').get_data(
+                as_text=True)
+
+            self.assertIn('post 4 ', html)
+            self.assertNotIn('post 5 ', html)
+            self.assertNotIn('Older warbles', html)
+
+    def test_show_mentions(self):
+        """Tests the mentions page lists messages mentioning the user"""
+        db.session.add_all([
+            Message(text="thanks @u2", user_id=self.u1_id),
+            Message(text="thanks nobody", user_id=self.u1_id),
+        ])
+        db.session.commit()
+        list(backfill())
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f'/users/{self.u2_id}/mentions').get_data(
+                as_text=True)
+
+            self.assertIn('>@u2</a>', html)
+            self.assertNotIn('thanks nobody', html)
+
+    def test_backfill_is_repeatable(self):
+        """Tests that running the backfill twice doesn't duplicate rows"""
+        db.session.add(Message(text="#again", user_id=self.u1_id))
+        db.session.commit()
+
+        self.assertEqual(list(backfill()), [1])
+        self.assertEqual(list(backfill()), [1])
+        self.assertEqual(MessageTag.query.count(), 1)
@@ -0,0 +1,233 @@
+"""Timeline event tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_events.py
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import g
+
+from testing import DBTestCase, requires_postgres
+from app import app, broker, CURR_USER_KEY
+from events import Broker, LocalChannel, PostgresChannel, SQLiteChannel
+from models import db, Message, User
+
+
+class BrokerTestCase(TestCase):
+    def setUp(self):
+        self.broker = Broker(LocalChannel())
+
+    def test_fan_out_by_topic(self):
+        """Tests that events reach every subscriber of their topic only"""
+        a = self.broker.subscribe([1, 2])
+        b = self.broker.subscribe([2])
+
+        self.broker.publish(2, {'id': 10})
+        self.broker.publish(1, {'id': 11})
+
+        self.assertEqual(a.get(0), {'id': 10})
+        self.assertEqual(a.get(0), {'id': 11})
+        self.assertEqual(b.get(0), {'id': 10})
+        self.assertIsNone(b.get(0))
+
+    def test_slow_subscriber_drops_oldest(self):
+        """Tests that a full queue keeps only the newest events"""
+        sub = self.broker.subscribe([1], maxsize=2)
+
+        for i in range(3):
+            self.broker.publish(1, {'id': i})
+
+        self.assertEqual([sub.get(0), sub.get(0)], [{'id': 1}, {'id': 2}])
+
+    def test_close(self):
+        """Tests that closed subscriptions stop receiving events"""
+        sub = self.broker.subscribe([1, 2])
+        self.assertEqual(self.broker.subscriber_count(), 1)
+
+        sub.close()
+        self.broker.publish(1, {'id': 1})
+
+        self.assertEqual(self.broker.subscriber_count(), 0)
+        self.assertIsNone(sub.get(0))
+
+
+@requires_postgres
+class PostgresChannelTestCase(TestCase):
+    def test_notify_reaches_listener(self):
+        """Tests that events published with NOTIFY are delivered"""
+        channel = PostgresChannel(db.engine, name='warbler_events_test')
+        pg_broker = Broker(channel)
+
+        try:
+            sub = pg_broker.subscribe([1])
+            self.assertTrue(channel.listening.wait(5))
+
+            pg_broker.publish(1, {'type': 'message', 'id': 5})
+
+            self.assertEqual(sub.get(5), {'type': 'message', 'id': 5})
+        finally:
+            channel.close()
+
+
+class SQLiteChannelTestCase(TestCase):
+    def test_events_reach_other_brokers(self):
+        """Tests that events reach brokers sharing the database file"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'events.sqlite3')
+            channels = [SQLiteChannel(path, poll_interval=0.01)
+                        for _ in range(2)]
+            brokers = [Broker(channel) for channel in channels]
+
+            try:
+                subs = [b.subscribe([1]) for b in brokers]
+
+                for channel in channels:
+                    self.assertTrue(channel.listening.wait(5))
+
+                brokers[0].publish(1, {'type': 'message', 'id': 5})
+
+                for sub in subs:
+                    self.assertEqual(sub.get(5), {'type': 'message', 'id': 5})
+            finally:
+                for channel in channels:
+                    channel.close()
+
+
+class TimelineStreamViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        u1.following.append(u2)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_stream_events(self):
+        """Tests that posts and deletes by followed users are streamed"""
+        with app.test_client() as c:
+            self.login(c, self.u1_id)
+
+            resp = c.get('/api/timeline/stream', buffered=False)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+
+            chunks = iter(resp.response)
+            self.assertEqual(next(chunks), b"retry: 5000\n\n")
+
+        with app.test_client() as c:
+            self.login(c, self.u2_id)
+            c.post('/messages/new', data={'text': 'hello'})
+
+            msg = Message.query.one()
+            c.post(f'/messages/{msg.id}/delete')
+
+        self.assertEqual(
+            next(chunks).decode(),
+            f'event: message\ndata: {{"id": {msg.id}, '
+            f'"user_id": {self.u2_id}}}\n\n')
+        self.assertTrue(next(chunks).startswith(b"event: delete\n"))
+
+        resp.close()
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_stream_heartbeat(self):
+        """Tests that idle streams get keep-alive comments"""
+        with patch('app.STREAM_HEARTBEAT', 0.01):
+            with app.test_client() as c:
+                self.login(c, self.u1_id)
+
+                resp = c.get('/api/timeline/stream', buffered=False)
+                chunks = iter(resp.response)
+                next(chunks)
+
+                self.assertEqual(next(chunks), b": keep-alive\n\n")
+                resp.close()
+
+    def test_long_poll_wakes_on_event(self):
+        """Tests that a long-poll re-checks as soon as it's woken"""
+        def post_message(subscription, timeout):
+            db.session.add(Message(text="hi", user_id=self.u2_id))
+            db.session.commit()
+            return {'type': 'message'}
+
+        with patch('events.Subscription.get', post_message):
+            with app.test_client() as c:
+                self.login(c, self.u1_id)
+
+                start = time.monotonic()
+                data = c.get('/api/timeline/new?since=0&wait=30').get_json()
+
+        self.assertEqual(data['count'], 1)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_max_streams(self):
+        """Tests streams and long-polls past MAX_STREAMS get a 503"""
+        slots = threading.BoundedSemaphore(1)
+
+        with patch('app.open_streams', slots):
+            with app.test_client() as c:
+                self.login(c, self.u1_id)
+
+                resp = c.get('/api/timeline/stream', buffered=False)
+                self.assertEqual(resp.status_code, 200)
+
+                full = c.get('/api/timeline/stream')
+                self.assertEqual(full.status_code, 503)
+                self.assertEqual(full.headers['Retry-After'], '30')
+
+                self.assertEqual(
+                    c.get('/api/timeline/new?wait=5').status_code, 503)
+                # Without a wait there's nothing to hold open
+                self.assertEqual(
+                    c.get('/api/timeline/new').status_code, 200)
+
+                resp.close()
+
+                # Closing the stream frees its slot
+                self.assertTrue(slots.acquire(blocking=False))
+
+    def test_stream_closed_before_start(self):
+        """Tests a stream closed before its first chunk is cleaned up"""
+        slots = threading.BoundedSemaphore(1)
+
+        with patch('app.open_streams', slots):
+            # The view itself: the test client always reads a first chunk
+            with app.test_request_context('/api/timeline/stream'):
+                g.user = db.session.get(User, self.u1_id)
+                resp = app.view_functions['stream_timeline']()
+
+            self.assertEqual(broker.subscriber_count(), 1)
+            resp.close()
+
+        self.assertEqual(broker.subscriber_count(), 0)
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_stream_subscribe_fails(self):
+        """Tests a stream that can't subscribe gives its slot back"""
+        slots = threading.BoundedSemaphore(1)
+
+        with patch('app.open_streams', slots):
+            with patch('app.broker.subscribe', side_effect=OSError):
+                with app.test_client() as c:
+                    self.login(c, self.u1_id)
+
+                    resp = c.get('/api/timeline/stream')
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertTrue(slots.acquire(blocking=False))
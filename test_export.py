@@ -0,0 +1,150 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+import gzip
+import json
+from datetime import datetime
+
+from testing import DBTestCase
+from app import app, CURR_USER_KEY
+from archive import archive_messages
+from models import db, Message, User
+import export
+
+
+class ExportTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        m1 = Message(text="first", user_id=u1.id)
+        m2 = Message(text="second, with a comma", user_id=u1.id)
+        m3 = Message(text="u2 says hi", user_id=u2.id)
+        old = Message(text="ancient", user_id=u1.id,
+                      timestamp=datetime(2015, 3, 1))
+        db.session.add_all([m1, m2, m3, old])
+        db.session.commit()
+
+        u1.likes.append(m3)
+        u1.following.append(u2)
+        u2.following.append(u1)
+        db.session.commit()
+
+        archive_messages(datetime(2016, 1, 1))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+        self.m3_id = m3.id
+
+    def records(self, **kwargs):
+        return [json.loads(line)
+                for line in export.generate(self.u1_id, **kwargs)]
+
+    def test_ndjson_sections(self):
+        """Tests that every section is exported in order"""
+        records = self.records()
+
+        self.assertEqual(
+            [r['section'] for r in records],
+            ['profile', 'messages', 'messages', 'archived_messages',
+             'likes', 'following', 'followers'])
+
+        self.assertEqual(records[0]['email'], 'u1@email.com')
+        self.assertEqual(records[3]['text'], 'ancient')
+        self.assertEqual(records[3]['timestamp'], '2015-03-01T00:00:00')
+        self.assertEqual(records[4]['text'], 'u2 says hi')
+        self.assertEqual(records[5]['username'], 'u2')
+
+    def test_resume(self):
+        """Tests resuming an export after a cursor"""
+        records = self.records()
+        cursor = records[1]['cursor']
+
+        self.assertEqual(cursor, f"messages:{self.m1_id}")
+        self.assertEqual(self.records(after=cursor), records[2:])
+
+    def test_resume_archive(self):
+        """Tests archived messages resume by month, whatever their ids"""
+        # Imported later, so its id is higher than a newer month's
+        older = Message(text="older still", user_id=self.u1_id,
+                        timestamp=datetime(2014, 6, 1))
+        db.session.add(older)
+        db.session.commit()
+        older_id = older.id
+        archive_messages(datetime(2016, 1, 1))
+        db.session.commit()
+
+        records = self.records(sections=['archived_messages'])
+
+        self.assertEqual(
+            [r['text'] for r in records], ['older still', 'ancient'])
+        self.assertEqual(
+            records[0]['cursor'], f"archived_messages:2014-06:{older_id}")
+        self.assertEqual(
+            self.records(sections=['archived_messages'],
+                         after=records[0]['cursor']),
+            records[1:])
+
+        for cursor in ("archived_messages:12", "archived_messages:2014-13:1"):
+            with self.assertRaises(export.InvalidExport):
+                export.generate(self.u1_id, after=cursor)
+
+    def test_csv(self):
+        """Tests CSV export of one section"""
+        lines = list(export.generate(
+            self.u1_id, 'csv', ['messages']))
+
+        self.assertEqual(lines[0], 'id,timestamp,text\r\n')
+        self.assertIn('"second, with a comma"', lines[2])
+
+        with self.assertRaises(export.InvalidExport):
+            export.generate(self.u1_id, 'csv')
+
+    def test_export_view_gzip(self):
+        """Tests the export download, gzip-compressed on the fly"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f'/users/{self.u1_id}/export?section=likes',
+                         headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_encoding, 'gzip')
+            self.assertIn('attachment', resp.headers['Content-Disposition'])
+
+            lines = gzip.decompress(resp.data).decode().splitlines()
+
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['message_id'], self.m3_id)
+
+    def test_export_view_errors(self):
+        """Tests that other users can't export and bad requests fail"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f'/users/{self.u1_id}/export')
+            self.assertEqual(resp.status_code, 401)
+
+            resp = c.get(f'/users/{self.u2_id}/export?format=csv')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_export_command(self):
+        """Tests the export-user CLI command"""
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=[
+            'export-user', 'u1', '--format', 'csv', '--section', 'following'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(result.output, f'user_id,username\n{self.u2_id},u2\n')
@@ -0,0 +1,218 @@
+"""In-memory follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+import random
+from unittest.mock import patch
+
+from testing import DBTestCase
+from app import app, CURR_USER_KEY
+from events import Broker, LocalChannel
+from follow_graph import FOLLOWS_TOPIC, FollowGraph
+from models import db, User
+
+
+class FollowGraphTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(6)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        self.broker = Broker(LocalChannel())
+        self.graph = FollowGraph(self.broker)
+        self.graph._subscription = self.broker.subscribe(
+            [FOLLOWS_TOPIC], maxsize=None)
+
+    def publish(self, event_type, user, other):
+        self.broker.publish(FOLLOWS_TOPIC, {
+            'type': event_type,
+            'user_id': user.id,
+            'followed_id': other.id,
+        })
+
+    def check(self, follows):
+        """Compare every graph query against the set of (a, b) follows."""
+        ids = [u.id for u in self.users]
+
+        for a in ids:
+            self.assertEqual(
+                self.graph.get_following(a),
+                sorted(b for b in ids if (a, b) in follows))
+            self.assertEqual(
+                self.graph.get_followers(a),
+                sorted(b for b in ids if (b, a) in follows))
+
+            for b in ids:
+                self.assertEqual(
+                    self.graph.is_following(a, b), (a, b) in follows)
+                self.assertEqual(
+                    self.graph.get_followers_followed_by(b, a),
+                    sorted(c for c in ids
+                           if (a, c) in follows and (c, b) in follows))
+
+    def test_load(self):
+        """Tests the loaded graph matches the follows table"""
+        u0, u1, u2, u3, u4, u5 = self.users
+        u0.following.extend([u1, u2, u5])
+        u1.following.append(u0)
+        u2.following.extend([u1, u5])
+        db.session.commit()
+
+        self.assertFalse(self.graph.ready)
+        self.graph.load()
+        self.assertTrue(self.graph.ready)
+
+        self.check({(u0.id, u1.id), (u0.id, u2.id), (u0.id, u5.id),
+                    (u1.id, u0.id), (u2.id, u1.id), (u2.id, u5.id)})
+
+    def test_events(self):
+        """Tests follow events keep the graph in step"""
+        rng = random.Random(42)
+        follows = set()
+
+        for user, other in rng.sample(
+                [(a, b) for a in self.users for b in self.users if a != b],
+                12):
+            user.following.append(other)
+            follows.add((user.id, other.id))
+        db.session.commit()
+
+        self.graph.load()
+
+        for i in range(40):
+            user, other = rng.sample(self.users, 2)
+
+            if (user.id, other.id) in follows:
+                user.following.remove(other)
+                db.session.commit()
+                self.publish('unfollow', user, other)
+                follows.remove((user.id, other.id))
+            else:
+                user.following.append(other)
+                db.session.commit()
+                self.publish('follow', user, other)
+                follows.add((user.id, other.id))
+
+            if i % 10 == 0:
+                self.graph.sync()
+
+            # A reload replays the events it finds queued
+            if i == 25:
+                self.graph.load()
+
+        self.check(follows)
+
+    def test_delete_event(self):
+        """Tests a deleted user drops out with all their follows"""
+        u0, u1, u2, u3 = self.users[:4]
+        u0.following.extend([u1, u2])
+        u1.following.extend([u0, u2])
+        u2.following.append(u1)
+        db.session.commit()
+
+        self.graph.load()
+
+        # Followed after the load, then deleted
+        self.publish('follow', u3, u1)
+        self.broker.publish(
+            FOLLOWS_TOPIC, {'type': 'delete', 'user_id': u1.id})
+
+        u1_id = u1.id
+        self.users.remove(u1)
+        self.check({(u0.id, u2.id)})
+        self.assertEqual(self.graph.get_followers(u1_id), [])
+        self.assertFalse(self.graph.is_following(u3.id, u1_id))
+        # Nor in "followed by" hints on or for the deleted user
+        self.assertEqual(
+            self.graph.get_followers_followed_by(u1_id, u0.id), [])
+        self.assertEqual(
+            self.graph.get_followers_followed_by(u2.id, u1_id), [])
+
+    def test_reload_when_changes_pile_up(self):
+        """Tests a reload starts once there are max_changes changes"""
+        u0, u1 = self.users[:2]
+        self.graph.load()
+        self.graph.max_changes = 2
+
+        with patch.object(self.graph, 'reload') as reload:
+            self.publish('follow', u0, u1)
+            self.graph.sync()
+            reload.assert_not_called()
+
+            self.publish('follow', u1, u0)
+            self.graph.sync()
+            reload.assert_called_once()
+
+    def test_profile_hints(self):
+        """Tests "follows you" and "followed by" hints on profiles"""
+        u0, u1, u2, u3 = self.users[:4]
+        u0.following.extend([u1, u2])
+        u1.following.append(u3)
+        u2.following.append(u3)
+        u3.following.append(u0)
+        db.session.commit()
+
+        self.graph.load()
+
+        for graph in (None, self.graph):
+            with patch.object(User, 'follow_graph', graph):
+                with app.test_client() as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = u0.id
+
+                    html = c.get(f'/users/{u3.id}').text
+
+                self.assertIn('Follows you', html)
+                self.assertRegex(
+                    html, r'Followed by\s*<a href="/users/\d+">@u1</a>, '
+                          r'<a href="/users/\d+">@u2</a>')
+
+                with app.test_client() as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = u1.id
+
+                    html = c.get(f'/users/{u2.id}').text
+
+                self.assertNotIn('Follows you', html)
+                self.assertNotIn('Followed by', html)
+
+    def test_views_publish_events(self):
+        """Tests following and unfollowing reach the graph"""
+        u0, u1 = self.users[:2]
+        self.graph.load()
+
+        with patch('app.broker', self.broker):
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u0.id
+
+                c.post(f'/users/follow/{u1.id}')
+                self.assertTrue(self.graph.is_following(u0.id, u1.id))
+
+                c.post(f'/users/stop-following/{u1.id}')
+                self.assertFalse(self.graph.is_following(u0.id, u1.id))
+
+    def test_delete_user_publishes_event(self):
+        """Tests deleting an account takes its follows out of the graph"""
+        u0, u1 = self.users[:2]
+        u0.following.append(u1)
+        u1.following.append(u0)
+        db.session.commit()
+
+        self.graph.load()
+
+        with patch('app.broker', self.broker):
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = u1.id
+
+                c.post('/users/delete')
+
+        self.assertEqual(self.graph.get_following(u0.id), [])
+        self.assertEqual(self.graph.get_followers(u0.id), [])
@@ -0,0 +1,95 @@
+"""Follow graph analytics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph_stats.py
+
+from unittest import TestCase
+
+import numpy as np
+from scipy import sparse
+
+from testing import DBTestCase
+from app import app
+from models import db, User, UserStats
+import graph_stats
+
+
+class PageRankTestCase(TestCase):
+    def test_matches_dense_power_iteration(self):
+        """Tests PageRank against a dense reference implementation"""
+        # edges: follower -> followed
+        edges = [(0, 1), (1, 2), (2, 0), (3, 2), (0, 2)]
+        n = 5
+
+        followers = sparse.csr_matrix(
+            ([1.0] * len(edges),
+             ([b for a, b in edges], [a for a, b in edges])),
+            shape=(n, n))
+        out_degree = np.bincount([a for a, b in edges], minlength=n)
+
+        links = np.zeros((n, n))
+        for a, b in edges:
+            links[b, a] = 1 / out_degree[a]
+        links[:, out_degree == 0] = 1 / n
+
+        expected = np.full(n, 1 / n)
+        for i in range(200):
+            expected = 0.15 / n + 0.85 * links @ expected
+
+        rank = graph_stats.pagerank(followers, out_degree)
+
+        np.testing.assert_allclose(rank, expected, atol=1e-7)
+        self.assertAlmostEqual(rank.sum(), 1)
+
+
+class GraphStatsTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        users = [User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        u0, u1, u2, u3 = users
+
+        # u0 <-> u1 are mutual; u2 follows u0 and u1; u3 follows nobody
+        u0.following.append(u1)
+        u1.following.append(u0)
+        u2.following.extend([u0, u1])
+        db.session.commit()
+
+        self.ids = [u.id for u in users]
+
+    def test_graph_stats(self):
+        """Tests degrees, influence and reciprocity written to user_stats"""
+        summary = graph_stats.run(chunk_size=2)
+
+        self.assertEqual(summary['users'], 4)
+        self.assertEqual(summary['follows'], 4)
+        self.assertAlmostEqual(summary['reciprocity'], 0.5)
+
+        stats = {s.user_id: s for s in UserStats.query.all()}
+        u0, u1, u2, u3 = (stats[i] for i in self.ids)
+
+        self.assertEqual((u0.followers, u0.following), (2, 1))
+        self.assertEqual((u2.followers, u2.following), (0, 2))
+        self.assertEqual(u0.reciprocity, 1)
+        self.assertEqual(u2.reciprocity, 0)
+        self.assertEqual(u3.reciprocity, 0)
+
+        self.assertAlmostEqual(u0.influence, u1.influence)
+        self.assertGreater(u0.influence, u2.influence)
+        self.assertAlmostEqual(u2.influence, u3.influence)
+
+    def test_graph_stats_command(self):
+        """Tests the graph-stats CLI command replaces earlier results"""
+        runner = app.test_cli_runner()
+
+        for i in range(2):
+            result = runner.invoke(args=['graph-stats'])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertIn('4 users, 4 follows', result.output)
+        self.assertEqual(UserStats.query.count(), 4)
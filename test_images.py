@@ -0,0 +1,56 @@
+"""Image upload tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from app import app
+from images import InvalidImage, save_upload
+
+
+def png(size):
+    """A PNG file of `size` pixels."""
+
+    file = BytesIO()
+    Image.new('RGB', size, 'blue').save(file, 'PNG')
+    file.seek(0)
+    return file
+
+
+class SaveUploadTestCase(TestCase):
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def test_decompression_bomb(self):
+        """Tests images over the pixel limit are invalid, not an error"""
+        with patch.object(Image, 'MAX_IMAGE_PIXELS', 100):
+            # Pillow raises over twice the limit, and only warns under it
+            for size in ((20, 20), (12, 12)):
+                with self.assertRaises(InvalidImage):
+                    save_upload(png(size), 'avatars')
+
+    def test_variant_failure_logged(self):
+        """Tests an error generating variants is logged"""
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        generate_variants = patch(
+            'images.generate_variants', side_effect=OSError("disk full"))
+
+        with patch('images.executor', executor), generate_variants:
+            with self.assertLogs('warbler.images', 'ERROR') as logs:
+                save_upload(png((10, 10)), 'avatars')
+                executor.shutdown()
+
+        self.assertIn("Can't generate image variants", logs.output[0])
+        self.assertIn("disk full", logs.output[0])
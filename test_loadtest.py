@@ -0,0 +1,83 @@
+"""Load generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loadtest.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from loadtest import (
+    LIKES_PER_MESSAGE, READS_PER_WRITE, Route, Step, derive_mix,
+    find_saturation, parse_csrf_token, percentile,
+)
+
+
+class DeriveMixTestCase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+        self.write('users.csv', "username,email\nalice,a@a.com\nbob,b@b.com\n")
+        self.write('messages.csv', "text,timestamp,user_id\nhi,,1\nyo,,1\n")
+        self.write(
+            'follows.csv',
+            "user_being_followed_id,user_following_id\n1,2\n")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.dir.name, name), 'w') as f:
+            f.write(text)
+
+    def test_derive_mix(self):
+        """Tests action weights and targets follow the seed data"""
+        mix = derive_mix(self.dir.name)
+
+        self.assertAlmostEqual(sum(mix.actions.values()), 1)
+        self.assertAlmostEqual(
+            mix.actions['follow'] / mix.actions['post'], 0.5)
+        self.assertAlmostEqual(
+            mix.actions['like'] / mix.actions['post'], LIKES_PER_MESSAGE)
+
+        writes = sum(mix.actions[name] for name in ('post', 'follow', 'like'))
+        self.assertAlmostEqual((1 - writes) / writes, READS_PER_WRITE)
+
+        # alice posted twice; bob followed once. alice has the follower.
+        self.assertEqual(mix.logins, [('alice', 3), ('bob', 2)])
+        self.assertEqual(mix.targets, [(1, 2), (2, 1)])
+
+
+class ReportTestCase(TestCase):
+    def step(self, users, requests, errors=0):
+        routes = {'GET /': Route(requests, errors, 1, 2, 3)}
+        return Step(users, 1.0, routes, {})
+
+    def test_percentile(self):
+        """Tests nearest-rank percentiles"""
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def test_find_saturation(self):
+        """Tests saturation is the last step that still added throughput"""
+        steps = [self.step(1, 100), self.step(2, 190), self.step(4, 195)]
+        self.assertIs(find_saturation(steps), steps[1])
+
+        steps = [self.step(1, 100), self.step(2, 200, errors=10)]
+        self.assertIs(find_saturation(steps), steps[0])
+
+        steps = [self.step(1, 100), self.step(2, 200)]
+        self.assertIs(find_saturation(steps), steps[1])
+
+    def test_parse_csrf_token(self):
+        """Tests the CSRF token is read from a form"""
+        html = (
+            '<input id="csrf_token" name="csrf_token" type="hidden" '
+            'value="abc">')
+
+        self.assertEqual(parse_csrf_token(html), 'abc')
+        self.assertIsNone(parse_csrf_token('<form></form>'))
@@ -4,37 +4,13 @@
 #
 #    python -m unittest test_message_model.py
 
+from testing import DBTestCase
+from models import db, User, Message
 
-import os
-from unittest import TestCase
 
-from models import db, User, Message, Like, Follow
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app
-
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(DBTestCase):
     def setUp(self):
-        Follow.query.delete()
-        Like.query.delete()
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
         u = User.signup("u", "u@email.com", "password", None)
         m1 = Message(text="test")
@@ -46,9 +22,6 @@ class MessageModelTestCase(TestCase):
         self.u_id = u.id
         self.m1_id = m1.id
 
-    def tearDown(self):
-        db.session.rollback()
-
     def test_message_model(self):
         """Tests that message was instantiated for a user"""
 
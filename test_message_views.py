@@ -4,46 +4,22 @@
 #
 #    FLASK_DEBUG=False python -m unittest test_message_views.py
 
-import os
-from unittest import TestCase
+import re
+import time
+from unittest import skipUnless
+from unittest.mock import patch
+from urllib.parse import unquote
 
-from models import db, Message, User, Follow, Like
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
+from sqlalchemy import func, select, text
 
+from testing import DBTestCase, DATABASE_BACKEND, requires_postgres
 from app import app, CURR_USER_KEY
+from models import db, Message, User, SEARCH_CONFIG, SEARCH_TABLE
 
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-
-# app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
 
-app.config['WTF_CSRF_ENABLED'] = False
-
-
-class MessageBaseViewTestCase(TestCase):
+class MessageBaseViewTestCase(DBTestCase):
     def setUp(self):
-        Follow.query.delete()
-        Like.query.delete()
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -60,9 +36,6 @@ class MessageBaseViewTestCase(TestCase):
         self.u2_id = u2.id
         self.m1_id = m1.id
 
-    def tearDown(self):
-        db.session.rollback()
-
 
 class MessageAddViewTestCase(MessageBaseViewTestCase):
     def test_display_add_message(self):
@@ -307,3 +280,178 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertIn("New to Warbler?", html)
 
 
+
+
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.add(u3)
+        db.session.flush()
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.following.append(db.session.get(User, self.u2_id))
+
+        db.session.add_all([
+            Message(text="Warblers are singing birds", user_id=self.u2_id),
+            Message(text="Birds birds birds, so many birds",
+                    user_id=self.u2_id),
+            Message(text="A bird in the hand", user_id=u3.id),
+            Message(text="Nothing to see here", user_id=u3.id),
+        ])
+        db.session.commit()
+
+    def search(self, **params):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/messages/search', query_string=params)
+            self.assertEqual(resp.status_code, 200)
+
+            return resp.get_data(as_text=True)
+
+    def test_search_ranked(self):
+        """Tests that matches are stemmed and ordered by rank"""
+        html = self.search(q='bird')
+
+        self.assertIn('so many birds', html)
+        self.assertIn('singing birds', html)
+        self.assertIn('A bird in the hand', html)
+        self.assertNotIn('Nothing to see here', html)
+        self.assertLess(html.index('so many birds'),
+                        html.index('singing birds'))
+
+    def test_search_following(self):
+        """Tests limiting results to people the user follows"""
+        html = self.search(q='bird', following='1')
+
+        self.assertIn('so many birds', html)
+        self.assertNotIn('A bird in the hand', html)
+
+    def test_search_pages(self):
+        """Tests keyset pagination through results"""
+        found = []
+        params = {'q': 'bird'}
+
+        with patch('app.SEARCH_PAGE_SIZE', 1):
+            for page in range(3):
+                html = self.search(**params)
+                found += re.findall(r'<p>(.*bird.*)</p>', html)
+
+                cursor = re.search(r'after=([^"&]+)', html)
+                params['after'] = cursor and unquote(cursor.group(1))
+
+        self.assertEqual(len(found), 3)
+        self.assertEqual(len(set(found)), 3)
+        self.assertIsNone(params['after'])
+
+    @requires_postgres
+    def test_search_uses_index(self):
+        """Tests that search can use the full-text index"""
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+
+        plan = db.session.execute(
+            text("EXPLAIN " + str(
+                select(Message.id)
+                .where(func.to_tsvector(SEARCH_CONFIG, Message.text)
+                       .op('@@')(func.websearch_to_tsquery(
+                           SEARCH_CONFIG, 'bird')))
+                .compile(db.engine, compile_kwargs={'literal_binds': True})
+            ))).scalars().all()
+
+        self.assertIn('ix_messages_text_search', '\n'.join(plan))
+
+    @skipUnless(DATABASE_BACKEND == 'sqlite', "needs SQLite")
+    def test_search_uses_fts_index(self):
+        """Tests that search on SQLite uses the FTS5 index, kept in step"""
+        stmt = (select(Message.id)
+                .join(SEARCH_TABLE, SEARCH_TABLE.c.rowid == Message.id)
+                .where(SEARCH_TABLE.c.messages_fts.op('MATCH')('"bird"')))
+
+        plan = db.session.execute(text("EXPLAIN QUERY PLAN " + str(
+            stmt.compile(db.engine, compile_kwargs={'literal_binds': True})
+        ))).all()
+        plan = '\n'.join(row[-1] for row in plan)
+
+        self.assertIn('VIRTUAL TABLE INDEX', plan)
+        self.assertIn('INTEGER PRIMARY KEY', plan)
+
+        self.assertIn("in the hand", self.search(q="bird"))
+
+        Message.query.filter(Message.text.like("A bird%")).delete()
+        db.session.commit()
+
+        self.assertNotIn("in the hand", self.search(q="bird"))
+
+
+class TimelineDeltaViewTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = db.session.get(User, self.u1_id)
+        u1.following.append(db.session.get(User, self.u2_id))
+        db.session.commit()
+
+    def get_new(self, **params):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/api/timeline/new', query_string=params)
+            self.assertEqual(resp.status_code, 200)
+
+            return resp.get_json()
+
+    def test_new_messages(self):
+        """Tests counting feed messages newer than the cursor"""
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.add(u3)
+        db.session.flush()
+
+        m2 = Message(text="m2-text", user_id=self.u2_id)
+        m3 = Message(text="not followed", user_id=u3.id)
+        db.session.add_all([m2, m3])
+        db.session.commit()
+
+        self.assertEqual(
+            self.get_new(since=0),
+            {'count': 2, 'ids': [m2.id, self.m1_id], 'cursor': m2.id})
+
+        self.assertEqual(
+            self.get_new(since=m2.id),
+            {'count': 0, 'ids': [], 'cursor': m2.id})
+
+    def test_long_poll_times_out(self):
+        """Tests that waiting with nothing new returns an empty delta"""
+        with patch('app.NEW_MESSAGES_POLL_INTERVAL', 0.01):
+            data = self.get_new(since=self.m1_id, wait=0.05)
+
+        self.assertEqual(data['count'], 0)
+
+    def test_long_poll_bad_wait(self):
+        """Tests that a NaN, infinite or negative wait doesn't wait"""
+        for wait in ('nan', 'inf', '-inf', '-5'):
+            with patch('app.NEW_MESSAGES_POLL_INTERVAL', 0.01):
+                start = time.monotonic()
+                data = self.get_new(since=self.m1_id, wait=wait)
+
+            self.assertEqual(data['count'], 0)
+            self.assertLess(time.monotonic() - start, 1)
+
+    def test_new_messages_unauthorized(self):
+        """Tests that the endpoint needs a logged in user"""
+        with app.test_client() as c:
+            resp = c.get('/api/timeline/new')
+            self.assertEqual(resp.status_code, 401)
+
+    def test_homepage_banner(self):
+        """Tests that the homepage passes its newest id to the banner"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get('/').get_data(as_text=True)
+
+        self.assertIn(f'data-since="{self.m1_id}"', html)
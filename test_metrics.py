@@ -0,0 +1,68 @@
+"""Metrics endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+from testing import DBTestCase
+from app import app, CURR_USER_KEY
+from models import db, User
+
+
+class MetricsViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+        super().tearDown()
+
+    def test_metrics(self):
+        """Tests that requests, SQL statements and bcrypt are measured"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get('/')
+            c.get('/not-a-page-at-all')
+
+            resp = c.get('/metrics')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/plain')
+
+            text = resp.get_data(as_text=True)
+            self.assertIn(
+                'warbler_requests_total{endpoint="homepage",method="GET",'
+                'status="200"}', text)
+            self.assertIn(
+                'warbler_requests_total{endpoint="none",method="GET",'
+                'status="404"}', text)
+            self.assertIn(
+                'warbler_request_duration_seconds_bucket{endpoint="homepage"',
+                text)
+            self.assertIn(
+                'warbler_sql_statements_total{endpoint="homepage"}', text)
+            self.assertIn(
+                'warbler_bcrypt_duration_seconds_count{operation="hash"}',
+                text)
+            self.assertIn('warbler_db_pool_checkouts_total', text)
+            self.assertIn('warbler_ratelimit_checks', text)
+
+    def test_metrics_token(self):
+        """Tests that METRICS_TOKEN is required when set"""
+        app.config['METRICS_TOKEN'] = 'secret'
+
+        with app.test_client() as c:
+            resp = c.get('/metrics')
+            self.assertEqual(resp.status_code, 401)
+
+            resp = c.get('/metrics',
+                          headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(resp.status_code, 200)
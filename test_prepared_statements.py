@@ -0,0 +1,166 @@
+"""Cached and prepared statement tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_prepared_statements.py
+
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import select, text
+
+from testing import DBTestCase, requires_postgres
+from app import prepared_statements
+from models import db, Follow, Message, User
+from prepared_statements import PREPARED, to_prepare
+
+
+class ToPrepareTestCase(TestCase):
+    def test_to_prepare(self):
+        """Tests pyformat parameters become numbered ones"""
+        sql, names = to_prepare(
+            "SELECT * FROM t WHERE a = %(a)s AND b LIKE '%%x' "
+            "AND (c = %(b)s OR d = %(a)s)")
+
+        self.assertEqual(
+            sql,
+            "SELECT * FROM t WHERE a = $1 AND b LIKE '%x' "
+            "AND (c = $2 OR d = $1)")
+        self.assertEqual(names, ['a', 'b'])
+
+
+class CachedStatementsTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.add_all([u1, u2, u3])
+        db.session.flush()
+
+        db.session.add(
+            Follow(user_being_followed_id=u2.id, user_following_id=u1.id))
+        db.session.add_all([
+            Message(text=f"{user.username}-{n}", user_id=user.id,
+                    timestamp=datetime(2024, 1, 1 + n))
+            for user in (u1, u2, u3) for n in range(3)])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def prepared(self):
+        """Names of the statements prepared on the test's connection."""
+
+        return set(db.session.connection().exec_driver_sql(
+            "SELECT name FROM pg_prepared_statements").scalars())
+
+    def test_get(self):
+        """Tests users are found by id and username"""
+        self.assertEqual(User.get(self.u1_id).username, 'u1')
+        self.assertEqual(User.get_by_username('u2').id, self.u2_id)
+        self.assertIsNone(User.get(-1))
+        self.assertIsNone(User.get_by_username('nobody'))
+
+    def test_timeline(self):
+        """Tests the timeline has the messages of the user and followed"""
+        u1 = User.get(self.u1_id)
+        ids = u1.list_feed_user_ids()
+
+        self.assertCountEqual(ids, [self.u1_id, self.u2_id])
+
+        messages = Message.get_timeline(ids, limit=4)
+
+        self.assertEqual(len(messages), 4)
+        self.assertTrue(
+            all(message.user_id in ids for message in messages))
+        self.assertEqual(
+            [(m.timestamp, m.id) for m in messages],
+            sorted(((m.timestamp, m.id) for m in messages), reverse=True))
+
+    def test_get_messages(self):
+        """Tests a user's messages, newest first, in batches or not"""
+        u2 = User.get(self.u2_id)
+
+        self.assertEqual(
+            [m.text for m in u2.get_messages()], ['u2-2', 'u2-1', 'u2-0'])
+        self.assertEqual(
+            [m.text for m in u2.get_messages(yield_per=2)],
+            ['u2-2', 'u2-1', 'u2-0'])
+
+    @requires_postgres
+    def test_prepared(self):
+        """Tests statements are prepared once per connection, then reused"""
+        for _ in range(3):
+            db.session.expunge_all()
+            self.assertEqual(User.get(self.u1_id).username, 'u1')
+
+        prepared = db.session.connection().exec_driver_sql(
+            "SELECT statement FROM pg_prepared_statements").scalars().all()
+
+        self.assertEqual(
+            len([sql for sql in prepared if 'WHERE users.id = $1' in sql]),
+            1)
+
+    @requires_postgres
+    def test_timeline_prepared_once(self):
+        """Tests the timeline is one prepared statement for any feed size"""
+        for ids in ([self.u1_id], [self.u1_id, self.u2_id]):
+            Message.get_timeline(ids)
+
+        prepared = db.session.connection().exec_driver_sql(
+            "SELECT statement FROM pg_prepared_statements").scalars().all()
+
+        self.assertEqual(
+            len([sql for sql in prepared
+                 if 'WHERE messages.user_id = ANY ($1)' in sql]),
+            1)
+
+    @requires_postgres
+    def test_in_lists_not_prepared(self):
+        """Tests statements whose IN lists change their SQL run as they are"""
+        before = self.prepared()
+
+        for ids in ([self.u1_id], [self.u1_id, self.u2_id]):
+            db.session.execute(
+                select(User.username).where(User.id.in_(ids)),
+                execution_options=PREPARED).all()
+
+        self.assertEqual(self.prepared(), before)
+
+    @requires_postgres
+    def test_unpreparable(self):
+        """Tests a statement Postgres can't prepare runs as it is"""
+        stmt = text("SELECT :a + :b")
+
+        for _ in range(2):
+            self.assertEqual(
+                db.session.execute(
+                    stmt, {'a': 1, 'b': 2},
+                    execution_options=PREPARED).scalar(), 3)
+
+        # The transaction is still usable
+        self.assertEqual(User.get(self.u1_id).username, 'u1')
+
+    @requires_postgres
+    def test_evicts_least_recently_used(self):
+        """Tests each connection keeps at most max_per_connection"""
+        max_per_connection = prepared_statements.max_per_connection
+        prepared_statements.max_per_connection = 2
+
+        try:
+            for n in range(4):
+                db.session.execute(
+                    text(f"SELECT {n} + :a"), {'a': 1},
+                    execution_options=PREPARED)
+
+            names = list(
+                db.session.connection().info['prepared_statements'])
+            server = db.session.connection().exec_driver_sql(
+                "SELECT name FROM pg_prepared_statements").scalars().all()
+        finally:
+            prepared_statements.max_per_connection = max_per_connection
+
+        self.assertEqual(len(names), 2)
+        self.assertTrue(set(names) <= set(server))
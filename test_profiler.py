@@ -0,0 +1,151 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from testing import DBTestCase
+from app import app, CURR_USER_KEY
+from models import db, User
+from profiler import SamplingProfiler
+
+
+def busy_work(seconds):
+    """Spin for `seconds` so the sampler has something to see."""
+
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SamplingProfilerTestCase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'profiler.sqlite3')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_sampled_stacks(self):
+        """Tests that a profiled request's stack is collected"""
+        p = SamplingProfiler(self.path, interval=0.001, default_rate=1)
+
+        p.enable()
+        self.assertTrue(p.should_sample('homepage'))
+
+        p.start_request('homepage')
+        busy_work(0.1)
+        p.stop_request()
+        p.disable()
+
+        self.assertGreater(p.get_summary()['homepage'], 0)
+
+        folded = p.get_collapsed('homepage')
+        self.assertIn('test_profiler.py:busy_work', folded)
+        self.assertRegex(folded.splitlines()[0], r'^\S+ \d+$')
+
+    def test_per_endpoint_rate(self):
+        """Tests that per-endpoint sample rates override the default"""
+        p = SamplingProfiler(self.path, default_rate=1)
+        p.set_rate(0, 'show_user')
+
+        self.assertTrue(p.should_sample('homepage'))
+        self.assertFalse(p.should_sample('show_user'))
+
+    def test_shared_between_workers(self):
+        """Tests that workers share settings and stacks"""
+        workers = [
+            SamplingProfiler(self.path, interval=0.001, refresh_interval=0)
+            for _ in range(2)]
+
+        workers[0].enable(default_rate=1)
+
+        self.assertTrue(workers[1].enabled)
+        self.assertEqual(workers[1].default_rate, 1)
+
+        workers[1].start_request('homepage')
+        busy_work(0.05)
+        workers[1].stop_request()
+        workers[1].flush()
+
+        self.assertGreater(workers[0].get_summary()['homepage'], 0)
+        self.assertIn(
+            'test_profiler.py:busy_work', workers[0].get_collapsed('homepage'))
+
+        workers[0].reset()
+        workers[0].disable()
+
+        self.assertEqual(workers[1].get_summary(), {})
+        self.assertFalse(workers[1].enabled)
+
+
+class ProfilerViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        admin = User.signup("admin", "admin@email.com", "password", None)
+        admin.is_admin = True
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+
+        db.session.add_all([admin, u1])
+        db.session.commit()
+
+        self.admin_id = admin.id
+        self.u1_id = u1.id
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.profiler = SamplingProfiler(
+            os.path.join(self.dir.name, 'profiler.sqlite3'))
+
+        patcher = patch('app.profiler', self.profiler)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.profiler.disable()
+        self.dir.cleanup()
+
+        super().tearDown()
+
+    def test_profiler_not_admin(self):
+        """Tests that only admins can see the profiler"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/admin/profiler')
+            self.assertEqual(resp.status_code, 401)
+
+            resp = c.get('/admin/profiler/homepage.folded')
+            self.assertEqual(resp.status_code, 401)
+
+    def test_enable_profiler(self):
+        """Tests turning on the profiler and downloading stacks"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+
+            resp = c.post('/admin/profiler',
+                          data={
+                              'enabled': 'y',
+                              'sample_rate': '0.5',
+                              'endpoint': 'homepage',
+                          },
+                          follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Profiler settings saved', resp.get_data(as_text=True))
+            self.assertTrue(self.profiler.enabled)
+            self.assertEqual(self.profiler.sample_rates['homepage'], 0.5)
+
+            resp = c.get('/admin/profiler/homepage.folded')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/plain')
+            self.assertIn('attachment', resp.headers['Content-Disposition'])
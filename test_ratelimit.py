@@ -0,0 +1,145 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from testing import DBTestCase
+from app import app, RATE_LIMITS
+from ratelimit import Limit, TokenBucketStore
+
+
+class TokenBucketStoreTestCase(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.store = TokenBucketStore(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_burst_then_reject(self):
+        """Tests that a bucket allows `capacity` requests, then rejects"""
+        limit = Limit(3, 30)
+
+        for i in range(3):
+            self.assertEqual(
+                self.store.consume('login', [('k', limit)], now=100),
+                (True, 0))
+
+        allowed, retry_after = self.store.consume(
+            'login', [('k', limit)], now=100)
+
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 10)
+
+    def test_refill(self):
+        """Tests that tokens refill over the limit's period"""
+        limit = Limit(1, 10)
+
+        self.assertTrue(self.store.consume('s', [('k', limit)], now=0)[0])
+        self.assertFalse(self.store.consume('s', [('k', limit)], now=5)[0])
+        self.assertTrue(self.store.consume('s', [('k', limit)], now=10)[0])
+
+    def test_all_or_nothing(self):
+        """Tests that a rejected check doesn't take tokens from any bucket"""
+        small = Limit(1, 60)
+        large = Limit(5, 60)
+
+        self.store.consume('s', [('a', small)], now=0)
+
+        allowed, _ = self.store.consume(
+            's', [('a', small), ('b', large)], now=0)
+        self.assertFalse(allowed)
+
+        for i in range(5):
+            self.assertTrue(self.store.consume('s', [('b', large)], now=0)[0])
+
+    def test_counters(self):
+        """Tests that allowed and rejected checks are counted per scope"""
+        limit = Limit(1, 60)
+
+        self.store.consume('login', [('k', limit)], now=0)
+        self.store.consume('login', [('k', limit)], now=0)
+
+        self.assertEqual(self.store.get_counters(), {
+            ('login', 'allowed'): 1,
+            ('login', 'rejected'): 1,
+        })
+
+
+class RateLimitViewTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+
+        app.config['RATELIMIT_ENABLED'] = True
+        app.config['RATELIMIT_STORAGE'] = self.path
+
+    def tearDown(self):
+        app.config['RATELIMIT_ENABLED'] = False
+        os.remove(self.path)
+
+        super().tearDown()
+
+    def test_login_rate_limited(self):
+        """Tests that repeated logins for one username get a 429"""
+        capacity = RATE_LIMITS['login']['user'].capacity
+
+        with app.test_client() as c:
+            for i in range(capacity):
+                resp = c.post('/login', data={
+                    'username': 'nobody',
+                    'password': 'password',
+                })
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.post('/login', data={
+                'username': 'NoBody',
+                'password': 'password',
+            })
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn('Retry-After', resp.headers)
+            self.assertIn('TOO MANY REQUESTS', resp.get_data(as_text=True))
+
+            resp = c.get('/login')
+            self.assertEqual(resp.status_code, 200)
+
+    def test_availability_rate_limited(self):
+        """Tests that name availability checks are limited per IP"""
+        capacity = RATE_LIMITS['check_available']['ip'].capacity
+
+        with app.test_client() as c:
+            for i in range(capacity):
+                resp = c.get(f'/api/users/available?username=name{i}')
+                self.assertEqual(resp.status_code, 200)
+
+            resp = c.get('/api/users/available?username=another')
+            self.assertEqual(resp.status_code, 429)
+
+    def test_limited_per_forwarded_address(self):
+        """Tests clients behind a trusted proxy are limited separately"""
+        capacity = RATE_LIMITS['check_available']['ip'].capacity
+        proxied = ProxyFix(app.wsgi_app, x_for=1)
+
+        def check(client_ip):
+            return c.get(
+                '/api/users/available?username=name',
+                headers={'X-Forwarded-For': client_ip}).status_code
+
+        with patch.object(app, 'wsgi_app', proxied), app.test_client() as c:
+            for i in range(capacity):
+                self.assertEqual(check('203.0.113.1'), 200)
+
+            self.assertEqual(check('203.0.113.1'), 429)
+            self.assertEqual(check('203.0.113.2'), 200)
@@ -0,0 +1,218 @@
+"""Message sharding tests, against two local shard databases."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+
+import json
+
+from sqlalchemy import select, text
+
+from testing import DBTestCase, get_shard_database_urls, requires_postgres
+from app import app, CURR_USER_KEY, SHARDED_TABLES
+from models import db, shards, Like, Message, Mention, User
+import export
+import trending
+
+
+@requires_postgres
+class ShardTestCase(DBTestCase):
+    @classmethod
+    def setUpClass(cls):
+        shards.configure(get_shard_database_urls(2))
+        shards.drop_all(SHARDED_TABLES)
+        shards.create_all(SHARDED_TABLES)
+
+    @classmethod
+    def tearDownClass(cls):
+        shards.configure([])
+
+    def setUp(self):
+        super().setUp()
+
+        # Users until there's one on each shard, then one more
+        self.users = []
+
+        while len({shards.for_user(u.id) for u in self.users}) < 2:
+            i = len(self.users)
+            user = User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            db.session.add(user)
+            db.session.flush()
+            self.users.append(user)
+
+        self.u0 = self.users[0]
+        self.u1 = next(
+            u for u in self.users
+            if shards.for_user(u.id) != shards.for_user(self.u0.id))
+
+        db.session.commit()
+
+    def tearDown(self):
+        super().tearDown()
+
+        # Shard writes are really committed, so clear them out
+        for engine in shards.engines:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "TRUNCATE messages, likes, message_tags, mentions"))
+
+    def rows_on(self, shard, stmt):
+        with shards.engines[shard].connect() as conn:
+            return conn.execute(stmt).all()
+
+    def login(self, client, user):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_messages_on_authors_shard(self):
+        """Tests messages are stored and found on their author's shard"""
+        m0 = Message.create(self.u0, "from u0")
+        m1 = Message.create(self.u1, "from u1")
+        db.session.commit()
+
+        for user, message in ((self.u0, m0), (self.u1, m1)):
+            shard = shards.for_user(user.id)
+            self.assertEqual(shards.for_message(message.id), shard)
+            self.assertEqual(
+                self.rows_on(shard, select(Message.id, Message.user_id)),
+                [(message.id, user.id)])
+
+        # Nothing on the main database
+        self.assertEqual(db.session.query(Message).count(), 0)
+
+        # Ids follow posting order across shards
+        self.assertGreater(m1.id, m0.id)
+
+        db.session.expunge_all()
+        self.assertEqual(Message.get(m1.id).text, "from u1")
+        self.assertEqual(
+            [m.text for m in db.session.get(User, self.u0.id).get_messages()],
+            ["from u0"])
+
+    def test_home_timeline(self):
+        """Tests the timeline merges both shards newest first"""
+        self.u0.following.append(self.u1)
+        db.session.commit()
+
+        ids = []
+
+        for i in range(6):
+            user = self.u0 if i % 2 else self.u1
+            ids.append(Message.create(user, f"warble {i}").id)
+            db.session.commit()
+
+        with app.test_client() as c:
+            self.login(c, self.u0)
+            html = c.get('/').text
+
+            self.assertEqual(
+                [html.index(f"warble {i}") for i in reversed(range(6))],
+                sorted(html.index(f"warble {i}") for i in range(6)))
+
+            data = c.get('/api/timeline/new', query_string={
+                'since': ids[1]}).get_json()
+
+        self.assertEqual(
+            data,
+            {'count': 4, 'ids': ids[:1:-1], 'cursor': ids[-1]})
+
+    def test_add_message_view(self):
+        """Tests posting, tags and mentions land on the author's shard"""
+        with app.test_client() as c:
+            self.login(c, self.u1)
+            c.post('/messages/new', data={
+                'text': f"hello #shards @{self.u0.username}"})
+
+            self.login(c, self.u0)
+            c.post('/messages/new', data={'text': "more #shards"})
+
+            html = c.get('/tags/shards').text
+            self.assertLess(html.index("more"), html.index("hello"))
+
+            html = c.get(f'/users/{self.u0.id}/mentions').text
+            self.assertIn("hello", html)
+
+            html = c.get(f'/users/{self.u1.id}').text
+            self.assertIn("hello", html)
+            self.assertNotIn("more", html)
+
+        shard = shards.for_user(self.u1.id)
+        self.assertEqual(
+            self.rows_on(shard, select(Mention.user_id)), [(self.u0.id,)])
+
+    def test_likes(self):
+        """Tests likes live on the liker's shard and follow deletes"""
+        message = Message.create(self.u1, "likeable")
+        db.session.commit()
+
+        with app.test_client() as c:
+            self.login(c, self.u0)
+            html = c.post(
+                f'/messages/{message.id}/like-toggle',
+                data={'origin_url': f'/messages/{message.id}'},
+                follow_redirects=True).text
+            self.assertIn('<i class="bi bi-star-fill"></i>', html)
+
+            html = c.get(f'/users/{self.u0.id}/likes').text
+            self.assertIn("likeable", html)
+
+        self.assertEqual(
+            self.rows_on(shards.for_user(self.u0.id), select(Like.user_id)),
+            [(self.u0.id,)])
+
+        self.assertEqual(self.u0.get_stats().likes, 1)
+        self.assertEqual(self.u1.get_stats().messages, 1)
+
+        lines = export.generate(self.u0.id, sections=['likes'])
+        like, = [json.loads(line) for line in lines]
+        self.assertEqual(like['message_id'], message.id)
+        self.assertEqual(like['text'], "likeable")
+
+        with app.test_client() as c:
+            self.login(c, self.u1)
+            c.post(f'/messages/{message.id}/delete')
+
+        for shard in shards.all():
+            self.assertEqual(self.rows_on(shard, select(Like.user_id)), [])
+            self.assertEqual(self.rows_on(shard, select(Message.id)), [])
+
+    def test_trending(self):
+        """Tests trending messages are read from each one's shard"""
+        m0 = Message.create(self.u0, "trending on u0's shard")
+        m1 = Message.create(self.u1, "trending on u1's shard")
+        db.session.commit()
+
+        counter = trending.TrendingCounter()
+        counter.liked(m0.id)
+        counter.liked(m1.id)
+        counter.liked(m1.id)
+        counter.flush()
+        counter.refresh()
+
+        self.assertEqual(
+            [m.id for m in trending.get_messages()], [m1.id, m0.id])
+
+    def test_delete_user(self):
+        """Tests deleting a user clears their rows from every shard"""
+        with app.test_client() as c:
+            self.login(c, self.u1)
+            c.post('/messages/new', data={
+                'text': f"hi @{self.u0.username}"})
+
+        self.u0.like(Message.create(self.u1, "liked"))
+        Message.create(self.u0, "bye")
+        db.session.commit()
+
+        with app.test_client() as c:
+            self.login(c, self.u0)
+            c.post('/users/delete')
+
+        self.assertIsNone(db.session.get(User, self.u0.id))
+
+        for shard in shards.all():
+            self.assertEqual(self.rows_on(shard, select(Like.user_id)), [])
+            self.assertEqual(self.rows_on(shard, select(Mention.user_id)), [])
+            self.assertEqual(
+                self.rows_on(shard, select(Message.user_id)),
+                [(self.u1.id,)] * 2 if shard == shards.for_user(self.u1.id)
+                else [])
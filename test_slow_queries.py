@@ -0,0 +1,117 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+from unittest import TestCase
+from unittest.mock import Mock
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from testing import DBTestCase, DATABASE_BACKEND
+from app import app, slow_query_log, CURR_USER_KEY
+from models import db, User
+from slow_queries import describe_parameters, fingerprint, SlowQueryLog
+
+
+class FingerprintTestCase(TestCase):
+    def test_literals_collapsed(self):
+        """Tests that statements differing only in values match"""
+        a = fingerprint("SELECT * FROM users WHERE id IN (1, 2, 3)")
+        b = fingerprint("SELECT *  FROM users\nWHERE id IN (%(id_1)s)")
+
+        self.assertEqual(a, b)
+        self.assertEqual(a[1], "SELECT * FROM users WHERE id IN (...)")
+
+    def test_strings_collapsed(self):
+        """Tests that quoted strings are replaced"""
+        _, normalized = fingerprint(
+            "SELECT * FROM users WHERE username = 'it''s me' LIMIT 10")
+
+        self.assertEqual(
+            normalized, "SELECT * FROM users WHERE username = ? LIMIT ?")
+
+    def test_parameters_have_no_values(self):
+        """Tests that only parameter types are described"""
+        shape = describe_parameters(
+            {'username': 'secret', 'id_1': 5}, False)
+
+        self.assertEqual(shape, "{username: str[6], id_1: int}")
+        self.assertNotIn('secret', shape)
+
+
+class ExplainTestCase(TestCase):
+    def test_savepoint_fails(self):
+        """Tests a failed SAVEPOINT is reported in the plan, not raised"""
+        conn = Mock()
+        conn.dialect.name = 'sqlite'
+        cursor = conn.connection.cursor.return_value
+        cursor.execute.side_effect = Exception("no transaction")
+
+        plan = SlowQueryLog().explain(conn, "SELECT 1", ())
+
+        self.assertEqual(plan, "(EXPLAIN failed: no transaction)")
+        cursor.close.assert_called_once()
+
+
+class SlowQueryLogTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.add(u1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+        slow_query_log.reset()
+        slow_query_log.threshold_ms = 0
+
+    def tearDown(self):
+        slow_query_log.threshold_ms = app.config['SLOW_QUERY_MS']
+        slow_query_log.reset()
+
+        super().tearDown()
+
+    def test_logs_route_and_plan(self):
+        """Tests that slow statements are logged with route and plan"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with self.assertLogs('warbler.slow_queries', 'WARNING') as logs:
+                resp = c.get(f'/users/{self.u1_id}')
+                self.assertEqual(resp.status_code, 200)
+
+        output = '\n'.join(logs.output)
+
+        self.assertIn('route=GET /users/<int:user_id> (show_user)', output)
+        self.assertIn('FROM users', output)
+        # Postgres's EXPLAIN or SQLite's EXPLAIN QUERY PLAN
+        self.assertIn(
+            'Scan' if DATABASE_BACKEND == 'postgresql' else 'SEARCH users',
+            output)
+        self.assertNotIn('u1@email.com', output)
+
+    def test_repeated_statement_logged_once(self):
+        """Tests that a fingerprint isn't logged again within min_interval"""
+        with self.assertLogs('warbler.slow_queries', 'WARNING') as logs:
+            for user_id in (1, 2, 3):
+                db.session.get(User, self.u1_id + user_id)
+                db.session.expunge_all()
+
+        users_lookups = [line for line in logs.output if 'FROM users' in line]
+        self.assertEqual(len(users_lookups), 1)
+
+    def test_failed_statement_forgotten(self):
+        """Tests a statement that raises doesn't leave its timer behind"""
+        db.session.begin_nested()
+
+        with self.assertRaises(DBAPIError):
+            db.session.execute(text("SELECT * FROM no_such_table"))
+
+        db.session.rollback()
+
+        self.assertEqual(db.session.connection().info['query_start'], [])
@@ -0,0 +1,83 @@
+"""SQLite engine setup tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sqlite_engine.py
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, exc, text
+
+import sqlite_engine
+
+
+class SQLiteEngineTestCase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f"sqlite:///{os.path.join(self.dir.name, 'test.sqlite3')}",
+            **sqlite_engine.engine_options({}))
+        sqlite_engine.instrument(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.dir.cleanup()
+
+    def test_pragmas(self):
+        """Tests connections use WAL, foreign keys and a busy timeout"""
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.exec_driver_sql("PRAGMA journal_mode").scalar(), 'wal')
+            self.assertEqual(
+                conn.exec_driver_sql("PRAGMA foreign_keys").scalar(), 1)
+            self.assertEqual(
+                conn.exec_driver_sql("PRAGMA busy_timeout").scalar(), 5000)
+
+    def test_savepoints(self):
+        """Tests nested transactions roll back on their own"""
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE TABLE t (x INTEGER)"))
+
+        with self.engine.begin() as conn:
+            conn.execute(text("INSERT INTO t VALUES (1)"))
+
+            with conn.begin_nested() as nested:
+                conn.execute(text("INSERT INTO t VALUES (2)"))
+                nested.rollback()
+
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.execute(text("SELECT x FROM t")).scalars().all(), [1])
+
+    def test_begin_immediate(self):
+        """Tests the sqlite_begin option takes the write lock up front"""
+        with self.engine.begin() as conn:
+            conn.execute(text("CREATE TABLE t (x INTEGER)"))
+
+        with self.engine.connect() as other:
+            other.exec_driver_sql("PRAGMA busy_timeout=0")
+            other.commit()
+
+            with self.engine.connect().execution_options(
+                    sqlite_begin='IMMEDIATE') as conn:
+                conn.begin()
+
+                with self.assertRaises(exc.OperationalError):
+                    with other.begin():
+                        other.execute(text("INSERT INTO t VALUES (1)"))
+
+                conn.rollback()
+
+    def test_new_connection_after_fork(self):
+        """Tests pooled connections aren't reused by a forked process"""
+        with self.engine.connect() as conn:
+            before = conn.connection.dbapi_connection
+
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            with self.engine.connect() as conn:
+                after = conn.connection.dbapi_connection
+
+        self.assertIsNot(before, after)
@@ -0,0 +1,203 @@
+"""Follow suggestion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_suggestions.py
+
+import random
+from unittest.mock import patch
+
+from testing import DBTestCase
+from app import app, CURR_USER_KEY
+from models import db, FollowSuggestion, Message, SuggestionUpdate, User
+import suggestions
+
+
+class SuggestionsTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.users = [
+            User.signup(f"u{i}", f"u{i}@email.com", "password", None)
+            for i in range(6)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def follow(self, user, other):
+        user.following.append(other)
+        db.session.flush()
+        suggestions.follow_added(user.id, other.id)
+        suggestions.apply_updates()
+
+    def unfollow(self, user, other):
+        user.following.remove(other)
+        db.session.flush()
+        suggestions.follow_removed(user.id, other.id)
+        suggestions.apply_updates()
+
+    def get_suggestions(self):
+        return {
+            (s.user_id, s.suggested_user_id): (s.mutual_count, s.score)
+            for s in FollowSuggestion.query.all()}
+
+    def test_rebuild(self):
+        """Tests suggestions are friends of friends ranked by mutuals"""
+        u0, u1, u2, u3, u4, u5 = self.users
+
+        # u0 follows u1 and u2, who both follow u3; u2 also follows u4
+        u0.following.extend([u1, u2])
+        u1.following.extend([u3, u0])
+        u2.following.extend([u3, u4])
+        db.session.add(Message(text="hi", user_id=u4.id))
+        db.session.commit()
+
+        self.assertEqual(suggestions.rebuild(), 3)
+
+        suggested = [(user.username, mutual_count)
+                     for user, mutual_count in u0.get_suggestions()]
+        self.assertEqual(suggested, [('u3', 2), ('u4', 1)])
+
+        # u1 follows u0, who follows u2; u0 itself is not suggested
+        self.assertEqual(
+            [user.username for user, _ in u1.get_suggestions()], ['u2'])
+
+        scores = self.get_suggestions()
+        self.assertEqual(scores[(u0.id, u3.id)][1], 2.0)
+        self.assertAlmostEqual(
+            scores[(u0.id, u4.id)][1], 1 + 1 / suggestions.ACTIVITY_CAP)
+
+    def test_incremental_matches_rebuild(self):
+        """Tests follow/unfollow updates agree with a full rebuild"""
+        rng = random.Random(41)
+        following = set()
+
+        for i in range(60):
+            user, other = rng.sample(self.users, 2)
+
+            if (user, other) in following:
+                self.unfollow(user, other)
+                following.remove((user, other))
+            else:
+                self.follow(user, other)
+                following.add((user, other))
+
+            incremental = self.get_suggestions()
+            suggestions.rebuild()
+
+            self.assertEqual(incremental, self.get_suggestions(), i)
+
+    def test_updates_queued(self):
+        """Tests a follow only queues the followers' updates"""
+        u0, u1, u2 = self.users[:3]
+
+        u0.following.append(u1)
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1.id
+
+            c.post(f'/users/follow/{u2.id}')
+
+        self.assertEqual(SuggestionUpdate.query.count(), 1)
+        self.assertEqual(self.get_suggestions(), {})
+
+        self.assertEqual(suggestions.apply_updates(), 1)
+        self.assertEqual(SuggestionUpdate.query.count(), 0)
+        self.assertEqual(self.get_suggestions(), {(u0.id, u2.id): (1, 1.0)})
+
+    def test_per_user_cap(self):
+        """Tests updates keep only the top SUGGESTIONS_PER_USER per user"""
+        u0, u1, u2, u3, u4, u5 = self.users
+
+        with patch('suggestions.SUGGESTIONS_PER_USER', 2):
+            self.follow(u0, u1)
+            self.follow(u0, u2)
+            self.follow(u1, u3)
+            self.follow(u2, u3)
+            self.follow(u1, u4)
+            self.follow(u1, u5)
+
+        self.assertEqual(
+            [user.username for user, _ in u0.get_suggestions()],
+            ['u3', 'u4'])
+
+    def test_user_deleted(self):
+        """Tests deleting a user recounts their followers' suggestions"""
+        u0, u1, u2, u3 = self.users[:4]
+
+        # u0 is suggested u3 through both u1 and u2
+        u0.following.extend([u1, u2])
+        u1.following.append(u3)
+        u2.following.append(u3)
+        db.session.commit()
+        suggestions.rebuild()
+        u0_id, u3_id = u0.id, u3.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1.id
+
+            c.post('/users/delete')
+
+        self.assertEqual(SuggestionUpdate.query.count(), 1)
+        suggestions.apply_updates()
+
+        incremental = self.get_suggestions()
+        self.assertEqual(incremental[(u0_id, u3_id)], (1, 1.0))
+
+        suggestions.rebuild()
+        self.assertEqual(incremental, self.get_suggestions())
+
+    def test_rebuild_drops_queue(self):
+        """Tests a full rebuild covers the updates queued before it"""
+        u0, u1 = self.users[:2]
+
+        u0.following.append(u1)
+        db.session.flush()
+        suggestions.follow_added(u0.id, u1.id)
+        suggestions.rebuild()
+
+        self.assertEqual(SuggestionUpdate.query.count(), 0)
+
+    def test_home_sidebar(self):
+        """Tests suggestions are shown on the home page"""
+        u0, u1, u2 = self.users[:3]
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0.id
+
+            resp = c.get('/')
+            self.assertNotIn('Who to follow', resp.text)
+
+            c.post(f'/users/follow/{u1.id}')
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1.id
+            c.post(f'/users/follow/{u2.id}')
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0.id
+
+            # What each worker's SuggestionUpdater does
+            suggestions.apply_updates()
+
+            resp = c.get('/')
+            self.assertIn('Who to follow', resp.text)
+            self.assertIn('@u2', resp.text)
+            self.assertIn('Followed by 1 you follow', resp.text)
+
+            c.post(f'/users/follow/{u2.id}')
+            resp = c.get('/')
+            self.assertNotIn('Who to follow', resp.text)
+
+    def test_rebuild_command(self):
+        """Tests the rebuild-suggestions CLI command"""
+        u0, u1, u2 = self.users[:3]
+        u0.following.append(u1)
+        u1.following.append(u2)
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['rebuild-suggestions'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('1 suggestions', result.output)
@@ -0,0 +1,152 @@
+"""Trending messages tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_trending.py
+
+import time
+from unittest.mock import patch
+
+from sqlalchemy import select
+
+from testing import DBTestCase
+from app import app, CURR_USER_KEY
+from models import db, Message, TrendingCount, User
+import trending
+from trending import BUCKET_SECONDS, HALF_LIFE_BUCKETS, WINDOW_BUCKETS
+
+
+class TrendingTestCase(DBTestCase):
+    def setUp(self):
+        super().setUp()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.add_all([u1, u2])
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u1.id)
+        m2 = Message(text="m2-text", user_id=u1.id)
+        m3 = Message(text="m3-text", user_id=u1.id)
+        db.session.add_all([m1, m2, m3])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+        self.m3_id = m3.id
+
+        self.counter = trending.TrendingCounter()
+        self.now = time.time()
+
+    def test_decayed_scores(self):
+        """Tests recent likes count most, and unlikes take them back"""
+        two_half_lives_ago = self.now - HALF_LIFE_BUCKETS * BUCKET_SECONDS * 2
+
+        for _ in range(3):
+            self.counter.liked(self.m1_id, now=self.now)
+            self.counter.liked(self.m2_id, now=two_half_lives_ago)
+
+        self.counter.unliked(self.m1_id, now=self.now)
+        self.counter.posted(self.m3_id, now=self.now)
+
+        self.assertEqual(self.counter.flush(), 3)
+        self.assertEqual(self.counter.refresh(now=self.now), 3)
+
+        # m1: 2 likes; m2: 3 likes at a quarter weight; m3: just posted
+        self.assertEqual(
+            [m.id for m in trending.get_messages()],
+            [self.m1_id, self.m2_id, self.m3_id])
+
+    def test_flush_adds_up(self):
+        """Tests flushes add to the counts already in the database"""
+        for _ in range(2):
+            self.counter.liked(self.m1_id, now=self.now)
+            self.counter.flush()
+
+        self.assertEqual(self.counter.flush(), 0)
+        self.assertEqual(
+            db.session.execute(
+                select(TrendingCount.likes)
+                .where(TrendingCount.message_id == self.m1_id)).scalar(),
+            2)
+
+    def test_window(self):
+        """Tests counts that left the window don't count, and are deleted"""
+        long_ago = self.now - WINDOW_BUCKETS * BUCKET_SECONDS
+
+        self.counter.liked(self.m1_id, now=long_ago)
+        self.counter.liked(self.m2_id, now=self.now)
+        self.counter.flush()
+
+        self.assertEqual(self.counter.refresh(now=self.now), 1)
+        self.assertEqual(
+            [m.id for m in trending.get_messages()], [self.m2_id])
+        self.assertEqual(
+            db.session.execute(select(TrendingCount.message_id)).scalars()
+            .all(),
+            [self.m2_id])
+
+    def test_starts_on_first_count(self):
+        """Tests a counter set up with the app starts flushing by itself"""
+        self.counter.init_app(app)
+
+        with patch('trending.threading.Thread') as Thread:
+            self.counter.liked(self.m1_id, now=self.now)
+            self.counter.posted(self.m2_id, now=self.now)
+
+        Thread.assert_called_once()
+        Thread.return_value.start.assert_called_once()
+        # The counts made while starting are kept
+        self.assertEqual(self.counter.flush(), 2)
+
+    def test_is_stale(self):
+        """Tests the list is refreshed once it's older than the interval"""
+        self.assertTrue(self.counter.is_stale())
+
+        self.counter.posted(self.m1_id)
+        self.counter.flush()
+        self.counter.refresh()
+
+        self.assertFalse(self.counter.is_stale())
+
+    def test_deleted_message(self):
+        """Tests deleted messages drop out of the list straight away"""
+        self.counter.liked(self.m1_id, now=self.now)
+        self.counter.liked(self.m2_id, now=self.now)
+        self.counter.flush()
+        self.counter.refresh(now=self.now)
+
+        db.session.get(Message, self.m1_id).delete()
+        db.session.commit()
+
+        self.assertEqual(
+            [m.id for m in trending.get_messages()], [self.m2_id])
+
+    def test_trending_view(self):
+        """Tests liking a message puts it on the trending page"""
+        with patch('app.trending_counter', self.counter):
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+
+                c.post(f'/messages/{self.m2_id}/like-toggle',
+                       data={'origin_url': '/'})
+
+                self.counter.flush()
+                self.counter.refresh()
+
+                resp = c.get('/trending')
+                html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('m2-text', html)
+        self.assertNotIn('m1-text', html)
+
+    def test_trending_view_logged_out(self):
+        """Tests the trending page is for logged-in users"""
+        with app.test_client() as c:
+            resp = c.get('/trending', follow_redirects=True)
+
+        self.assertIn('Access unauthorized', resp.get_data(as_text=True))
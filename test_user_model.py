@@ -4,41 +4,17 @@
 #
 #    python -m unittest test_user_model.py
 
-
-import os
-from unittest import TestCase
 from flask_bcrypt import Bcrypt
-from models import db, User, Message, Follow, Like, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
+from testing import DBTestCase
+from models import db, User, Message, DEFAULT_IMAGE_URL, DEFAULT_HEADER_IMAGE_URL
 from sqlalchemy.exc import IntegrityError
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
-from app import app
-
 bcrypt = Bcrypt()
 
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DBTestCase):
     def setUp(self):
-        Follow.query.delete()
-        Like.query.delete()
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -52,9 +28,6 @@ class UserModelTestCase(TestCase):
         self.u1_id = u1.id
         self.u2_id = u2.id
 
-    def tearDown(self):
-        db.session.rollback()
-
     def test_repr(self):
         """Tests repr for User model"""
         u1 = User.query.get(self.u1_id)
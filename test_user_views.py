@@ -5,37 +5,21 @@
 #    python -m unittest test_user_views.py
 
 import os
-from unittest import TestCase
-from models import db, User, Message, Like, Follow
+from io import BytesIO
+from unittest.mock import Mock, patch
 
+from PIL import Image
+from sqlalchemy import event
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
-
-# Now we can import app
-
+from testing import DBTestCase
 from app import app, CURR_USER_KEY
+from images import generate_variants
+from models import db, User
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.drop_all()
-db.create_all()
-
-app.config['WTF_CSRF_ENABLED'] = False
 
-
-class UserTemplateTestCase(TestCase):
+class UserTemplateTestCase(DBTestCase):
     def setUp(self):
-        Follow.query.delete()
-        Like.query.delete()
-        Message.query.delete()
-        User.query.delete()
+        super().setUp()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -50,9 +34,6 @@ class UserTemplateTestCase(TestCase):
         self.u2_id = u2.id
         self.u3_id = u3.id
 
-    def tearDown(self):
-        db.session.rollback()
-
 
 class UserAuthTestCase(UserTemplateTestCase):
     def test_get_signup(self):
@@ -113,6 +94,26 @@ class UserAuthTestCase(UserTemplateTestCase):
             html = resp_email.get_data(as_text=True)
             self.assertIn('Username or email already taken', html)
 
+    def test_signup_writes_after_hashing(self):
+        """Tests signup takes the write lock only once the hash is done"""
+        calls = Mock()
+        calls.hash.return_value = b'hashed'
+
+        with patch('app.begin_write', calls.begin_write), \
+                patch('models.bcrypt.generate_password_hash', calls.hash):
+            with app.test_client() as c:
+                c.post('/signup',
+                       data={
+                           'username': 'u4',
+                           'password': 'password',
+                           'email': 'u4@email.com',
+                           'image_url': ''
+                       })
+
+        self.assertEqual(
+            [name for name, _, _ in calls.mock_calls],
+            ['hash', 'begin_write'])
+
     def test_get_login(self):
         """Tests login form rendering"""
         with app.test_client() as c:
@@ -235,6 +236,20 @@ class UserRoutesTestCase(UserTemplateTestCase):
             self.assertIn("@u1", html)
             self.assertNotIn("@u2", html)
 
+    def test_list_users_search_no_results(self):
+        """Tests displaying of users search with no matches"""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/users?q=nobody')
+
+            self.assertEqual(resp.status_code, 200)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
     def test_list_users_search_unauthorized(self):
         """Tests displaying of users search result with nobody logged in"""
         with app.test_client() as c:
@@ -259,6 +274,22 @@ class UserRoutesTestCase(UserTemplateTestCase):
             html = resp.get_data(as_text=True)
             self.assertIn("@u1", html)
 
+    def test_show_user_streamed(self):
+        """Tests show user is streamed and shows counts"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f'/users/{self.u2_id}', buffered=False)
+            self.assertTrue(resp.is_streamed)
+
+            # Read after the view has returned, as a WSGI server would
+            html = resp.get_data(as_text=True)
+
+        self.assertIn("@u2", html)
+        self.assertRegex(
+            html, r'href="/users/\d+/following">\s*1\s*</a>')
+
     def test_show_user_unauthorized(self):
         """Tests show user with nobody logged in"""
         with app.test_client() as c:
@@ -312,6 +343,42 @@ class UserRoutesTestCase(UserTemplateTestCase):
             self.assertIn("@u2", html)
             self.assertNotIn("@u3", html)
 
+    def test_relationship_badges(self):
+        """Tests follow flags on follow lists come from the list query"""
+        u1 = User.query.get(self.u1_id)
+        u3 = User.query.get(self.u3_id)
+        u1.following.append(User.query.get(self.u2_id))
+        u3.following.append(u1)
+        db.session.commit()
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                html = c.get(f'/users/{self.u1_id}/followers').text
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+
+        cards = {
+            card.split('<p>@')[1].split('<')[0]: card
+            for card in html.split('class="card user-card"')[1:]}
+
+        # u1 follows u2 back, but not u3
+        self.assertIn('Mutual', cards['u2'])
+        self.assertIn('Unfollow', cards['u2'])
+        self.assertIn('Follows you', cards['u3'])
+        self.assertIn('/users/follow/', cards['u3'])
+
+        # Rows are rendered after the list query, with no queries of their own
+        self.assertIn('you_follow', statements[-1])
+
     def test_show_followers_unauthorized(self):
         """Tests show followers with nobody logged in"""
         with app.test_client() as c:
@@ -361,6 +428,9 @@ class UserRoutesTestCase(UserTemplateTestCase):
             html = resp_already.get_data(as_text=True)
             self.assertIn("You are already following that person!", html)
 
+            html = c.get(f'/users/{self.u2_id}').get_data(as_text=True)
+            self.assertNotIn("You are already following that person!", html)
+
     def test_start_following_unauthorized(self):
         """Tests start following with nobody logged in"""
         with app.test_client() as c:
@@ -493,6 +563,66 @@ class UserRoutesTestCase(UserTemplateTestCase):
             html = resp_email.get_data(as_text=True)
             self.assertIn("Username or email already taken", html)
 
+    def test_edit_profile_upload(self):
+        """Tests uploading a profile image and serving its thumbnail"""
+        png = BytesIO()
+        Image.new('RGB', (800, 600), 'blue').save(png, 'PNG')
+        png.seek(0)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post('/users/profile',
+                          data={
+                              "username": "u1",
+                              "email": "u1@email.com",
+                              "password": "password",
+                              "image_file": (png, 'avatar.png'),
+                          },
+                          content_type='multipart/form-data')
+
+            self.assertEqual(resp.status_code, 302)
+
+            u1 = db.session.get(User, self.u1_id)
+            self.assertTrue(u1.image_url.startswith('/uploads/avatars/'))
+
+            generate_variants(
+                os.path.join(app.config['UPLOAD_FOLDER'],
+                              u1.image_url.removeprefix('/uploads/')),
+                'avatars')
+
+            html = c.get(f'/users/{self.u1_id}').get_data(as_text=True)
+            thumb_url = u1.image_url.replace('.png', '-thumb.jpg')
+            self.assertIn(thumb_url, html)
+
+            resp = c.get(thumb_url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertEqual(Image.open(BytesIO(resp.data)).size, (256, 256))
+
+    def test_edit_profile_upload_invalid(self):
+        """Tests uploading a file that isn't an image"""
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post('/users/profile',
+                          data={
+                              "username": "u1",
+                              "email": "u1@email.com",
+                              "password": "password",
+                              "image_file": (BytesIO(b'not an image'),
+                                             'avatar.png'),
+                          },
+                          content_type='multipart/form-data')
+
+            self.assertEqual(resp.status_code, 200)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("Invalid image file", html)
+
     def test_edit_profile_wrong_password(self):
         """Tests edit profile with incorrect password"""
         with app.test_client() as c:
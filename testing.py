@@ -0,0 +1,184 @@
+"""Shared setup for the Warbler test suite.
+
+Import this module BEFORE importing the app: it points DATABASE_URL at the
+test database and lowers the bcrypt cost so that signing users up in
+`setUp` is cheap.
+
+Each pytest-xdist worker gets its own database (warbler_test_gw0,
+warbler_test_gw1, ...) so the suite can run across all cores:
+
+    python -m pytest -n auto
+
+Set TEST_DATABASE_URL to run against another database, e.g.
+`sqlite:////tmp/warbler_test.sqlite3` to run without a Postgres server.
+
+Every test runs inside an outer transaction that is rolled back in
+`tearDown`, so tests never have to delete rows themselves.
+"""
+
+import os
+import tempfile
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from flask.testing import FlaskClient
+from flask_sqlalchemy.session import _app_ctx_id
+
+TEST_DATABASE_URL = os.environ.get(
+    'TEST_DATABASE_URL', "postgresql:///warbler_test")
+
+
+def create_database(url):
+    """Create the Postgres database of `url` if it doesn't exist yet.
+
+    SQLite databases are created when first opened, so are left alone.
+    """
+
+    url = make_url(url)
+
+    if url.get_backend_name() != 'postgresql':
+        return
+
+    engine = create_engine(
+        url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+
+    with engine.connect() as conn:
+        exists = conn.execute(
+            text("SELECT 1 FROM pg_database WHERE datname = :name"),
+            {"name": url.database},
+        ).scalar()
+
+        if not exists:
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+
+    engine.dispose()
+
+
+def get_worker_database_url(base_url=TEST_DATABASE_URL):
+    """Return database URL for this test process.
+
+    Under pytest-xdist the worker id is appended to the database name and
+    the database is created if it doesn't exist yet.
+    """
+
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+
+    if not worker:
+        return base_url
+
+    url = make_url(base_url)
+
+    if url.get_backend_name() == 'sqlite':
+        root, ext = os.path.splitext(url.database)
+        worker_url = url.set(database=f"{root}_{worker}{ext}")
+        return worker_url.render_as_string(hide_password=False)
+
+    worker_url = url.set(database=f"{url.database}_{worker}")
+
+    create_database(worker_url)
+
+    return worker_url.render_as_string(hide_password=False)
+
+
+def get_shard_database_urls(count=2, base_url=TEST_DATABASE_URL):
+    """Return URLs of `count` shard databases for this test process,
+    creating them if needed (warbler_test_shard0, ...)."""
+
+    url = make_url(base_url)
+    urls = []
+
+    for i in range(count):
+        shard_url = url.set(database=f"{url.database}_shard{i}")
+        shard_url = get_worker_database_url(
+            shard_url.render_as_string(hide_password=False))
+        create_database(shard_url)
+        urls.append(shard_url)
+
+    return urls
+
+
+os.environ['DATABASE_URL'] = get_worker_database_url()
+
+DATABASE_BACKEND = make_url(os.environ['DATABASE_URL']).get_backend_name()
+
+# For tests of features that only exist on PostgreSQL (archive partitions,
+# LISTEN/NOTIFY, sharding)
+requires_postgres = skipUnless(
+    DATABASE_BACKEND == 'postgresql', "needs PostgreSQL")
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+os.environ.setdefault('UPLOAD_FOLDER', tempfile.mkdtemp(prefix='warbler-'))
+os.environ.setdefault(
+    'PROFILER_STORAGE',
+    os.path.join(tempfile.mkdtemp(prefix='warbler-'), 'profiler.sqlite3'))
+os.environ.setdefault('EVENTS_CHANNEL', 'local')
+# Tests flush trending counts, apply suggestion updates and load name
+# filters themselves, not from threads that outlive their transaction
+os.environ.setdefault('TRENDING_FLUSH', '0')
+os.environ.setdefault('TAKEN_NAMES', '0')
+os.environ.setdefault('SUGGESTION_UPDATES', '0')
+
+# Now we can import app
+
+from app import app  # noqa: E402
+from models import db  # noqa: E402
+
+# Create our tables once per test process; each test runs in a transaction
+# that is rolled back, so there's nothing to clean up between tests
+
+db.drop_all()
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Rate limits are tested separately, against a throwaway store
+
+app.config['RATELIMIT_ENABLED'] = False
+
+
+class TestClient(FlaskClient):
+    """Test client that doesn't keep request contexts after a `with` block.
+
+    No test looks at them, and a streamed page keeps its own request context
+    open until it's read (stream_with_context): the copies the client keeps
+    across redirects get popped out of order.
+    """
+
+    def __enter__(self):
+        return self
+
+
+app.test_client_class = TestClient
+
+
+class DBTestCase(TestCase):
+    """Base test case that wraps each test in a rolled-back transaction.
+
+    Calls to `db.session.commit()` (in tests or in view functions) only
+    release a savepoint, so everything a test writes disappears when the
+    outer transaction is rolled back in `tearDown`.
+    """
+
+    def setUp(self):
+        self._app_session = db.session
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        db.session = scoped_session(
+            sessionmaker(
+                bind=self.connection,
+                join_transaction_mode="create_savepoint",
+            ),
+            scopefunc=_app_ctx_id,
+        )
+
+    def tearDown(self):
+        db.session.remove()
+        db.session = self._app_session
+
+        self.transaction.rollback()
+        self.connection.close()
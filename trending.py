@@ -0,0 +1,259 @@
+"""Trending warbles: the most liked lately, recent likes counting most.
+
+Each worker counts likes, unlikes and new posts in memory, per message
+and BUCKET_SECONDS time bucket, and its background thread adds them to
+`trending_counts` every FLUSH_INTERVAL seconds in one upsert. Liking a
+message costs no extra query. The thread is started by `gunicorn.conf.py`,
+or by the first count in a process that has none yet (e.g. `flask run`).
+
+A message's score sums its likes, and POST_WEIGHT for being posted, over
+the last WINDOW_BUCKETS buckets, each bucket's weight halving every
+HALF_LIFE_BUCKETS as it ages. The top TRENDING_SIZE are precomputed into
+`trending_messages`, recomputed by whichever worker finds them more than
+REFRESH_INTERVAL seconds old; counts that have left the window are
+deleted then. The trending page only reads that table.
+
+Counts a worker hasn't flushed when it's killed are lost: trending is an
+estimate.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from models import db, shards, Message, TrendingCount, TrendingMessage
+
+logger = logging.getLogger('warbler.trending')
+
+BUCKET_SECONDS = 300
+# Six hours, with a like's weight halving every hour
+WINDOW_BUCKETS = 72
+HALF_LIFE_BUCKETS = 12
+POST_WEIGHT = 0.5
+
+TRENDING_SIZE = 50
+
+FLUSH_INTERVAL = 5
+REFRESH_INTERVAL = 5
+
+
+def get_bucket(now=None):
+    """Bucket of Unix time `now` (default: the current time)."""
+
+    return int((time.time() if now is None else now) // BUCKET_SECONDS)
+
+
+def get_messages(limit=TRENDING_SIZE):
+    """Trending messages, highest score first."""
+
+    ids = db.session.execute(
+        select(TrendingMessage.message_id)
+        .order_by(TrendingMessage.score.desc(),
+                  TrendingMessage.message_id.desc())
+        .limit(limit)).scalars().all()
+
+    stmts = {
+        shard: select(Message).where(Message.id.in_(message_ids))
+        for shard, message_ids in shards.group_by_message(ids).items()}
+
+    messages = {message.id: message for message, in shards.scatter(stmts)}
+
+    # Deleted messages stay in the list until it's next refreshed
+    return [messages[id] for id in ids if id in messages]
+
+
+def upsert_counts(rows):
+    """Add (bucket, message_id, likes, posts) dicts to trending_counts."""
+
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        insert_ = postgresql.insert
+    elif dialect == 'sqlite':
+        insert_ = sqlite.insert
+    else:
+        raise NotImplementedError(f"No upsert for {dialect}")
+
+    table = TrendingCount.__table__
+    stmt = insert_(table)
+
+    db.session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['bucket', 'message_id'],
+            set_={
+                'likes': table.c.likes + stmt.excluded.likes,
+                'posts': table.c.posts + stmt.excluded.posts,
+            }),
+        rows)
+
+
+class TrendingCounter:
+    """In-memory like and post counts, flushed to the database."""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._app = None
+        # (bucket, message_id): [likes, posts]
+        self._counts = defaultdict(lambda: [0, 0])
+
+    def init_app(self, app):
+        """Start flushing in each process the first time it counts."""
+
+        self._app = app
+
+    def _add(self, message_id, likes=0, posts=0, now=None):
+        if self._app is not None and self._pid != os.getpid():
+            self.start(self._app)
+
+        with self._lock:
+            count = self._counts[get_bucket(now), message_id]
+            count[0] += likes
+            count[1] += posts
+
+    def liked(self, message_id, now=None):
+        self._add(message_id, likes=1, now=now)
+
+    def unliked(self, message_id, now=None):
+        self._add(message_id, likes=-1, now=now)
+
+    def posted(self, message_id, now=None):
+        self._add(message_id, posts=1, now=now)
+
+    def start(self, app):
+        """Flush and refresh in a background thread of this process.
+
+        Does nothing if already started in this process.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            self._app = app
+            # Counts copied from the parent by a fork are the parent's
+            self._counts = defaultdict(lambda: [0, 0])
+
+        threading.Thread(
+            target=self._run, name='trending', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+
+            try:
+                with self._app.app_context():
+                    self.flush()
+
+                    if self.is_stale():
+                        self.refresh()
+            except Exception:
+                logger.exception("Can't update trending messages")
+
+    def flush(self):
+        """Add the counts since the last flush to the database.
+
+        Returns how many (bucket, message) rows were written. Counts are
+        kept for the next flush if this one fails.
+        """
+
+        with self._lock:
+            counts, self._counts = (
+                self._counts, defaultdict(lambda: [0, 0]))
+
+        rows = [
+            {'bucket': bucket, 'message_id': message_id,
+             'likes': likes, 'posts': posts}
+            for (bucket, message_id), (likes, posts) in counts.items()
+            if likes or posts]
+
+        if not rows:
+            return 0
+
+        try:
+            upsert_counts(rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+
+            with self._lock:
+                for key, (likes, posts) in counts.items():
+                    self._counts[key][0] += likes
+                    self._counts[key][1] += posts
+
+            raise
+
+        return len(rows)
+
+    def is_stale(self):
+        """Whether trending_messages is older than REFRESH_INTERVAL."""
+
+        computed_at = db.session.execute(
+            select(func.max(TrendingMessage.computed_at))).scalar()
+        db.session.commit()
+
+        return computed_at is None or (
+            datetime.utcnow() - computed_at
+            >= timedelta(seconds=self.refresh_interval))
+
+    def refresh(self, now=None):
+        """Recompute trending_messages from the counts in the window.
+
+        Returns the number of trending messages, or None if another worker
+        was refreshing them at the same time.
+        """
+
+        bucket = get_bucket(now)
+        start = bucket - WINDOW_BUCKETS + 1
+        weight = case(
+            {b: 0.5 ** ((bucket - b) / HALF_LIFE_BUCKETS)
+             for b in range(start, bucket + 1)},
+            value=TrendingCount.bucket,
+            else_=0.0)
+        score = func.sum(
+            (TrendingCount.likes + TrendingCount.posts * POST_WEIGHT)
+            * weight)
+
+        # Reads and then writes: take SQLite's write lock first
+        db.session.connection(
+            execution_options={'sqlite_begin': 'IMMEDIATE'})
+
+        top = db.session.execute(
+            select(TrendingCount.message_id, score.label('score'))
+            .where(TrendingCount.bucket.between(start, bucket))
+            .group_by(TrendingCount.message_id)
+            .having(score > 0)
+            .order_by(score.desc(), TrendingCount.message_id.desc())
+            .limit(TRENDING_SIZE)).all()
+
+        computed_at = datetime.utcnow()
+
+        try:
+            db.session.execute(delete(TrendingMessage))
+
+            if top:
+                db.session.execute(insert(TrendingMessage), [
+                    {'message_id': message_id, 'score': score,
+                     'computed_at': computed_at}
+                    for message_id, score in top])
+
+            db.session.execute(
+                delete(TrendingCount).where(TrendingCount.bucket < start))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return None
+
+        return len(top)